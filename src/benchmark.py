@@ -0,0 +1,164 @@
+import os
+import sys
+import time
+import argparse
+import pandas as pd
+from helper.config import PATHS, PARAMETERS
+from helper.logger import setup_logger
+from helper.path_define import samid, norm_vcf_path, FULL_PANEL
+from helper.file_utils import process_vcf
+from helper.truth_cache import load_truth
+from helper.lifecycle import ArtifactTracker
+from helper.chunk_planner import plan_chunk_params, predicted_seconds, fit_cost_model
+from helper.chunk_planner import panel_sample_count
+from pipeline.reference_panel_prepare import glimpse_chunk, chunk_reference_genome, split_reference_panel, prepare_panel
+from pipeline.ground_truth import ground_truth_vcf
+from pipeline.glimpse import read_chunks, phase_genome, phase_input, extract_chunk_id, ligate_genome, chunk_memory_gb
+from statistic.GT import valid_gt
+
+
+logger = setup_logger(os.path.join(PATHS["logs"], "benchmark.log"))
+
+
+def benchmark_dir(*parts):
+    path = os.path.join(PATHS["result_directory"], "benchmark", *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def chunk_summary(label, chromosome, chunk_file, model):
+    chunks = read_chunks(chromosome, chunk_file)
+    n_variants = [chunk[3] for chunk in chunks]
+    return {
+        "chunking": label,
+        "chunks": len(chunks),
+        "mean input variants": sum(n_variants) / max(len(chunks), 1),
+        "predicted phase seconds": float(sum(predicted_seconds(n, chromosome, model=model) for n in n_variants)),
+    }
+
+
+def benchmark_chunking(fq, chromosome, run=False):
+    """
+    So sánh cách chia chunk cũ (2 Mb / 0.2 Mb) với chunk planner trên một mẫu tham chiếu:
+    tổng thời gian phase dự đoán theo cost model, và thời gian đo thực tế nếu run=True (mode "bam").
+    Cả hai cách đều chia trên panel biallelic đã lọc MAF (panel dùng để phase), để số variant
+    của các chunk (cột 7) so sánh được với nhau.
+    """
+    outdir = benchmark_dir("chunking", samid(fq), chromosome)
+    model = fit_cost_model()
+    chunk_sets = {
+        "fixed_2mb": glimpse_chunk(chromosome, os.path.join(outdir, "fixed_2mb.chunks.txt"), input_vcf=norm_vcf_path(chromosome)),
+        "planned": glimpse_chunk(chromosome, os.path.join(outdir, "planned.chunks.txt"), plan_chunk_params(chromosome, model=model)),
+    }
+
+    rows = []
+    for label, chunk_file in chunk_sets.items():
+        row = chunk_summary(label, chromosome, chunk_file, model)
+        if run:
+            workdir = os.path.join(outdir, label)
+            tracker = ArtifactTracker(f"benchmark_{label}")
+            started = time.time()
+            timings = phase_genome(workdir, f"benchmark_{label}", chromosome, tracker, phase_input(fq, None), chunk_file=chunk_file)
+            row["wall seconds"] = time.time() - started
+            row["measured phase seconds"] = sum(timings.values())
+        rows.append(row)
+
+    df = pd.DataFrame(rows)
+    df.to_csv(os.path.join(outdir, "summary.csv"), index=False)
+    logger.info(f"Chunking benchmark for {samid(fq)} {chromosome}:\n{df.to_string(index=False)}")
+    print(df.to_string(index=False))
+    return df
+
+
+def genotype_concordance(truth_vcf, imputed_vcf):
+    """
+    Độ trùng khớp kiểu gen giữa kết quả impute và ground truth trên các site có ở cả hai.
+    """
+    truth = load_truth(truth_vcf, "Truth")
+    imputed = process_vcf(imputed_vcf, "Imputed")
+    merged = pd.merge(truth, imputed, on=["CHROM", "POS", "REF", "ALT"], how="inner")
+    merged = merged[merged["GT_Truth"].apply(valid_gt) & merged["GT_Imputed"].apply(valid_gt)]
+
+    match = merged["GT_Truth"] == merged["GT_Imputed"]
+    non_ref = merged["GT_Truth"] != "0/0"
+    return {
+        "sites": len(merged),
+        "concordance": float(match.mean()) if len(merged) else 0.0,
+        "non-ref sites": int(non_ref.sum()),
+        "non-ref concordance": float(match[non_ref].mean()) if non_ref.any() else 0.0,
+    }
+
+
+def benchmark_panels(fq, chromosome, panels):
+    """
+    So sánh panel đầy đủ với các panel con trên một mẫu đơn (mode "bam"): thời gian phase,
+    bộ nhớ dự kiến và độ trùng khớp kiểu gen so với ground truth của mẫu.
+    """
+    truth_vcf = ground_truth_vcf(samid(fq), chromosome)
+    rows = []
+    for panel in panels:
+        prepare_panel(chromosome, panel)
+        workdir = benchmark_dir("panels", samid(fq), chromosome, panel)
+        tracker = ArtifactTracker(f"benchmark_{panel}")
+        chunks = read_chunks(chromosome, panel=panel)
+
+        started = time.time()
+        timings = phase_genome(workdir, f"benchmark_{panel}", chromosome, tracker, phase_input(fq, None), panel=panel)
+        extract_chunk_id(workdir, chromosome, panel=panel)
+        imputed_vcf = ligate_genome(workdir, chromosome, tracker)
+
+        rows.append({
+            "panel": panel,
+            "panel samples": panel_sample_count(chromosome, panel),
+            "chunks": len(chunks),
+            "peak chunk memory GB": chunk_memory_gb(max((chunk[3] for chunk in chunks), default=0)),
+            "wall seconds": time.time() - started,
+            "measured phase seconds": sum(timings.values()),
+            **genotype_concordance(truth_vcf, imputed_vcf),
+        })
+
+    df = pd.DataFrame(rows)
+    df.to_csv(os.path.join(benchmark_dir("panels", samid(fq), chromosome), "summary.csv"), index=False)
+    logger.info(f"Panel benchmark for {samid(fq)} {chromosome}:\n{df.to_string(index=False)}")
+    print(df.to_string(index=False))
+    return df
+
+
+def replan_chunks(chromosomes):
+    """
+    Tạo lại file chunk theo cost model hiện tại và reference nhị phân tương ứng.
+    """
+    for chromosome in chromosomes:
+        chunk_reference_genome(chromosome, force=True)
+        split_reference_panel(chromosome)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the imputation pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    chunking = subparsers.add_parser("chunking", help="fixed 2 Mb chunks vs cost-model chunks")
+    chunking.add_argument("fastq", help="fastq của mẫu tham chiếu (đã chạy alignment)")
+    chunking.add_argument("chromosome")
+    chunking.add_argument("--run", action="store_true", help="chạy GLIMPSE2_phase thật với cả hai cách chia")
+
+    panels = subparsers.add_parser("panels", help="full reference panel vs population-subset panels")
+    panels.add_argument("fastq", help="fastq của một mẫu đơn có ground truth (đã chạy alignment)")
+    panels.add_argument("chromosome")
+    panels.add_argument("--panels", nargs="+", default=[FULL_PANEL, *PARAMETERS["panel"]["subsets"]])
+
+    replan = subparsers.add_parser("replan", help="regenerate chunk files from the cost model")
+    replan.add_argument("chromosomes", nargs="*", default=PARAMETERS["chrs"])
+
+    args = parser.parse_args()
+    if args.command == "chunking":
+        benchmark_chunking(args.fastq, args.chromosome, args.run)
+    elif args.command == "panels":
+        benchmark_panels(args.fastq, args.chromosome, args.panels)
+    elif args.command == "replan":
+        replan_chunks(args.chromosomes)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
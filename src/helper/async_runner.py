@@ -0,0 +1,284 @@
+import os
+import re
+import time
+import asyncio
+import threading
+from collections import deque
+from helper.config import PATHS, PARAMETERS
+from helper.logger import setup_logger
+
+logger = setup_logger(os.path.join(PATHS["logs"], "async_runner.log"))
+
+RUNNER = PARAMETERS["runner"]
+# Đọc output của tiến trình theo khối (không theo dòng: output có thể không có '\n', ví dụ progress '\r')
+STREAM_CHUNK = 1 << 16
+# Độ dài tối đa của một dòng giữ trong tail
+TAIL_LINE_BYTES = 4096
+LINE_BREAK = re.compile(rb"[\r\n]")
+
+
+class Job:
+    """
+    Một lệnh ngoài (hoặc một pipeline lệnh nối bằng pipe) chạy trong AsyncRunner.
+
+        Job("basevar:chr21:1-100", [basetype_cmd], resource="basevar", log_path=..., retries=2)
+        Job("gl:chr21", [mpileup_cmd, call_cmd], resource="gl")     # mpileup | call
+        Job("merge:chr21", function=lambda: merge(...), resource="basevar_merge")
+
+    - resource: tên semaphore giới hạn số job cùng loại chạy đồng thời (runner.limits)
+    - memory: bộ nhớ dự kiến (GB), tổng của các job đang chạy không vượt quá runner.memory_gb
+    - fatal: job lỗi (sau khi hết retry) sẽ hủy mọi job khác trong cùng lần run()
+    - on_start(job) / on_failure(job, tail) / on_success(job): callback chạy trên event loop;
+      on_success có thể trả về danh sách job mới để đưa vào hàng đợi.
+    """
+
+    def __init__(self, name, commands=None, function=None, resource="default", memory=0, log_path=None, stdout_path=None,
+                 retries=0, backoff=0, fatal=True, on_start=None, on_success=None, on_failure=None):
+        if commands and isinstance(commands[0], str):
+            commands = [commands]
+        self.name = name
+        self.commands = commands or []
+        self.function = function
+        self.resource = resource
+        self.memory = memory
+        self.log_path = log_path
+        self.stdout_path = stdout_path
+        self.retries = retries
+        self.backoff = backoff
+        self.fatal = fatal
+        self.on_start = on_start
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.returncode = None
+        self.attempts = 0
+        self.elapsed = None
+
+
+class JobFailed(RuntimeError):
+    def __init__(self, job, tail):
+        self.job = job
+        self.tail = tail
+        super().__init__(f"Job {job.name} failed with exit code {job.returncode}: {' | '.join(tail)}")
+
+
+class MemoryBudget:
+    """
+    Semaphore có trọng số theo GB bộ nhớ. Job không vừa chỗ trống sẽ chờ, trong khi job nhỏ hơn
+    vẫn được chạy nếu vừa (lấp chỗ trống còn lại). Job lớn hơn cả budget chỉ chạy khi budget trống.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.used = 0
+        self.condition = None
+
+    async def acquire(self, amount):
+        amount = min(amount, self.capacity)
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used + amount <= self.capacity)
+            self.used += amount
+        return amount
+
+    async def release(self, amount):
+        async with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+
+class AsyncRunner:
+    """
+    Chạy các job ngoài bằng asyncio.create_subprocess_exec trên một event loop riêng (một thread),
+    thay vì giữ một thread cho mỗi tiến trình. Semaphore theo resource được dùng chung cho mọi mẫu
+    đang chạy trong cùng tiến trình Python, nên giới hạn trong runner.limits là giới hạn toàn cục.
+
+        results = runner.run(jobs)   # chặn tới khi mọi job (kể cả job sinh thêm) chạy xong
+    """
+
+    def __init__(self, limits, memory_gb=RUNNER["memory_gb"], default_limit=PARAMETERS["threads"], tail_lines=RUNNER["log_tail"]):
+        self.limits = dict(limits)
+        self.memory = MemoryBudget(memory_gb)
+        self.default_limit = default_limit
+        self.tail_lines = tail_lines
+        self.semaphores = {}
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self.loop.run_forever, name="async-runner", daemon=True)
+                thread.start()
+            return self.loop
+
+    def _semaphore(self, resource):
+        if resource not in self.semaphores:
+            self.semaphores[resource] = asyncio.Semaphore(self.limits.get(resource, self.default_limit))
+        return self.semaphores[resource]
+
+    def run(self, jobs):
+        """
+        Chạy một nhóm job, trả về {tên job: exit code}. Nếu một job fatal lỗi, các job còn lại
+        của nhóm bị hủy (tiến trình đang chạy bị kill) và JobFailed được raise.
+        """
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self._run_batch(list(jobs)), loop).result()
+
+    async def _run_batch(self, jobs):
+        batch = {"tasks": set(), "results": {}}
+
+        def submit(job):
+            batch["tasks"].add(asyncio.ensure_future(self._run_job(job, submit, batch["results"])))
+
+        for job in jobs:
+            submit(job)
+
+        while batch["tasks"]:
+            done, _ = await asyncio.wait(batch["tasks"], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                batch["tasks"].discard(task)
+                error = task.exception()
+                if error is None:
+                    continue
+                logger.error(f"Fatal job error, cancelling {len(batch['tasks'])} sibling jobs: {error}")
+                for sibling in batch["tasks"]:
+                    sibling.cancel()
+                await asyncio.gather(*batch["tasks"], return_exceptions=True)
+                raise error
+        return batch["results"]
+
+    async def _run_job(self, job, submit, results):
+        tail = []
+        for attempt in range(job.retries + 1):
+            job.attempts = attempt + 1
+            # Lấy slot của resource trước rồi mới giữ bộ nhớ: chỉ job sắp chạy mới chiếm budget,
+            # job đang xếp hàng chờ slot không giữ bộ nhớ của resource khác
+            async with self._semaphore(job.resource):
+                reserved = await self.memory.acquire(job.memory)
+                try:
+                    if job.on_start:
+                        job.on_start(job)
+                    started = time.time()
+                    job.returncode, tail = await self._execute(job)
+                    elapsed = job.elapsed = time.time() - started
+                finally:
+                    await self.memory.release(reserved)
+
+            if job.returncode == 0:
+                logger.info(f"{job.name} finished in {elapsed:.1f}s")
+                break
+            logger.warning(f"{job.name} failed (attempt {attempt + 1}/{job.retries + 1}, exit {job.returncode}): {' | '.join(tail)}")
+            if job.on_failure:
+                job.on_failure(job, tail)
+            if attempt < job.retries:
+                await asyncio.sleep(job.backoff * 2 ** attempt)
+
+        results[job.name] = job.returncode
+        if job.returncode != 0:
+            if job.fatal:
+                raise JobFailed(job, tail)
+            return
+
+        if job.on_success:
+            for follow_up in job.on_success(job) or []:
+                submit(follow_up)
+
+    async def _execute(self, job):
+        if job.function is not None:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, job.function)
+            except Exception as e:
+                return 1, [repr(e)]
+            return 0, []
+
+        tail = deque(maxlen=self.tail_lines)
+        log = open(job.log_path, "wb") if job.log_path else None
+        stdout_file = open(job.stdout_path, "wb") if job.stdout_path else None
+        processes = []
+        readers = []
+        stdin = read_fd = write_fd = None
+        try:
+            for i, command in enumerate(job.commands):
+                if i < len(job.commands) - 1:
+                    read_fd, write_fd = os.pipe()
+                    stdout = write_fd
+                else:
+                    stdout = stdout_file if stdout_file else asyncio.subprocess.PIPE
+
+                process = await asyncio.create_subprocess_exec(
+                    *command, stdin=stdin, stdout=stdout, stderr=asyncio.subprocess.PIPE
+                )
+                processes.append(process)
+
+                # Đầu đọc/ghi của pipe giờ thuộc về tiến trình con
+                if stdin is not None:
+                    os.close(stdin)
+                if write_fd is not None:
+                    os.close(write_fd)
+                stdin, read_fd, write_fd = read_fd, None, None
+
+                readers.append(asyncio.ensure_future(self._stream(process.stderr, log, tail)))
+                if process.stdout is not None:
+                    readers.append(asyncio.ensure_future(self._stream(process.stdout, log, tail)))
+
+            await asyncio.gather(*readers)
+            returncodes = [await process.wait() for process in processes]
+        except (asyncio.CancelledError, Exception) as e:
+            for fd in (stdin, read_fd, write_fd):
+                if fd is not None:
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+            for process in processes:
+                await process.wait()
+            # Dừng các reader còn lại trước khi đóng file log
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            if isinstance(e, OSError):
+                # Không khởi chạy được lệnh (ví dụ thiếu chương trình)
+                return 127, list(tail) + [str(e)]
+            return 1, list(tail) + [repr(e)]
+        finally:
+            if log:
+                log.close()
+            if stdout_file:
+                stdout_file.close()
+
+        # Giống `set -o pipefail`: lấy mã lỗi khác 0 đầu tiên trong pipeline
+        returncode = next((code for code in returncodes if code != 0), 0)
+        return returncode, list(tail)
+
+    @staticmethod
+    async def _stream(stream, log, tail):
+        """
+        Ghi log của tiến trình ngay khi có dữ liệu, giữ lại vài dòng cuối để báo lỗi.
+        Đọc theo khối nên dòng rất dài hoặc output nhị phân không làm reader lỗi.
+        """
+        pending = b""
+        while True:
+            data = await stream.read(STREAM_CHUNK)
+            if not data:
+                break
+            if log:
+                log.write(data)
+                log.flush()
+            *lines, pending = LINE_BREAK.split(pending + data)
+            for line in lines:
+                if line.strip():
+                    tail.append(line[-TAIL_LINE_BYTES:].decode(errors="replace").rstrip())
+            pending = pending[-TAIL_LINE_BYTES:]
+        if pending.strip():
+            tail.append(pending.decode(errors="replace").rstrip())
+
+
+# Runner dùng chung cho toàn bộ tiến trình
+runner = AsyncRunner(RUNNER["limits"])
@@ -0,0 +1,241 @@
+import os
+import numpy as np
+import pysam
+from concurrent.futures import ProcessPoolExecutor
+from helper.config import PATHS, PARAMETERS
+from helper.logger import setup_logger
+from helper.path_define import reference_gc_path
+from helper.binned_depth import make_bins, write_binned_depth, gc_bins
+
+logger = setup_logger(os.path.join(PATHS["logs"], "bam_scanner.log"))
+
+# Các trường SN được ghi ra file thống kê (cùng tên với `samtools stats`)
+STAT_KEYS = [
+    "raw total sequences",
+    "reads mapped",
+    "reads unmapped",
+    "reads duplicated",
+    "reads MQ0",
+    "reads QC failed",
+    "non-primary alignments",
+    "total length",
+    "bases mapped (cigar)",
+    "mismatches",
+]
+
+
+def depth_runs(starts, ends, length):
+    """
+    Tính depth dạng run-length từ danh sách các block [start, end) của read.
+    Trả về (run_starts, run_depths); run cuối kéo dài tới hết chromosome.
+    """
+    if len(starts) == 0:
+        return np.zeros(1, dtype=np.int32), np.zeros(1, dtype=np.int32)
+
+    positions = np.concatenate((starts, ends))
+    deltas = np.concatenate((np.ones(len(starts), dtype=np.int32), -np.ones(len(ends), dtype=np.int32)))
+    order = np.argsort(positions, kind="stable")
+    positions = positions[order]
+    deltas = deltas[order]
+
+    breakpoints, first = np.unique(positions, return_index=True)
+    changes = np.add.reduceat(deltas, first)
+    breakpoints = breakpoints[changes != 0]
+    depths = np.cumsum(changes[changes != 0], dtype=np.int32)
+
+    if len(breakpoints) and breakpoints[0] == 0:
+        run_starts = breakpoints.astype(np.int32)
+        run_depths = depths
+    else:
+        run_starts = np.concatenate(([0], breakpoints)).astype(np.int32)
+        run_depths = np.concatenate(([0], depths)).astype(np.int32)
+    keep = run_starts < length
+    return run_starts[keep], run_depths[keep]
+
+
+def reference_gc(gc_reference, contig, bin_sizes):
+    """
+    (gc, acgt) của reference theo từng bin size. Không phụ thuộc mẫu nên chỉ tính một lần cho mỗi
+    reference, chromosome và bin size rồi cache ra .npy (giống reference_gaps); các lần sau chỉ đọc cache.
+    Trả về {bin_size: (gc, acgt)}, rỗng nếu không có reference hoặc chromosome không có trong reference.
+    """
+    if not gc_reference or not os.path.exists(gc_reference):
+        return {}
+
+    result = {}
+    missing = []
+    for bin_size in bin_sizes:
+        cache_path = reference_gc_path(gc_reference, contig, bin_size)
+        if os.path.exists(cache_path):
+            gc, acgt = np.load(cache_path)
+            result[bin_size] = (gc, acgt)
+        else:
+            missing.append(bin_size)
+    if not missing:
+        return result
+
+    with pysam.FastaFile(gc_reference) as fasta:
+        if contig not in fasta.references:
+            return result
+        sequence = fasta.fetch(contig)
+    for bin_size in missing:
+        cache_path = reference_gc_path(gc_reference, contig, bin_size)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        result[bin_size] = gc_bins(sequence, bin_size)
+        # Nhiều worker / mẫu có thể cùng tạo một cache: ghi file tạm riêng rồi os.replace
+        tmp_path = f"{cache_path}.{os.getpid()}.part.npy"
+        np.save(tmp_path, np.stack(result[bin_size]))
+        os.replace(tmp_path, cache_path)
+    return result
+
+
+def scan_contig(bam_path, contig, length, reference=None, bin_sizes=(), gc_reference=PATHS["ref"]):
+    """
+    Đọc toàn bộ read của một chromosome (qua BAM index) một lần duy nhất,
+    trả về thống kê cơ bản, depth dạng run-length và số read theo bin.
+    """
+    stats = dict.fromkeys(STAT_KEYS, 0)
+    block_starts = []
+    block_ends = []
+    read_starts = []
+    qual_starts = []
+    min_mapq = PARAMETERS["depth"]["min_mapq"]
+
+    with pysam.AlignmentFile(bam_path, reference_filename=reference) as bam:
+        for read in bam.fetch(contig):
+            if read.is_secondary or read.is_supplementary:
+                stats["non-primary alignments"] += 1
+                continue
+
+            stats["raw total sequences"] += 1
+            stats["total length"] += read.query_length
+            if read.is_qcfail:
+                stats["reads QC failed"] += 1
+            if read.is_duplicate:
+                stats["reads duplicated"] += 1
+            if read.is_unmapped:
+                stats["reads unmapped"] += 1
+                continue
+
+            stats["reads mapped"] += 1
+            if read.mapping_quality == 0:
+                stats["reads MQ0"] += 1
+            if read.has_tag("NM"):
+                stats["mismatches"] += read.get_tag("NM")
+
+            read_starts.append(read.reference_start)
+            if read.mapping_quality >= min_mapq and not read.is_duplicate and not read.is_qcfail:
+                qual_starts.append(read.reference_start)
+
+            # Giống `bedtools genomecov -split`: chỉ tính các block thực sự align
+            for start, end in read.get_blocks():
+                block_starts.append(start)
+                block_ends.append(end)
+                stats["bases mapped (cigar)"] += end - start
+
+    run_starts, run_depths = depth_runs(
+        np.asarray(block_starts, dtype=np.int64), np.asarray(block_ends, dtype=np.int64), length
+    )
+
+    bins = {}
+    if bin_sizes:
+        gc = reference_gc(gc_reference, contig, bin_sizes)
+        for bin_size in bin_sizes:
+            bins[bin_size] = make_bins(read_starts, qual_starts, gc.get(bin_size), length, bin_size)
+
+    return contig, stats, run_starts, run_depths, bins
+
+
+def write_stats(stats_path, stats):
+    """
+    Ghi file thống kê theo định dạng SN của `samtools stats`.
+    """
+    mapped_bases = stats["bases mapped (cigar)"]
+    total_reads = stats["raw total sequences"]
+    summary = dict(stats)
+    summary["average length"] = stats["total length"] / total_reads if total_reads else 0
+    summary["error rate"] = stats["mismatches"] / mapped_bases if mapped_bases else 0
+
+    with open(stats_path, "w") as out:
+        out.write("# Summary Numbers. Use `grep ^SN | cut -f 2-` to extract this part.\n")
+        for key, value in summary.items():
+            out.write(f"SN\t{key}:\t{value}\n")
+
+
+def write_bedgraph(cvg_bed_gz, contigs, runs):
+    """
+    Ghi coverage dạng bedgraph (tương đương `-bga`), nén BGZF và tạo index tabix.
+    """
+    with pysam.BGZFile(cvg_bed_gz, "wb") as out:
+        for contig, length in contigs:
+            run_starts, run_depths = runs[contig]
+            run_ends = np.append(run_starts[1:], length)
+            lines = "".join(
+                f"{contig}\t{start}\t{end}\t{depth}\n"
+                for start, end, depth in zip(run_starts.tolist(), run_ends.tolist(), run_depths.tolist())
+            )
+            out.write(lines.encode())
+
+    pysam.tabix_index(cvg_bed_gz, preset="bed", force=True)
+
+
+def scan_bam(bam_path, stats_path, cvg_bed_gz, depth_path, threads=PARAMETERS["threads"], reference=None, bins_paths=None):
+    """
+    Quét BAM một lần (song song theo chromosome) và tạo:
+      - file thống kê (thay cho `samtools stats`)
+      - coverage bedgraph đã nén và index (thay cho `bedtools genomecov -bga -split`), bỏ qua nếu cvg_bed_gz là None
+      - depth theo từng chromosome dạng run-length (.npz)
+      - binned depth cho mỗi bin size trong bins_paths ({bin_size: path .npy})
+    """
+    bins_paths = bins_paths or {}
+    with pysam.AlignmentFile(bam_path, reference_filename=reference) as bam:
+        contigs = list(zip(bam.references, bam.lengths))
+        unplaced_reads = bam.nocoordinate
+
+    logger.info(f"Scanning {bam_path} over {len(contigs)} contigs with {threads} workers")
+
+    # Chromosome dài chạy trước để tránh worker bị dồn việc ở cuối
+    ordered = sorted(contigs, key=lambda contig: contig[1], reverse=True)
+    stats = dict.fromkeys(STAT_KEYS, 0)
+    runs = {}
+    bins = {bin_size: {} for bin_size in bins_paths}
+
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        futures = [
+            executor.submit(scan_contig, bam_path, contig, length, reference, tuple(bins_paths))
+            for contig, length in ordered
+        ]
+        for future in futures:
+            contig, contig_stats, run_starts, run_depths, contig_bins = future.result()
+            for key, value in contig_stats.items():
+                stats[key] += value
+            runs[contig] = (run_starts, run_depths)
+            for bin_size, values in contig_bins.items():
+                bins[bin_size][contig] = values
+
+    stats["raw total sequences"] += unplaced_reads
+    stats["reads unmapped"] += unplaced_reads
+
+    write_stats(stats_path, stats)
+    if cvg_bed_gz is not None:
+        write_bedgraph(cvg_bed_gz, contigs, runs)
+    for bin_size, bins_path in bins_paths.items():
+        write_binned_depth(bins_path, bin_size, contigs, bins[bin_size])
+
+    depth_arrays = {}
+    for contig, (run_starts, run_depths) in runs.items():
+        depth_arrays[f"{contig}.start"] = run_starts
+        depth_arrays[f"{contig}.depth"] = run_depths
+    with open(depth_path, "wb") as out:
+        np.savez_compressed(out, **depth_arrays)
+
+    logger.info(f"Finished scanning {bam_path}: {stats['reads mapped']} mapped reads")
+    return stats
+
+
+def load_depth(depth_path, contig):
+    """
+    Đọc depth run-length của một chromosome từ file .npz do scan_bam tạo ra.
+    """
+    with np.load(depth_path) as data:
+        return data[f"{contig}.start"], data[f"{contig}.depth"]
@@ -0,0 +1,267 @@
+import struct
+import zlib
+
+# Block EOF chuẩn của BGZF (block rỗng)
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# Dữ liệu tối đa của một block (giống htslib)
+MAX_BLOCK_DATA = 0xff00
+
+TBI_MIN_SHIFT = 14
+TBI_FORMAT_VCF = 2
+
+
+def read_blocks(path):
+    """
+    Đọc lần lượt các block BGZF thô (chưa giải nén) của một file.
+    """
+    with open(path, "rb") as fh:
+        while True:
+            header = fh.read(18)
+            if not header:
+                return
+            if len(header) < 18 or header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+                raise ValueError(f"Not a BGZF file: {path}")
+            block_size = struct.unpack_from("<H", header, 16)[0] + 1
+            yield header + fh.read(block_size - 18)
+
+
+def has_eof(path):
+    """
+    File BGZF được ghi trọn vẹn (kết thúc bằng block EOF).
+    """
+    try:
+        with open(path, "rb") as fh:
+            fh.seek(-len(BGZF_EOF), 2)
+            return fh.read() == BGZF_EOF
+    except OSError:
+        return False
+
+
+def block_data(block):
+    """
+    Giải nén một block BGZF.
+    """
+    if struct.unpack_from("<I", block, len(block) - 4)[0] == 0:
+        return b""
+    return zlib.decompress(block[18:-8], -15)
+
+
+def compress_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def split_block_data(data):
+    """
+    Chia dữ liệu thành các đoạn vừa một block BGZF (tối đa MAX_BLOCK_DATA byte chưa nén).
+    """
+    for start in range(0, len(data), MAX_BLOCK_DATA):
+        yield data[start:start + MAX_BLOCK_DATA]
+
+
+def reg2bin(beg, end):
+    """
+    Bin nhỏ nhất chứa [beg, end) theo sơ đồ binning của BAI/TBI.
+    """
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+
+class TabixIndexBuilder:
+    """
+    Tạo index .tbi (preset vcf) từ các record và virtual offset của chúng.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+
+    def add(self, line, voffset_beg, voffset_end):
+        fields = line.split(b"\t", 8)
+        chrom = fields[0]
+        beg = int(fields[1]) - 1
+        end = beg + len(fields[3])
+        if len(fields) > 7 and b"END=" in fields[7]:
+            for item in fields[7].split(b";"):
+                if item.startswith(b"END="):
+                    end = max(end, int(item[4:]))
+        end = max(end, beg + 1)
+
+        if chrom not in self.refs:
+            self.names.append(chrom)
+            self.refs[chrom] = ({}, [])
+        bins, linear = self.refs[chrom]
+
+        chunks = bins.setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == voffset_beg:
+            chunks[-1][1] = voffset_end
+        else:
+            chunks.append([voffset_beg, voffset_end])
+
+        last_window = (end - 1) >> TBI_MIN_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> TBI_MIN_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = voffset_beg
+
+    def serialize(self):
+        names = b"".join(name + b"\0" for name in self.names)
+        out = [b"TBI\1", struct.pack("<8i", len(self.names), TBI_FORMAT_VCF, 1, 2, 0, ord("#"), 0, len(names)), names]
+        for name in self.names:
+            bins, linear = self.refs[name]
+            out.append(struct.pack("<i", len(bins)))
+            for bin_id in sorted(bins):
+                chunks = bins[bin_id]
+                out.append(struct.pack("<Ii", bin_id, len(chunks)))
+                out.extend(struct.pack("<QQ", beg, end) for beg, end in chunks)
+
+            # Cửa sổ không có record lấy offset của cửa sổ trước (giống htslib)
+            filled = []
+            previous = 0
+            for voffset in linear:
+                previous = voffset if voffset is not None else previous
+                filled.append(previous)
+            out.append(struct.pack(f"<i{len(filled)}Q", len(filled), *filled))
+        return b"".join(out)
+
+    def write(self, index_path):
+        data = self.serialize()
+        with open(index_path, "wb") as out:
+            for chunk in split_block_data(data):
+                out.write(compress_block(chunk))
+            out.write(BGZF_EOF)
+
+
+class IndexedBgzfWriter:
+    """
+    Ghi file VCF BGZF từ các block có sẵn (copy nguyên block, không nén lại)
+    và tạo index tabix trong cùng một lần ghi.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, "wb")
+        self.coffset = 0
+        self.index = TabixIndexBuilder()
+        self.partial = b""
+        self.line_start = None
+
+    def write_raw_block(self, block, data):
+        self._index(data)
+        self.fh.write(block)
+        self.coffset += len(block)
+
+    def write_data(self, data):
+        for chunk in split_block_data(data):
+            self.write_raw_block(compress_block(chunk), chunk)
+
+    def _index(self, data):
+        position = 0
+        while position < len(data):
+            if self.line_start is None:
+                self.line_start = (self.coffset << 16) | position
+            newline = data.find(b"\n", position)
+            if newline == -1:
+                self.partial += data[position:]
+                return
+            line = self.partial + data[position:newline]
+            if line and not line.startswith(b"#"):
+                self.index.add(line, self.line_start, (self.coffset << 16) | (newline + 1))
+            self.partial = b""
+            self.line_start = None
+            position = newline + 1
+
+    def close(self):
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+        self.index.write(f"{self.path}.tbi")
+
+
+def header_end(text):
+    """
+    Vị trí byte đầu tiên sau header (các dòng bắt đầu bằng '#'), None nếu chưa hết header.
+    """
+    position = 0
+    while position < len(text):
+        if text[position:position + 1] != b"#":
+            return position
+        newline = text.find(b"\n", position)
+        if newline == -1:
+            return None
+        position = newline + 1
+    return None
+
+
+def concat_vcfs(inputs, output):
+    """
+    Nối các file VCF.gz (BGZF) theo đúng thứ tự đầu vào, các region phải rời nhau và đã sắp xếp.
+    Header lấy từ file đầu tiên; block dữ liệu được copy nguyên trạng, chỉ block chứa
+    phần cuối header của mỗi file được nén lại. Index .tbi được tạo trong cùng lần ghi.
+    """
+    writer = IndexedBgzfWriter(output)
+    header = None
+
+    for path in inputs:
+        buffered = b""
+        in_header = True
+        for block in read_blocks(path):
+            data = block_data(block)
+            if not data:
+                continue
+            if not in_header:
+                writer.write_raw_block(block, data)
+                continue
+
+            buffered += data
+            end = header_end(buffered)
+            if end is None:
+                continue
+            in_header = False
+
+            file_header = buffered[:end]
+            if header is None:
+                header = file_header
+                writer.write_data(header)
+            elif file_header.rsplit(b"\n#CHROM", 1)[-1] != header.rsplit(b"\n#CHROM", 1)[-1]:
+                raise ValueError(f"Sample columns of {path} differ from {inputs[0]}")
+
+            offset_in_block = end - (len(buffered) - len(data))
+            if offset_in_block <= 0:
+                writer.write_raw_block(block, data)
+            else:
+                writer.write_data(data[offset_in_block:])
+
+        if in_header and header is None and buffered:
+            header = buffered
+            writer.write_data(header)
+
+    writer.close()
+    return output
+
+
+def concat_bgzf(inputs, output):
+    """
+    Nối các file BGZF không có header (ví dụ TSV các region) bằng cách copy nguyên block,
+    bỏ block EOF ở giữa. Index (tabix) cần tạo lại sau khi nối.
+    """
+    with open(output, "wb") as out:
+        for path in inputs:
+            for block in read_blocks(path):
+                if struct.unpack_from("<I", block, len(block) - 4)[0] == 0:
+                    continue
+                out.write(block)
+        out.write(BGZF_EOF)
+    return output
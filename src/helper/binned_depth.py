@@ -0,0 +1,134 @@
+import os
+import json
+import numpy as np
+
+# Mỗi bin gồm: số read (theo vị trí bắt đầu), số read đạt MAPQ và không duplicate,
+# tỷ lệ GC và tỷ lệ base khác N của reference trong bin (dùng để chuẩn hóa GC).
+BIN_DTYPE = np.dtype([
+    ("count", "<u4"),
+    ("count_q", "<u4"),
+    ("gc", "<f4"),
+    ("acgt", "<f4"),
+])
+
+
+def bin_label(bin_size):
+    """
+    10000 -> "10kb", 1000000 -> "1mb"
+    """
+    if bin_size % 1000000 == 0:
+        return f"{bin_size // 1000000}mb"
+    if bin_size % 1000 == 0:
+        return f"{bin_size // 1000}kb"
+    return f"{bin_size}bp"
+
+
+def bins_suffix(bin_size):
+    return f".bins{bin_label(bin_size)}.npy"
+
+
+def index_path(bins_path):
+    return bins_path[:-len(".npy")] + ".json"
+
+
+def count_bins(read_starts, length, bin_size):
+    """
+    Đếm số read có vị trí bắt đầu rơi vào mỗi bin.
+    """
+    n_bins = (length + bin_size - 1) // bin_size
+    return np.bincount(np.asarray(read_starts, dtype=np.int64) // bin_size, minlength=n_bins)[:n_bins].astype(np.uint32)
+
+
+def gc_bins(sequence, bin_size):
+    """
+    Tính tỷ lệ GC (trên các base khác N) và tỷ lệ base khác N cho mỗi bin.
+    """
+    bases = np.frombuffer(sequence.upper().encode(), dtype=np.uint8)
+    n_bins = (len(bases) + bin_size - 1) // bin_size
+    edges = np.arange(0, len(bases), bin_size)
+    widths = np.diff(np.append(edges, len(bases)))
+
+    is_gc = (bases == ord("G")) | (bases == ord("C"))
+    is_acgt = is_gc | (bases == ord("A")) | (bases == ord("T"))
+    gc_count = np.add.reduceat(is_gc.astype(np.uint32), edges) if n_bins else np.zeros(0)
+    acgt_count = np.add.reduceat(is_acgt.astype(np.uint32), edges) if n_bins else np.zeros(0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gc = np.where(acgt_count > 0, gc_count / acgt_count, np.nan)
+    return gc.astype(np.float32), (acgt_count / widths).astype(np.float32)
+
+
+def make_bins(read_starts, qual_starts, reference_gc, length, bin_size):
+    """
+    Tạo mảng bin (BIN_DTYPE) cho một chromosome. reference_gc = (gc, acgt) của reference theo bin
+    (gc_bins, đã cache sẵn cho mỗi reference và bin size), None nếu không có reference.
+    """
+    n_bins = (length + bin_size - 1) // bin_size
+    bins = np.zeros(n_bins, dtype=BIN_DTYPE)
+    bins["count"] = count_bins(read_starts, length, bin_size)
+    bins["count_q"] = count_bins(qual_starts, length, bin_size)
+    if reference_gc is not None:
+        bins["gc"], bins["acgt"] = reference_gc
+    else:
+        bins["gc"] = np.nan
+        bins["acgt"] = np.nan
+    return bins
+
+
+def write_binned_depth(bins_path, bin_size, contigs, per_contig_bins):
+    """
+    Ghi các bin của tất cả chromosome vào một file .npy liên tục (mở được bằng mmap),
+    kèm file .json chứa offset của từng chromosome.
+    """
+    offsets = {}
+    offset = 0
+    for contig, _ in contigs:
+        n_bins = len(per_contig_bins[contig])
+        offsets[contig] = [offset, n_bins]
+        offset += n_bins
+
+    data = np.lib.format.open_memmap(bins_path, mode="w+", dtype=BIN_DTYPE, shape=(offset,))
+    for contig, (start, n_bins) in offsets.items():
+        data[start:start + n_bins] = per_contig_bins[contig]
+    data.flush()
+    del data
+
+    with open(index_path(bins_path), "w") as out:
+        json.dump({"bin_size": bin_size, "contigs": offsets}, out)
+
+
+class BinnedDepth:
+    """
+    Đọc nhanh binned depth của một mẫu (memory-mapped, không copy dữ liệu).
+
+        depth = BinnedDepth(binned_depth_path(fq, 100000))
+        counts = depth.counts("chr21")
+    """
+
+    def __init__(self, bins_path):
+        if not os.path.exists(bins_path):
+            raise FileNotFoundError(f"Binned depth file not found: {bins_path}")
+        with open(index_path(bins_path)) as fh:
+            index = json.load(fh)
+        self.path = bins_path
+        self.bin_size = index["bin_size"]
+        self.offsets = index["contigs"]
+        self.data = np.load(bins_path, mmap_mode="r")
+
+    @property
+    def contigs(self):
+        return list(self.offsets)
+
+    def chromosome(self, contig):
+        """
+        Trả về toàn bộ bin (structured array) của một chromosome.
+        """
+        start, n_bins = self.offsets[contig]
+        return self.data[start:start + n_bins]
+
+    def counts(self, contig, field="count"):
+        return self.chromosome(contig)[field]
+
+    def bin_starts(self, contig):
+        _, n_bins = self.offsets[contig]
+        return np.arange(n_bins, dtype=np.int64) * self.bin_size
@@ -0,0 +1,128 @@
+import os
+import json
+import threading
+import subprocess
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from helper.config import PATHS, PARAMETERS, TOOLS
+from helper.path_define import norm_vcf_path, chunks_path
+from helper.logger import setup_logger
+
+logger = setup_logger(os.path.join(PATHS["logs"], "chunk_planner.log"))
+
+CHUNKING = PARAMETERS["glimpse"]["chunking"]
+MEMORY = PARAMETERS["glimpse"]["memory"]
+TIMINGS_PATH = os.path.join(PATHS["logs"], "glimpse_phase_timings.tsv")
+TIMING_COLUMNS = ["chromosome", "chunk_id", "input_region", "n_variants", "panel_samples", "n_targets", "threads", "seconds"]
+
+_timings_lock = threading.Lock()
+
+
+def record_phase_timing(chromosome, chunk_id, input_region, n_variants, n_targets, threads, seconds, panel=None):
+    """
+    Ghi thời gian chạy GLIMPSE2_phase của một chunk để lần chia chunk sau dùng làm dữ liệu cho cost model.
+    """
+    row = [chromosome, chunk_id, input_region, n_variants, panel_sample_count(chromosome, panel), n_targets, threads, f"{seconds:.2f}"]
+    with _timings_lock:
+        new_file = not os.path.exists(TIMINGS_PATH)
+        with open(TIMINGS_PATH, "a") as out:
+            if new_file:
+                out.write("\t".join(TIMING_COLUMNS) + "\n")
+            out.write("\t".join(str(value) for value in row) + "\n")
+
+
+def load_timings():
+    if not os.path.exists(TIMINGS_PATH):
+        return pd.DataFrame(columns=TIMING_COLUMNS)
+    return pd.read_csv(TIMINGS_PATH, sep="\t")
+
+
+@lru_cache(maxsize=None)
+def panel_sample_count(chromosome, panel=None):
+    process = subprocess.run([TOOLS["bcftools"], "query", "-l", norm_vcf_path(chromosome, panel)], capture_output=True, text=True)
+    if process.returncode != 0:
+        logger.error(f"Error reading panel samples for {chromosome}: {process.stderr}")
+        raise RuntimeError(f"Error reading panel samples for {chromosome}: {process.stderr}")
+    return len(process.stdout.split())
+
+
+def work_units(n_variants, panel_samples, n_targets):
+    """
+    Khối lượng tính toán của một chunk: số variant x số mẫu panel (triệu) x số mẫu cần impute.
+    """
+    return np.asarray(n_variants, dtype=np.float64) * panel_samples / 1e6 * n_targets
+
+
+def fit_cost_model(timings=None):
+    """
+    Hồi quy tuyến tính CPU-giây = a * work_units + b từ các lần phase đã ghi lại.
+    Chưa đủ dữ liệu (min_timings) thì dùng hệ số mặc định trong cấu hình.
+    """
+    timings = load_timings() if timings is None else timings
+    default = (CHUNKING["cpu_seconds_per_unit"], CHUNKING["overhead_seconds"])
+    if len(timings) < CHUNKING["min_timings"]:
+        return default
+
+    units = work_units(timings["n_variants"], timings["panel_samples"], timings["n_targets"])
+    if np.ptp(units) == 0:
+        return default
+    cpu_seconds = timings["seconds"].to_numpy(dtype=np.float64) * timings["threads"].to_numpy(dtype=np.float64)
+    design = np.stack([units, np.ones(len(units))], axis=1)
+    (a, b), *_ = np.linalg.lstsq(design, cpu_seconds, rcond=None)
+    if a <= 0:
+        return default
+    return float(a), float(max(b, 0.0))
+
+
+def predicted_seconds(n_variants, chromosome, n_targets=1, threads=None, model=None, panel=None):
+    a, b = model or fit_cost_model()
+    threads = threads or PARAMETERS["glimpse"]["phase_threads"]
+    return (a * work_units(n_variants, panel_sample_count(chromosome, panel), n_targets) + b) / threads
+
+
+def phase_targets():
+    """
+    Số mẫu được phase cùng lúc trong mỗi chunk: glimpse.batch_size khi phase theo batch
+    (chỉ với mode "bam"), ngược lại 1.
+    """
+    glimpse = PARAMETERS["glimpse"]
+    return max(glimpse["batch_size"], 1) if glimpse["mode"] == "bam" else 1
+
+
+def plan_chunk_params(chromosome, n_targets=1, model=None, panel=None):
+    """
+    Chọn số variant của window và buffer cho GLIMPSE2_chunk sao cho mỗi chunk chạy khoảng
+    target_seconds và dùng không quá target_memory_gb.
+    """
+    a, b = model or fit_cost_model()
+    threads = PARAMETERS["glimpse"]["phase_threads"]
+    unit_per_variant = panel_sample_count(chromosome, panel) / 1e6 * n_targets
+
+    by_time = (CHUNKING["target_seconds"] * threads - b) / (a * unit_per_variant)
+    by_memory = (CHUNKING["target_memory_gb"] - MEMORY["base_gb"]) / MEMORY["gb_per_kvariant"] * 1000
+    input_variants = max(min(by_time, by_memory), 0)
+
+    # input region = window + 2 buffer
+    fraction = CHUNKING["buffer_fraction"]
+    window_count = max(int(input_variants / (1 + 2 * fraction)), CHUNKING["min_window_count"])
+    buffer_count = max(int(window_count * fraction), 1)
+    params = {
+        "window_count": window_count,
+        "buffer_count": buffer_count,
+        "window_mb": CHUNKING["window_mb"],
+        "buffer_mb": CHUNKING["buffer_mb"],
+        "model": [a, b],
+        "n_targets": n_targets,
+    }
+    logger.info(f"{chromosome}: chunk plan {params} (limit by time {by_time:.0f}, by memory {by_memory:.0f} variants)")
+    return params
+
+
+def chunk_params_path(chromosome, panel=None):
+    return f"{chunks_path(chromosome, panel)}.params.json"
+
+
+def write_chunk_params(chromosome, params, panel=None):
+    with open(chunk_params_path(chromosome, panel), "w") as out:
+        json.dump(params, out, indent=1)
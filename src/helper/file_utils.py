@@ -1,11 +1,13 @@
 import random
 import subprocess
 import os
+import errno
+import shutil
+import numpy as np
 import pandas as pd
 from cyvcf2 import VCF
 from helper.config import PATHS, TOOLS, PARAMETERS
 from helper.logger import setup_logger
-from helper.converter import convert_genotype
 from statistic.ALT import valid_alt
 
 logger = setup_logger(os.path.join(PATHS["logs"], "file_utils.log"))
@@ -68,6 +70,38 @@ def filter_and_trim_with_seqtk(input_file, output_file, num_reads, max_length=PA
     return output_file
 
 
+def check_free_space(directory, required_bytes):
+    """
+    Kiểm tra thư mục còn đủ dung lượng trống hay không, nếu không thì báo lỗi.
+    """
+    os.makedirs(directory, exist_ok=True)
+    free_bytes = shutil.disk_usage(directory).free
+    if free_bytes < required_bytes:
+        logger.error(f"Not enough free space in {directory}: need {required_bytes / 1e9:.1f} GB, have {free_bytes / 1e9:.1f} GB")
+        raise RuntimeError(f"Not enough free space in {directory}: need {required_bytes / 1e9:.1f} GB, have {free_bytes / 1e9:.1f} GB")
+    logger.info(f"{directory} has {free_bytes / 1e9:.1f} GB free (need {required_bytes / 1e9:.1f} GB).")
+
+
+def move_atomic(src_file, dst_file):
+    """
+    Di chuyển file sang dst_file một cách atomic: file đích chỉ xuất hiện khi đã ghi xong.
+    Nếu khác filesystem (scratch -> shared storage) thì copy sang file tạm cạnh đích rồi rename.
+    """
+    try:
+        os.replace(src_file, dst_file)
+        return dst_file
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    tmp_file = f"{dst_file}.part"
+    shutil.copyfile(src_file, tmp_file)
+    shutil.copystat(src_file, tmp_file)
+    os.replace(tmp_file, dst_file)
+    os.remove(src_file)
+    return dst_file
+
+
 def save_results_to_csv(file_path, df):
     # Save the dataframe to the specified file path
     os.makedirs(os.path.dirname(file_path), exist_ok=True)  # Tạo thư mục nếu chưa tồn tại
@@ -76,52 +110,89 @@ def save_results_to_csv(file_path, df):
     logger.info(f"Saved: {file_path}")
 
 
-def extract_vcf(sample_name, vcf_reference, output_vcf_path):
+# Số record mỗi khối mảng cấp phát trước khi đọc VCF theo cột
+VCF_CHUNK_SIZE = 1 << 18
+# Mã kiểu gen: (a + 1) * 8 + (b + 1) với a <= b trong [-1, 6] (-1 là allele thiếu), giống chuỗi "a/b" của convert_genotype
+GT_STRINGS = np.array([f"{code // 8 - 1}/{code % 8 - 1}" for code in range(64)], dtype=object)
+VCF_COLUMNS = {"positions": np.int64, "contigs": np.int32, "ref": np.int32, "alt": np.int32, "genotypes": np.int8, "af": np.float64}
+
+
+def genotype_code(genotype):
     """
-    Tách mẫu VCF từ file tham chiếu bằng cách sử dụng bcftools.
+    Mã int8 của kiểu gen mẫu đầu tiên (record.genotypes[0] = [a, b, phased]); thiếu allele -> -1.
     """
+    if len(genotype) < 3:
+        first, second = -1, (genotype[0] if genotype else -1)
+    else:
+        first, second = genotype[0], genotype[1]
+    first, second = min(max(first, -1), 6), min(max(second, -1), 6)
+    if first > second:
+        first, second = second, first
+    return (first + 1) * 8 + second + 1
 
-    # Xây dựng lệnh bcftools
-    vcf_command = [
-        TOOLS["bcftools"], "view", vcf_reference,
-        "--samples", sample_name,
-        "-m", "2", "-M", "2",
-        "-Oz", "-o", output_vcf_path,
-        f"--threads={PARAMETERS['threads']}"
-    ]
-
-    try:
-        result = subprocess.run(vcf_command, capture_output=True, text=True)
-        if result.returncode != 0:
-            logger.error(f"Failed to extract VCF: {result.stderr}")
-            raise RuntimeError(f"Failed to extract VCF: {result.stderr}")
-        logger.info(f"VCF file extracted successfully to {output_vcf_path}.")
-    except Exception as e:
-        logger.error(f"Error extracting VCF: {e}")
-        raise
 
-def process_vcf(vcf_path, method_name="Test"):
+def read_vcf_columns(vcf_path, region=None, chunk_size=VCF_CHUNK_SIZE):
+    """
+    Đọc VCF theo cột vào các mảng NumPy cấp phát trước theo khối chunk_size record:
+    positions, mã contig / allele (chỉ số vào contig_table / allele_table), mã kiểu gen int8
+    của mẫu đầu tiên và AF float64 (INFO/AF, -1 nếu không có). region (ví dụ "chr21:1-5000000")
+    chỉ đọc vùng đó qua index của VCF.
+    """
+    contigs, alleles = {}, {}
+    chunks = []
+    chunk = {name: np.empty(chunk_size, dtype=dtype) for name, dtype in VCF_COLUMNS.items()}
+    filled = 0
+
+    vcf_reader = VCF(vcf_path)
+    for record in (vcf_reader(region) if region else vcf_reader):
+        if filled == chunk_size:
+            chunks.append(chunk)
+            chunk = {name: np.empty(chunk_size, dtype=dtype) for name, dtype in VCF_COLUMNS.items()}
+            filled = 0
+
+        af = record.INFO.get("AF")
+        if isinstance(af, tuple):
+            af = af[0]
+        chunk["positions"][filled] = record.POS
+        chunk["contigs"][filled] = contigs.setdefault(record.CHROM, len(contigs))
+        chunk["ref"][filled] = alleles.setdefault(record.REF, len(alleles))
+        chunk["alt"][filled] = alleles.setdefault(record.ALT[0], len(alleles))
+        chunk["genotypes"][filled] = genotype_code(record.genotypes[0])
+        chunk["af"][filled] = -1 if af is None else af
+        filled += 1
+    vcf_reader.close()
+
+    columns = {name: np.concatenate([*(full[name] for full in chunks), chunk[name][:filled]]) for name in VCF_COLUMNS}
+    columns["contig_table"] = np.array(list(contigs), dtype=str)
+    columns["allele_table"] = np.array(list(alleles), dtype=str)
+    return columns
+
+
+def vcf_frame(columns, method_name="Test"):
+    """
+    DataFrame CHROM, POS, REF, ALT, AF_{m}, GT_{m}, {m} từ các cột của read_vcf_columns.
+    """
+    return pd.DataFrame({
+        "CHROM": columns["contig_table"][columns["contigs"]].astype(object),
+        "POS": np.asarray(columns["positions"], dtype=np.int64),
+        "REF": columns["allele_table"][columns["ref"]].astype(object),
+        "ALT": columns["allele_table"][columns["alt"]].astype(object),
+        f"AF_{method_name}": np.asarray(columns["af"], dtype=np.float64),
+        f"GT_{method_name}": GT_STRINGS[columns["genotypes"]],
+        method_name: True,
+    })
+
+
+def process_vcf(vcf_path, method_name="Test", region=None):
     """
     Đọc VCF và trích xuất thông tin cần thiết.
     """
-    variants = []
     try:
         logger.info(f"Processing VCF file: {vcf_path} for method {method_name}")
-        vcf_reader = VCF(vcf_path)
-        for record in vcf_reader:
-            variants.append({
-                "CHROM": record.CHROM,
-                "POS": record.POS,
-                "REF": record.REF,
-                "ALT": record.ALT[0],
-                f"AF_{method_name}": dict(record.INFO).get('AF', -1),
-                f"GT_{method_name}": convert_genotype(record.genotypes[0]),
-                method_name: True
-            })
-
+        df = vcf_frame(read_vcf_columns(vcf_path, region), method_name)
     except Exception as e:
         logger.error(f"Error processing VCF file {vcf_path}: {e}")
         raise
 
     logger.info(f"Finished processing VCF file: {vcf_path}")
-    return pd.DataFrame(variants)
\ No newline at end of file
+    return df
@@ -0,0 +1,169 @@
+import os
+import shutil
+import threading
+from functools import lru_cache
+from helper.config import PATHS, PARAMETERS
+from helper.logger import setup_logger
+
+logger = setup_logger(os.path.join(PATHS["logs"], "lifecycle.log"))
+
+
+def path_size(path):
+    """
+    Dung lượng (bytes) của một file hoặc cả thư mục.
+    """
+    if os.path.isdir(path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for file in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    pass
+        return total
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class ArtifactTracker:
+    """
+    Theo dõi các file trung gian của một mẫu và xóa ngay khi consumer cuối cùng chạy xong.
+
+        tracker.register([sai_file], consumers=["samse"])
+        ...
+        tracker.consumed("samse")   # sai_file bị xóa tại đây
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.artifacts = {}
+        self.sizes = {}
+        self.current_bytes = 0
+        self.peak_bytes = 0
+        self.freed_bytes = 0
+        self.lock = threading.Lock()
+
+    def register(self, paths, consumers):
+        """
+        Ghi nhận các file vừa được tạo và danh sách các bước sẽ đọc chúng.
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        with self.lock:
+            for path in paths:
+                size = path_size(path)
+                self.current_bytes += size - self.sizes.get(path, 0)
+                self.sizes[path] = size
+                self.artifacts.setdefault(path, set()).update(consumers)
+            self.peak_bytes = max(self.peak_bytes, self.current_bytes)
+
+    def consumed(self, consumer):
+        """
+        Đánh dấu consumer đã chạy thành công, xóa các file không còn ai cần.
+        """
+        released = []
+        with self.lock:
+            for path, consumers in list(self.artifacts.items()):
+                consumers.discard(consumer)
+                if not consumers:
+                    released.append(path)
+                    del self.artifacts[path]
+                    size = self.sizes.pop(path, 0)
+                    self.current_bytes -= size
+                    self.freed_bytes += size
+
+        for path in released:
+            remove_path(path)
+            logger.info(f"[{self.name}] Removed {path} (last consumer: {consumer})")
+
+        if released:
+            self.report()
+        return released
+
+    def report(self):
+        logger.info(
+            f"[{self.name}] Intermediate footprint: current {self.current_bytes / 1e9:.2f} GB, "
+            f"peak {self.peak_bytes / 1e9:.2f} GB, freed {self.freed_bytes / 1e9:.2f} GB"
+        )
+        return {"current": self.current_bytes, "peak": self.peak_bytes, "freed": self.freed_bytes}
+
+
+@lru_cache(maxsize=None)
+def genome_size(fai_path=PATHS["ref_fai"]):
+    with open(fai_path) as fh:
+        return sum(int(line.split("\t")[1]) for line in fh if line.strip())
+
+
+def estimated_fastq_bytes(coverage):
+    """
+    Kích thước dự kiến của FASTQ (nén) sinh ở một độ phủ, ước lượng trước khi sinh:
+    coverage x kích thước genome x lifecycle.fastq_bytes_per_base.
+    """
+    return coverage * genome_size() * PARAMETERS["lifecycle"]["fastq_bytes_per_base"]
+
+
+class DiskAdmission:
+    """
+    Chỉ cho phép chạy thêm mẫu mới khi dung lượng trống (trừ phần các mẫu đang chạy
+    còn sẽ ghi thêm) đủ cho dung lượng dự kiến của mẫu đó.
+    """
+
+    def __init__(self, directory, reserve_bytes=0):
+        self.directory = directory
+        self.reserve_bytes = reserve_bytes
+        self.reserved = {}
+        self.peak_ratio = None
+        self.condition = threading.Condition()
+
+    def projected_bytes(self, fq, fastq_bytes=None):
+        """
+        Dung lượng dự kiến = kích thước FASTQ x tỷ lệ peak/FASTQ lớn nhất đã quan sát.
+        Với fastq_bytes (mẫu chưa sinh FASTQ, kích thước ước lượng trước) thì tính thêm cả chính file FASTQ.
+        """
+        ratio = self.peak_ratio if self.peak_ratio is not None else PARAMETERS["scratch"]["size_factor"]
+        if fastq_bytes is not None:
+            return (ratio + 1) * fastq_bytes
+        return ratio * os.path.getsize(fq)
+
+    def pending_bytes(self):
+        """
+        Phần dung lượng các mẫu đã nhận còn sẽ ghi thêm: dung lượng đã ghi (tracker.current_bytes)
+        đã nằm trong dung lượng trống hiện tại nên không trừ lại lần nữa.
+        """
+        return sum(
+            max(projected - (tracker.current_bytes if tracker is not None else 0), 0)
+            for projected, tracker in self.reserved.values()
+        )
+
+    def admit(self, fq, tracker=None, fastq_bytes=None, timeout=60):
+        projected = self.projected_bytes(fq, fastq_bytes)
+        with self.condition:
+            while True:
+                free_bytes = shutil.disk_usage(self.directory).free - self.pending_bytes()
+                if free_bytes - self.reserve_bytes >= projected or not self.reserved:
+                    self.reserved[fq] = (projected, tracker)
+                    logger.info(f"Admitted {fq}: projected {projected / 1e9:.2f} GB, free {free_bytes / 1e9:.2f} GB")
+                    return projected
+                logger.info(f"Waiting for disk space before starting {fq} (need {projected / 1e9:.2f} GB)")
+                self.condition.wait(timeout)
+
+    def release(self, key, tracker=None, fq=None):
+        """
+        Trả chỗ đã giữ cho key (đường dẫn dùng khi admit); fq là FASTQ thật để cập nhật tỷ lệ peak/FASTQ.
+        """
+        fq = fq or key
+        with self.condition:
+            self.reserved.pop(key, None)
+            if tracker is not None and os.path.isfile(fq) and os.path.getsize(fq) > 0:
+                ratio = tracker.peak_bytes / os.path.getsize(fq)
+                self.peak_ratio = ratio if self.peak_ratio is None else max(self.peak_ratio, ratio)
+            self.condition.notify_all()
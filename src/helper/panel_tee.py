@@ -0,0 +1,109 @@
+"""
+Tách luồng VCF (không nén) của một region panel đã normalize thành các file sau trong một lần đọc:
+panel (.vcf.gz), sites VCF (8 cột đầu, .vcf.gz), TSV "CHROM POS REF,ALT" (.tsv.gz), file vị trí
+"CHROM POS" và ba mảng nhị phân cho site index (int32 vị trí, uint8 mã ref/alt, float32 AF).
+Chỉ giữ record có POS trong [start, end], để các region kề nhau không trùng record
+(bcftools view -r trả cả record chồng lên đầu region).
+
+    bcftools view -r chr1:1-20000000 ... | bcftools norm ... | bcftools view ... -Ov \\
+        | python panel_tee.py --start 1 --end 20000000 --bgzip bgzip --panel ... --sites ... --tsv ... --positions ... \\
+            --index-positions ... --index-alleles ... --index-af ...
+
+Chạy như một tiến trình riêng (chỉ dùng thư viện chuẩn), nên mỗi region được xử lý song song thật sự.
+"""
+import sys
+import array
+import argparse
+import subprocess
+
+# Mã 2 bit của base, giống helper.site_index.BASES; byte allele = ref << 2 | alt
+BASE_CODES = {b"A": 0, b"C": 1, b"G": 2, b"T": 3}
+
+
+def bgzip_writer(bgzip, path, threads=1):
+    with open(path, "wb") as out:
+        return subprocess.Popen([bgzip, "-c", "-@", f"{threads}"], stdin=subprocess.PIPE, stdout=out)
+
+
+def site_af(info, genotypes):
+    """
+    AF của site: lấy INFO/AF nếu có, không thì INFO/AC / INFO/AN, không thì đếm allele trong cột GT.
+    """
+    tags = dict(item.split(b"=", 1) for item in info.split(b";") if b"=" in item)
+    if b"AF" in tags:
+        return float(tags[b"AF"].split(b",")[0])
+    if b"AC" in tags and b"AN" in tags and int(tags[b"AN"]) > 0:
+        return int(tags[b"AC"].split(b",")[0]) / int(tags[b"AN"])
+    alt_count = genotypes.count(b"1")
+    total = alt_count + genotypes.count(b"0")
+    return alt_count / total if total else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a normalized panel stream into panel, sites, TSV and positions")
+    parser.add_argument("--start", type=int, required=True)
+    parser.add_argument("--end", type=int, required=True)
+    parser.add_argument("--bgzip", default="bgzip")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--panel", required=True)
+    parser.add_argument("--sites", required=True)
+    parser.add_argument("--tsv", required=True)
+    parser.add_argument("--positions", required=True)
+    parser.add_argument("--index-positions", required=True)
+    parser.add_argument("--index-alleles", required=True)
+    parser.add_argument("--index-af", required=True)
+    args = parser.parse_args()
+
+    panel = bgzip_writer(args.bgzip, args.panel, args.threads)
+    sites = bgzip_writer(args.bgzip, args.sites)
+    tsv = bgzip_writer(args.bgzip, args.tsv)
+    records = 0
+    index_positions = array.array("i")
+    index_alleles = array.array("B")
+    index_af = array.array("f")
+
+    with open(args.positions, "wb") as positions:
+        for line in sys.stdin.buffer:
+            if line.startswith(b"##"):
+                panel.stdin.write(line)
+                sites.stdin.write(line)
+                continue
+            if line.startswith(b"#"):
+                # Dòng #CHROM của sites VCF không có cột FORMAT và cột mẫu (giống bcftools view -G)
+                panel.stdin.write(line)
+                sites.stdin.write(b"\t".join(line.rstrip(b"\n").split(b"\t")[:8]) + b"\n")
+                continue
+
+            fields = line.split(b"\t", 8)
+            position = int(fields[1])
+            if position < args.start or position > args.end:
+                continue
+            panel.stdin.write(line)
+            sites.stdin.write(b"\t".join(fields[:8]).rstrip(b"\n") + b"\n")
+            tsv.stdin.write(fields[0] + b"\t" + fields[1] + b"\t" + fields[3] + b"," + fields[4] + b"\n")
+            positions.write(fields[0] + b"\t" + fields[1] + b"\n")
+            index_positions.append(position)
+            index_alleles.append(BASE_CODES[fields[3]] << 2 | BASE_CODES[fields[4]])
+            # Cột mẫu bắt đầu sau cột FORMAT (chỉ đếm khi FORMAT là GT)
+            sample_columns = fields[8].split(b"\t", 1) if len(fields) > 8 else [b""]
+            genotypes = sample_columns[1] if sample_columns[0] == b"GT" and len(sample_columns) > 1 else b""
+            index_af.append(site_af(fields[7], genotypes))
+            records += 1
+
+    # Mảng little-endian ghi thẳng ra file, site_index nối các region lại thành .npy
+    for values, path in ((index_positions, args.index_positions), (index_alleles, args.index_alleles), (index_af, args.index_af)):
+        if sys.byteorder != "little":
+            values.byteswap()
+        with open(path, "wb") as out:
+            values.tofile(out)
+
+    status = 0
+    for writer in (panel, sites, tsv):
+        writer.stdin.close()
+        status = writer.wait() or status
+    sys.stderr.write(f"{records} records in {args.start}-{args.end}\n")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,9 @@
 import os
-from helper.config import PATHS
-from helper.file_utils import extract_vcf
+import json
+import hashlib
+from functools import lru_cache
+from helper.config import PATHS, PARAMETERS, TRIO_DATA
+from helper.binned_depth import bins_suffix, bin_label
 
 def cram_path(name):
     return os.path.join(PATHS["cram_directory"], f"{name}.final.cram")
@@ -23,10 +26,28 @@ def fastq_nipt_path(child, mother, father, coverage, ff, index):
 def base_dir(fq):
     return os.path.dirname(fq)
 
+def is_nipt(fq):
+    """
+    Mẫu NIPT nằm sâu hơn một cấp (thư mục ff) so với mẫu đơn, xem fastq_nipt_path / fastq_single_path.
+    """
+    return len(os.path.relpath(base_dir(fq), PATHS["result_directory"]).split(os.sep)) == 4
+
 def samid(fq):
     return os.path.basename(fq).replace(".fastq.gz", "")
 
+def cell_id(fq):
+    """
+    Tên duy nhất của một mẫu trong ma trận thí nghiệm (samid trùng nhau giữa các coverage / ff / lần lặp):
+    đường dẫn tương đối của thư mục mẫu so với result_directory, ví dụ "0.1x-HG02016-sample_1".
+    """
+    return os.path.relpath(base_dir(fq), PATHS["result_directory"]).replace(os.sep, "-")
+
 def tmp_outdir(fq):
+    # Nếu có cấu hình scratch (ổ local NVMe/tmpfs) thì file tạm được đặt ở đó,
+    # giữ nguyên cấu trúc thư mục tương đối so với result_directory
+    scratch = PATHS.get("scratch_directory")
+    if scratch:
+        return os.path.join(scratch, os.path.relpath(base_dir(fq), PATHS["result_directory"]), "1tmp_files")
     return os.path.join(base_dir(fq), "1tmp_files")
 
 def batch1_final_outdir(fq):
@@ -35,18 +56,34 @@ def batch1_final_outdir(fq):
 def bamlist_dir(fq):
     return os.path.join(batch1_final_outdir(fq), "bam.list")
 
+def final_alignment_suffix():
+    # BAM cuối cùng có thể lưu dưới dạng CRAM (tham chiếu tới PATHS["ref"])
+    return ".cram" if PARAMETERS["compression"]["final_format"] == "cram" else ".bam"
+
+def alignment_index_suffix(suffix):
+    return f"{suffix}.crai" if suffix == ".cram" else f"{suffix}.bai"
+
+def binned_depth_path(fq, bin_size):
+    return os.path.join(batch1_final_outdir(fq), f"{samid(fq)}.sorted.rmdup.realign.BQSR{bins_suffix(bin_size)}")
+
 def basevar_outdir(fq):
     return os.path.join(base_dir(fq), "basevar_output")
 
 def basevar_vcf(fq, chromosome):
     return os.path.join(basevar_outdir(fq), f"NIPT_basevar_{chromosome}.vcf.gz")
 
+def basevar_manifest_path(fq):
+    return os.path.join(basevar_outdir(fq), "regions.manifest.json")
+
 def vcf_list_path(fq, chromosome):
     return os.path.join(basevar_outdir(fq), f"NIPT_basevar_{chromosome}.vcf.list")
 
 def glimpse_outdir(fq):
     return os.path.join(base_dir(fq), "glimpse_output")
 
+def glimpse_batch_dir(name):
+    return os.path.join(PATHS["result_directory"], "glimpse_batch", name)
+
 def vcf_prefix(chromosome):
     return f"CCDG_14151_B01_GRM_WGS_2020-08-05_{chromosome}.filtered.shapeit2-duohmm-phased"
 
@@ -56,32 +93,101 @@ def get_vcf_path(chromosome):
 def get_tsv_path(chromosome):
     return os.path.join(PATHS["reference_path"], f"{vcf_prefix(chromosome)}.vcf.gz")
 
-def norm_vcf_path(chromosome): 
-    return os.path.join(PATHS["reference_path"], f"{vcf_prefix(chromosome)}.biallelic.snp.maf0.001.vcf.gz")
-
-def filtered_vcf_path(chromosome): 
-    return os.path.join(PATHS["reference_path"], f"{vcf_prefix(chromosome)}.biallelic.snp.maf0.001.sites.vcf.gz")
-
-def filtered_tsv_path(chromosome):
-    return os.path.join(PATHS["reference_path"], f"{vcf_prefix(chromosome)}.biallelic.snp.maf0.001.sites.tsv.gz")
-
-def chunks_path(chromosome):
-    return os.path.join(PATHS["reference_path"], f"{vcf_prefix(chromosome)}.chunks.txt")
+FULL_PANEL = "full"
+# Ngưỡng MAF nằm trong tên file, đổi PARAMETERS["maf"] thì panel được tạo lại dưới tên mới
+MAF_TAG = f"maf{PARAMETERS['maf']}"
+
+def active_panel(panel=None):
+    return panel or PARAMETERS["panel"]["active"]
+
+def population_path():
+    return os.path.join(PATHS["reference_path"], os.path.basename(PARAMETERS["panel"]["population_url"]))
+
+@lru_cache(maxsize=None)
+def panel_fingerprint(panel):
+    """
+    Dấu vân tay của một panel con: định nghĩa tập mẫu (kèm nội dung samples_file và danh sách trio bị loại
+    nếu có) và ngưỡng MAF.
+    Đổi định nghĩa thì đường dẫn đổi theo, panel cũ không bị dùng nhầm.
+    """
+    definition = PARAMETERS["panel"]["subsets"][panel]
+    digest = hashlib.sha1(json.dumps(definition, sort_keys=True).encode())
+    digest.update(f"maf={PARAMETERS['maf']}".encode())
+    if definition.get("samples_file"):
+        with open(definition["samples_file"], "rb") as samples_file:
+            digest.update(samples_file.read())
+    if definition.get("exclude_trios"):
+        digest.update(json.dumps(TRIO_DATA, sort_keys=True).encode())
+    return digest.hexdigest()[:8]
+
+def panel_tag(panel=None):
+    """
+    Phần tên file phân biệt panel con với panel đầy đủ (panel đầy đủ giữ nguyên tên cũ).
+    """
+    panel = active_panel(panel)
+    if panel == FULL_PANEL:
+        return ""
+    return f".{panel}_{panel_fingerprint(panel)}"
+
+def panel_parts_dir(chromosome, panel=None):
+    return os.path.join(PATHS["reference_path"], "panel_parts", f"{vcf_prefix(chromosome)}{panel_tag(panel)}")
+
+def panel_samples_path(panel):
+    return os.path.join(PATHS["reference_path"], f"panel_samples{panel_tag(panel)}.txt")
+
+def norm_vcf_path(chromosome, panel=None):
+    return os.path.join(PATHS["reference_path"], f"{vcf_prefix(chromosome)}{panel_tag(panel)}.biallelic.snp.{MAF_TAG}.vcf.gz")
+
+def filtered_vcf_path(chromosome, panel=None):
+    return os.path.join(PATHS["reference_path"], f"{vcf_prefix(chromosome)}{panel_tag(panel)}.biallelic.snp.{MAF_TAG}.sites.vcf.gz")
+
+def filtered_tsv_path(chromosome, panel=None):
+    return os.path.join(PATHS["reference_path"], f"{vcf_prefix(chromosome)}{panel_tag(panel)}.biallelic.snp.{MAF_TAG}.sites.tsv.gz")
+
+def site_index_dir(chromosome, panel=None):
+    return os.path.join(PATHS["reference_path"], "site_index", f"{vcf_prefix(chromosome)}{panel_tag(panel)}.biallelic.snp.{MAF_TAG}")
+
+def reference_gaps_path(chromosome):
+    return os.path.join(PATHS["reference_path"], f"reference_gaps.{chromosome}.npy")
+
+def reference_gc_path(reference, chromosome, bin_size):
+    return os.path.join(PATHS["reference_path"], "reference_gc", f"{os.path.basename(reference)}.{chromosome}.gc{bin_label(bin_size)}.npy")
+
+def positions_path(chromosome, panel=None):
+    return os.path.join(PATHS["reference_path"], f"{vcf_prefix(chromosome)}{panel_tag(panel)}.biallelic.snp.{MAF_TAG}.sites.pos.txt")
+
+def chunks_path(chromosome, panel=None):
+    return os.path.join(PATHS["reference_path"], f"{vcf_prefix(chromosome)}{panel_tag(panel)}.chunks.txt")
+
+def split_reference_prefix(chromosome, panel=None):
+    return os.path.join(PATHS["reference_path"], "split_reference", f"{vcf_prefix(chromosome)}{panel_tag(panel)}.biallelic.snp.{MAF_TAG}")
+
+def split_reference_bin(chromosome, input_region, prefix=None, panel=None):
+    """
+    Tên file do GLIMPSE2_split_reference tạo ra: {prefix}_{chr}_{IRGstart}_{IRGend}.bin
+    """
+    start, end = input_region.rsplit(":", 1)[1].split("-")
+    return f"{prefix or split_reference_prefix(chromosome, panel)}_{chromosome}_{start}_{end}.bin"
 
 def glimpse_vcf(fq, chromosome):
-    return os.path.join(glimpse_outdir(fq), "imputed_file_merged", f"glimpse.{chromosome}_imputed.vcf.gz")
+    return os.path.join(glimpse_outdir(fq), "imputed_file_merged", f"glimpse.{chromosome}_imputed.bcf")
 
 def get_vcf_ref(chromosome):
     return os.path.join(PATHS["vcf_directory"], f"20201028_CCDG_14151_B01_GRM_WGS_2020-08-05_{chromosome}.recalibrated_variants.vcf.gz")
 
-def ground_truth_vcf(name, chromosome):
-    path = os.path.join(PATHS["vcf_directory"], f"{name}_{chromosome}.vcf.gz")
-    if os.path.exists(path):
-        print(f"Ground truth VCF already exists: {path}")
-        return path
-    
-    extract_vcf(name, get_vcf_ref(chromosome), path)
-    return path
+def ground_truth_path(name, chromosome):
+    return os.path.join(PATHS["vcf_directory"], f"{name}_{chromosome}.vcf.gz")
+
+def truth_cache_dir(vcf_path):
+    """
+    Thư mục cache nhị phân (.npy) của một VCF ground truth: {vcf_directory}/truth_cache/{name}_{chr}
+    """
+    name = os.path.basename(vcf_path)
+    for suffix in (".vcf.gz", ".vcf", ".bcf"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return os.path.join(os.path.dirname(vcf_path), "truth_cache", name)
 
 def statistic_outdir(fq, chromosome="all"):
     if chromosome == "all":
@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import threading
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def region_key(chromosome, start, end):
+    return f"{chromosome}:{start}-{end}"
+
+
+class RegionManifest:
+    """
+    Trạng thái của từng region BaseVar của một mẫu, lưu ở file JSON để lần chạy lại
+    chỉ chạy các region còn thiếu hoặc bị lỗi.
+
+        {
+          "plan": {"chr21": [[start, end, cost], ...]},
+          "regions": {"chr21:1-123456": {"status": "done", "attempts": 1, "error": null, "updated": ...}}
+        }
+
+    Mọi thay đổi được ghi ngay xuống đĩa (ghi file tạm rồi os.replace) dưới một lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {"plan": {}, "regions": {}}
+        if os.path.exists(path):
+            with open(path) as fh:
+                self.data = json.load(fh)
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as out:
+            json.dump(self.data, out, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def plan(self, chromosome):
+        """
+        Kế hoạch region đã lưu của chromosome (None nếu chưa có); chạy lại phải dùng đúng kế hoạch cũ
+        để tái sử dụng các region đã xong.
+        """
+        regions = self.data["plan"].get(chromosome)
+        if regions is None:
+            return None
+        return [tuple(region) for region in regions]
+
+    def set_plan(self, chromosome, regions):
+        with self.lock:
+            self.data["plan"][chromosome] = [list(region) for region in regions]
+            for start, end, _ in regions:
+                self.data["regions"].setdefault(
+                    region_key(chromosome, start, end),
+                    {"status": PENDING, "attempts": 0, "error": None, "updated": None}
+                )
+            self._save()
+
+    def status(self, chromosome, start, end):
+        entry = self.data["regions"].get(region_key(chromosome, start, end))
+        return entry["status"] if entry else PENDING
+
+    def update(self, chromosome, start, end, status, error=None):
+        with self.lock:
+            entry = self.data["regions"].setdefault(
+                region_key(chromosome, start, end),
+                {"status": PENDING, "attempts": 0, "error": None, "updated": None}
+            )
+            if status == RUNNING:
+                entry["attempts"] += 1
+            entry["status"] = status
+            entry["error"] = error
+            entry["updated"] = time.time()
+            self._save()
+
+    def incomplete(self, chromosome):
+        """
+        Các region của chromosome chưa ở trạng thái done.
+        """
+        return [
+            (start, end) for start, end, _ in self.plan(chromosome) or []
+            if self.status(chromosome, start, end) != DONE
+        ]
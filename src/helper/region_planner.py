@@ -0,0 +1,263 @@
+import os
+import gzip
+import struct
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import pysam
+from helper.config import PATHS, PARAMETERS
+from helper.path_define import reference_gaps_path, filtered_tsv_path
+from helper.site_index import has_site_index, load_site_index
+from helper.logger import setup_logger
+
+logger = setup_logger(os.path.join(PATHS["logs"], "region_planner.log"))
+
+REF = PATHS["ref"]
+PLANNER = PARAMETERS["basevar"]["planner"]
+
+# Kích thước cửa sổ của linear index trong BAI (16 kb)
+LINEAR_WINDOW = 1 << 14
+# Pseudo-bin chứa số read mapped/unmapped của mỗi reference trong BAI
+PSEUDO_BIN = 37450
+
+
+@lru_cache(maxsize=8)
+def read_bai(bai_path):
+    """
+    Đọc linear index của file .bai.
+    Trả về danh sách (compressed_offsets, n_mapped) theo thứ tự reference trong header.
+    """
+    with open(bai_path, "rb") as fh:
+        data = fh.read()
+    if data[:4] != b"BAI\x01":
+        raise ValueError(f"Not a BAI file: {bai_path}")
+
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    offset = 8
+    refs = []
+    for _ in range(n_ref):
+        n_bin = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        n_mapped = 0
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, offset)
+            offset += 8
+            if bin_id == PSEUDO_BIN and n_chunk == 2:
+                n_mapped = struct.unpack_from("<Q", data, offset + 16)[0]
+            offset += 16 * n_chunk
+
+        n_intv = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        ioffsets = np.frombuffer(data, dtype="<u8", count=n_intv, offset=offset)
+        offset += 8 * n_intv
+
+        # Cửa sổ chưa có read (offset 0 hoặc -1) lấy theo offset hợp lệ đầu tiên/cửa sổ trước
+        valid = (ioffsets != 0) & (ioffsets != np.iinfo(np.uint64).max)
+        if valid.any():
+            ioffsets = np.where(valid, ioffsets, 0)
+            ioffsets[:np.argmax(valid)] = ioffsets[np.argmax(valid)]
+        else:
+            ioffsets = np.zeros(n_intv, dtype=np.uint64)
+
+        # Virtual offset -> compressed offset
+        refs.append((np.maximum.accumulate(ioffsets >> np.uint64(16)), n_mapped))
+    return refs
+
+
+def bai_window_reads(bam_path, contig, length):
+    """
+    Ước lượng số read trong mỗi cửa sổ 16 kb chỉ từ BAI (không đọc BAM):
+    số byte nén giữa hai offset khác nhau liên tiếp của linear index tỷ lệ với số read.
+    Ở độ phủ thấp một block BGZF phủ nhiều cửa sổ (các cửa sổ có cùng offset), nên số byte
+    được chia đều cho các cửa sổ đó, giống crai_window_reads. Chỉ dùng để ước lượng chi phí.
+    """
+    n_windows = (length + LINEAR_WINDOW - 1) // LINEAR_WINDOW
+    with pysam.AlignmentFile(bam_path) as bam:
+        tid = bam.get_tid(contig)
+    coffsets, n_mapped = read_bai(f"{bam_path}.bai")[tid]
+
+    window_bytes = np.zeros(n_windows, dtype=np.float64)
+    n_indexed = min(len(coffsets), n_windows)
+    if n_indexed:
+        offsets = coffsets[:n_indexed].astype(np.float64)
+        # Các đoạn cửa sổ liên tiếp có cùng offset: [starts[i], ends[i])
+        starts = np.flatnonzero(np.diff(offsets, prepend=-1) != 0)
+        ends = np.append(starts[1:], n_indexed)
+        run_bytes = np.append(np.diff(offsets[starts]), 0.0)
+        # Đoạn cuối không có offset kế tiếp: lấy số byte trung bình mỗi cửa sổ của các đoạn trước
+        if starts[-1] > 0:
+            run_bytes[-1] = (offsets[starts[-1]] - offsets[0]) / starts[-1] * (ends[-1] - starts[-1])
+        window_bytes[:n_indexed] = np.repeat(run_bytes / (ends - starts), ends - starts)
+
+    total_bytes = window_bytes.sum()
+    if total_bytes == 0:
+        # Không tách được theo offset (ví dụ cả contig nằm trong một block): chia đều
+        return np.full(n_windows, n_mapped / max(n_windows, 1), dtype=np.float64)
+    return window_bytes * (n_mapped / total_bytes)
+
+
+def crai_window_reads(cram_path, contig, length, bytes_per_read=PLANNER["cram_bytes_per_read"]):
+    """
+    Ước lượng số read trong mỗi cửa sổ 16 kb từ .crai: kích thước mỗi slice
+    được chia đều cho các cửa sổ mà slice đó phủ.
+    """
+    n_windows = (length + LINEAR_WINDOW - 1) // LINEAR_WINDOW
+    with pysam.AlignmentFile(cram_path, reference_filename=REF) as cram:
+        tid = cram.get_tid(contig)
+
+    window_bytes = np.zeros(n_windows, dtype=np.float64)
+    with gzip.open(f"{cram_path}.crai", "rt") as fh:
+        for line in fh:
+            seq_id, start, span, _, _, slice_size = (int(x) for x in line.split())
+            if seq_id != tid or span <= 0:
+                continue
+            first = max(start - 1, 0) // LINEAR_WINDOW
+            last = min((start - 1 + span) // LINEAR_WINDOW, n_windows - 1)
+            window_bytes[first:last + 1] += slice_size / (last - first + 1)
+    return window_bytes / bytes_per_read
+
+
+def window_reads(bam_path, contig, length):
+    if bam_path.endswith(".cram"):
+        return crai_window_reads(bam_path, contig, length)
+    return bai_window_reads(bam_path, contig, length)
+
+
+def reference_gaps(chromosome, min_gap=PLANNER["min_gap"]):
+    """
+    Các đoạn N liên tiếp (>= min_gap) của reference, dạng mảng (n, 2) [start, end) 0-based.
+    Kết quả được cache cạnh reference panel để các mẫu sau dùng lại.
+    """
+    gaps_path = reference_gaps_path(chromosome)
+    if os.path.exists(gaps_path):
+        return np.load(gaps_path)
+
+    logger.info(f"Scanning reference gaps for {chromosome}")
+    with pysam.FastaFile(REF) as fasta:
+        sequence = fasta.fetch(chromosome)
+    is_n = np.frombuffer(sequence.upper().encode(), dtype=np.uint8) == ord("N")
+    edges = np.diff(np.concatenate(([0], is_n.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    keep = ends - starts >= min_gap
+    gaps = np.stack([starts[keep], ends[keep]], axis=1).astype(np.int64)
+
+    np.save(gaps_path, gaps)
+    return gaps
+
+
+def window_gap_bases(gaps, n_windows):
+    """
+    Số base thuộc gap trong mỗi cửa sổ 16 kb.
+    """
+    gap_bases = np.zeros(n_windows, dtype=np.int64)
+    for start, end in gaps:
+        first = start // LINEAR_WINDOW
+        last = min((end - 1) // LINEAR_WINDOW, n_windows - 1)
+        for window in range(first, last + 1):
+            w_start = window * LINEAR_WINDOW
+            gap_bases[window] += min(end, w_start + LINEAR_WINDOW) - max(start, w_start)
+    return gap_bases
+
+
+def panel_site_positions(chromosome):
+    """
+    Vị trí các site của panel: đọc từ site index (memory-mapped), panel cũ chưa có index thì đọc TSV.
+    """
+    if has_site_index(chromosome):
+        return load_site_index(chromosome).positions
+    tsv_path = filtered_tsv_path(chromosome)
+    if not os.path.exists(tsv_path):
+        return np.zeros(0, dtype=np.int64)
+    return pd.read_csv(tsv_path, sep="\t", header=None, usecols=[1], dtype={1: np.int64})[1].to_numpy()
+
+
+def window_costs(bam_paths, chromosome, length, sites_only=False):
+    """
+    Chi phí dự kiến của BaseVar cho từng cửa sổ 16 kb:
+    cost = cost_per_base * base khác N + cost_per_read * read + cost_per_site * site của panel.
+    Trả về (cost, callable); chỉ cửa sổ toàn N là không cần gọi biến thể. Số read ước lượng từ
+    index chỉ dùng cho chi phí, không dùng để bỏ cửa sổ (ở độ phủ thấp ước lượng theo cửa sổ rất thô).
+    Với sites_only, BaseVar chỉ gọi tại site của panel nên bỏ phần chi phí theo base
+    và cửa sổ không có site nào cũng bị bỏ qua.
+    """
+    n_windows = (length + LINEAR_WINDOW - 1) // LINEAR_WINDOW
+    reads = np.zeros(n_windows, dtype=np.float64)
+    for bam_path in bam_paths:
+        reads += window_reads(bam_path, chromosome, length)
+
+    widths = np.full(n_windows, LINEAR_WINDOW, dtype=np.int64)
+    widths[-1] = length - (n_windows - 1) * LINEAR_WINDOW
+    bases = widths - window_gap_bases(reference_gaps(chromosome), n_windows)
+
+    site_positions = panel_site_positions(chromosome)
+    sites = np.bincount((site_positions - 1) // LINEAR_WINDOW, minlength=n_windows)[:n_windows]
+
+    cost = PLANNER["cost_per_read"] * reads + PLANNER["cost_per_site"] * sites
+    callable_windows = bases > 0
+    if sites_only:
+        callable_windows &= sites > 0
+    else:
+        cost = cost + PLANNER["cost_per_base"] * bases
+    return cost, callable_windows
+
+
+def merge_windows(cost, callable_windows, length, target_cost):
+    """
+    Gộp các cửa sổ liên tiếp thành region có chi phí xấp xỉ target_cost.
+    Region không vượt qua cửa sổ không cần gọi (gap, hoặc không có site của panel khi sites_only).
+    Trả về danh sách (start, end, cost) 1-based, end inclusive.
+    """
+    regions = []
+    region_start = None
+    region_cost = 0.0
+    for window in range(len(cost)):
+        if not callable_windows[window]:
+            if region_start is not None:
+                regions.append((region_start + 1, min(window * LINEAR_WINDOW, length), region_cost))
+                region_start = None
+            continue
+
+        if region_start is None:
+            region_start = window * LINEAR_WINDOW
+            region_cost = 0.0
+        region_cost += cost[window]
+
+        if region_cost >= target_cost:
+            regions.append((region_start + 1, min((window + 1) * LINEAR_WINDOW, length), region_cost))
+            region_start = None
+
+    if region_start is not None:
+        regions.append((region_start + 1, length, region_cost))
+    return regions
+
+
+def load_chromosome_lengths(in_fai, chroms):
+    lengths = {}
+    with open(in_fai) as fh:
+        for line in fh:
+            col = line.strip().split()
+            if col[0] in chroms:
+                lengths[col[0]] = int(col[1])
+    return lengths
+
+
+def plan_regions(bam_paths, chromosomes, target_regions=PLANNER["target_regions"], sites_only=False):
+    """
+    Chia các chromosome thành region cho BaseVar sao cho chi phí mỗi region gần bằng nhau
+    (tính trên toàn genome, nên chrY/chr21 có ít region hơn chr1), bỏ qua region không có gì để gọi.
+    Trả về {chromosome: [(start, end, cost), ...]}.
+    """
+    lengths = load_chromosome_lengths(PATHS["ref_fai"], chromosomes)
+    costs = {chromosome: window_costs(bam_paths, chromosome, lengths[chromosome], sites_only) for chromosome in chromosomes}
+
+    total_cost = sum(cost[callable_windows].sum() for cost, callable_windows in costs.values())
+    target_cost = total_cost / max(target_regions, 1)
+
+    plan = {}
+    for chromosome in chromosomes:
+        cost, callable_windows = costs[chromosome]
+        plan[chromosome] = merge_windows(cost, callable_windows, lengths[chromosome], target_cost)
+        skipped = int((~callable_windows).sum())
+        logger.info(f"{chromosome}: {len(plan[chromosome])} regions, {skipped} non-callable windows skipped")
+    return plan
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import subprocess
+from functools import lru_cache
+from helper.config import PATHS
+from helper.logger import setup_logger
+from helper.bgzf import has_eof
+
+logger = setup_logger(os.path.join(PATHS["logs"], "registry.log"))
+
+REGISTRY_PATH = os.path.join(PATHS["reference_path"], "registry.json")
+# Định dạng nén BGZF: file thiếu block EOF là file bị ghi dở (tải/ghi bị ngắt giữa chừng)
+BGZF_SUFFIXES = (".gz", ".bcf", ".tbi", ".csi")
+QUICK_BYTES = 1 << 20
+
+
+def quick_checksum(path):
+    """
+    Checksum nhanh: kích thước + 1 MB đầu + 1 MB cuối của file. Đủ để phát hiện file bị thay,
+    bị cắt hoặc ghi dở mà không phải đọc lại cả file nhiều GB.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(f"{size}".encode())
+    with open(path, "rb") as fh:
+        digest.update(fh.read(QUICK_BYTES))
+        if size > QUICK_BYTES:
+            fh.seek(max(size - QUICK_BYTES, QUICK_BYTES))
+            digest.update(fh.read())
+    return digest.hexdigest()
+
+
+def full_checksum(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 24), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def tool_version(tool):
+    """
+    Phiên bản của một công cụ: dòng đầu của `tool --version`, nếu không có thì checksum của file
+    chương trình (hoặc script) để vẫn phát hiện được khi công cụ bị thay.
+    """
+    try:
+        process = subprocess.run([tool, "--version"], capture_output=True, text=True, timeout=30)
+        lines = [line.strip() for line in (process.stdout + process.stderr).splitlines() if line.strip()]
+        if process.returncode == 0 and lines:
+            return lines[0]
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    if os.path.exists(tool):
+        return f"sha1:{quick_checksum(tool)}"
+    return "unknown"
+
+
+def integrity_problem(path, entry, full=False):
+    """
+    Lỗi toàn vẹn của một file đã đăng ký (None nếu file còn nguyên như lúc ghi nhận).
+    """
+    if not os.path.exists(path):
+        return "missing"
+    if os.path.getsize(path) != entry["size"]:
+        return f"size changed ({entry['size']} -> {os.path.getsize(path)})"
+    if path.endswith(BGZF_SUFFIXES) and not has_eof(path):
+        return "truncated (no BGZF EOF block)"
+    if quick_checksum(path) != entry["quick"]:
+        return "content changed"
+    if full and entry.get("sha1") and full_checksum(path) != entry["sha1"]:
+        return "content changed (sha1)"
+    return None
+
+
+class ResourceRegistry:
+    """
+    Sổ đăng ký các file dẫn xuất (reference panel, chunk, reference nhị phân, GATK bundle...):
+    mỗi file ghi lại input (kèm checksum nhanh), tham số, phiên bản công cụ và checksum của chính nó.
+
+        {
+          "<output path>": {
+            "inputs": {"<input path>": "<quick checksum>"}, "params": {...}, "tools": {"<tool>": "<version>"},
+            "size": ..., "quick": "...", "sha1": "...", "recorded": ...
+          }
+        }
+
+    File chỉ được coi là dùng được khi đã đăng ký, còn nguyên vẹn và input/tham số/công cụ không đổi;
+    file tồn tại nhưng chưa đăng ký (ví dụ do bước trước bị ngắt) được tạo lại.
+    """
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {}
+        if os.path.exists(path):
+            with open(path) as fh:
+                self.data = json.load(fh)
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as out:
+            json.dump(self.data, out, indent=1)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def describe(inputs=(), params=None, tools=()):
+        return {
+            "inputs": {path: quick_checksum(path) if os.path.exists(path) else None for path in inputs},
+            "params": json.loads(json.dumps(params or {})),
+            "tools": {tool: tool_version(tool) for tool in tools},
+        }
+
+    def stale_reason(self, output, description):
+        entry = self.data.get(output)
+        if entry is None:
+            return "missing" if not os.path.exists(output) else "not registered"
+        problem = integrity_problem(output, entry)
+        if problem:
+            return problem
+        for key in ("inputs", "params", "tools"):
+            if entry[key] != description[key]:
+                return f"{key} changed"
+        return None
+
+    def stale(self, outputs, inputs=(), params=None, tools=()):
+        """
+        Các output cần tạo lại, kèm lý do: {output: reason}. Checksum của input chỉ tính một lần.
+        """
+        description = self.describe(inputs, params, tools)
+        reasons = {}
+        for output in outputs:
+            reason = self.stale_reason(output, description)
+            if reason:
+                reasons[output] = reason
+        return reasons
+
+    def is_fresh(self, outputs, inputs=(), params=None, tools=()):
+        reasons = self.stale(outputs, inputs, params, tools)
+        for output, reason in reasons.items():
+            logger.info(f"Stale resource {output}: {reason}")
+        return not reasons
+
+    def record(self, outputs, inputs=(), params=None, tools=(), full=True):
+        """
+        Đăng ký các output vừa tạo xong (ghi sổ một lần cho cả nhóm).
+        """
+        description = self.describe(inputs, params, tools)
+        entries = {}
+        for output in outputs:
+            entries[output] = {
+                **description,
+                "size": os.path.getsize(output),
+                "quick": quick_checksum(output),
+                "sha1": full_checksum(output) if full else None,
+                "recorded": time.time(),
+            }
+        with self.lock:
+            self.data.update(entries)
+            self._save()
+
+    def verify(self, full=False, expected=()):
+        """
+        Kiểm tra nhanh mọi file đã đăng ký mà không tạo lại gì: file còn nguyên (kích thước, block EOF,
+        checksum nhanh, sha1 nếu full=True), input chưa bị thay và công cụ chưa đổi phiên bản.
+        File trong expected nhưng chưa đăng ký được báo là "missing" hoặc "not registered".
+        Trả về {path: problem}.
+        """
+        problems = {}
+        for output in sorted(set(expected) - set(self.data)):
+            problems[output] = "missing" if not os.path.exists(output) else "not registered"
+        input_checksums = {}
+        for output, entry in sorted(self.data.items()):
+            problem = integrity_problem(output, entry, full)
+            if problem is None:
+                for path, checksum in entry["inputs"].items():
+                    if path not in input_checksums:
+                        input_checksums[path] = quick_checksum(path) if os.path.exists(path) else None
+                    if input_checksums[path] != checksum:
+                        problem = f"input {path} changed"
+                        break
+            if problem is None:
+                for tool, version in entry["tools"].items():
+                    if tool_version(tool) != version:
+                        problem = f"tool {tool} changed ({version} -> {tool_version(tool)})"
+                        break
+            if problem:
+                problems[output] = problem
+        return problems
+
+
+# Sổ đăng ký dùng chung cho toàn bộ tiến trình
+registry = ResourceRegistry()
@@ -0,0 +1,122 @@
+import os
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from helper.path_define import site_index_dir
+
+# Mã 2 bit của base; byte allele của mỗi site = ref << 2 | alt
+BASES = np.array(["A", "C", "G", "T"])
+ARRAYS = {"positions": np.int32, "alleles": np.uint8, "af": np.float32}
+
+
+def site_index_files(chromosome, panel=None):
+    directory = site_index_dir(chromosome, panel)
+    return {name: os.path.join(directory, f"{name}.npy") for name in ARRAYS}
+
+
+def write_site_index(chromosome, parts, panel=None):
+    """
+    Ghi site index của chromosome từ các mảng thô theo region (đã sắp xếp, không trùng nhau):
+    parts = [(positions_file, alleles_file, af_file), ...] do panel_tee tạo ra.
+    Trả về danh sách file .npy đã ghi.
+    """
+    files = site_index_files(chromosome, panel)
+    os.makedirs(site_index_dir(chromosome, panel), exist_ok=True)
+    for (name, dtype), region_files in zip(ARRAYS.items(), zip(*parts)):
+        values = np.concatenate([np.fromfile(path, dtype=np.dtype(dtype).newbyteorder("<")) for path in region_files])
+        tmp_path = f"{files[name]}.part.npy"
+        np.save(tmp_path, values.astype(dtype, copy=False))
+        os.replace(tmp_path, files[name])
+    return list(files.values())
+
+
+class SiteIndex:
+    """
+    Site của reference panel (SNP biallelic sau lọc MAF) của một chromosome, dạng mảng NumPy
+    memory-mapped, để tra cứu vị trí / allele / AF mà không phải parse VCF hay TSV:
+
+        index = load_site_index("chr21")
+        index.positions                 # int32, tăng dần
+        index.lookup(positions)         # chỉ số site (-1 nếu không có trong panel)
+        index.region(start, end)        # slice các site trong [start, end]
+        index.frame(start, end)         # DataFrame CHROM, POS, REF, ALT, AF
+    """
+
+    def __init__(self, chromosome, panel=None):
+        self.chromosome = chromosome
+        files = site_index_files(chromosome, panel)
+        self.positions = np.load(files["positions"], mmap_mode="r")
+        self.alleles = np.load(files["alleles"], mmap_mode="r")
+        self.af = np.load(files["af"], mmap_mode="r")
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def ref(self):
+        return BASES[self.alleles >> 2]
+
+    @property
+    def alt(self):
+        return BASES[self.alleles & 3]
+
+    def lookup(self, positions):
+        """
+        Chỉ số của từng vị trí trong index (tìm nhị phân, vector hóa); -1 nếu không phải site của panel.
+        """
+        positions = np.asarray(positions)
+        index = np.searchsorted(self.positions, positions)
+        found = index < len(self.positions)
+        found[found] = self.positions[index[found]] == positions[found]
+        return np.where(found, index, -1)
+
+    def contains(self, positions):
+        return self.lookup(positions) >= 0
+
+    def af_at(self, positions):
+        """
+        AF của panel tại các vị trí (NaN nếu không phải site của panel).
+        """
+        index = self.lookup(positions)
+        return np.where(index >= 0, self.af[np.maximum(index, 0)], np.float32(np.nan))
+
+    def region(self, start=None, end=None):
+        """
+        slice các site có start <= POS <= end (1-based, end inclusive).
+        """
+        first = 0 if start is None else int(np.searchsorted(self.positions, start, side="left"))
+        last = len(self.positions) if end is None else int(np.searchsorted(self.positions, end, side="right"))
+        return slice(first, last)
+
+    def count(self, start=None, end=None):
+        region = self.region(start, end)
+        return region.stop - region.start
+
+    def window_counts(self, window, n_windows):
+        """
+        Số site trong mỗi cửa sổ window base (cửa sổ thứ i phủ [i * window + 1, (i + 1) * window]).
+        """
+        return np.bincount((self.positions - 1) // window, minlength=n_windows)[:n_windows]
+
+    def frame(self, start=None, end=None):
+        region = self.region(start, end)
+        alleles = self.alleles[region]
+        return pd.DataFrame({
+            "CHROM": self.chromosome,
+            "POS": np.asarray(self.positions[region], dtype=np.int64),
+            "REF": BASES[alleles >> 2],
+            "ALT": BASES[alleles & 3],
+            "AF": np.asarray(self.af[region]),
+        })
+
+
+@lru_cache(maxsize=None)
+def load_site_index(chromosome, panel=None):
+    """
+    SiteIndex dùng chung trong tiến trình (các mảng được map từ đĩa, không nạp hết vào RAM).
+    """
+    return SiteIndex(chromosome, panel)
+
+
+def has_site_index(chromosome, panel=None):
+    return all(os.path.exists(path) for path in site_index_files(chromosome, panel).values())
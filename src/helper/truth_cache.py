@@ -0,0 +1,80 @@
+import os
+import threading
+from collections import defaultdict
+import numpy as np
+from helper.config import PATHS
+from helper.logger import setup_logger
+from helper.path_define import truth_cache_dir
+from helper.file_utils import read_vcf_columns, vcf_frame
+from helper.registry import registry
+
+logger = setup_logger(os.path.join(PATHS["logs"], "truth_cache.log"))
+
+# Đổi khi thay định dạng cache để các cache cũ bị coi là stale
+CACHE_VERSION = 2
+# Mảng cột (dtype lưu trên đĩa) và bảng tra nhỏ (tên contig, chuỗi allele) mà mã ở các mảng trỏ vào
+ARRAYS = {
+    "positions": np.int32,
+    "contigs": np.uint8,
+    "ref": np.int32,
+    "alt": np.int32,
+    "genotypes": np.int8,
+    "af": np.float32,
+}
+TABLES = ("contig_table", "allele_table")
+
+_cache_locks = defaultdict(threading.Lock)
+
+
+def truth_cache_files(vcf_path):
+    directory = truth_cache_dir(vcf_path)
+    return {name: os.path.join(directory, f"{name}.npy") for name in (*ARRAYS, *TABLES)}
+
+
+def truth_cache_resources(vcf_path):
+    return {
+        "outputs": list(truth_cache_files(vcf_path).values()),
+        "inputs": [vcf_path],
+        "params": {"version": CACHE_VERSION},
+    }
+
+
+def write_truth_cache(vcf_path):
+    """
+    Parse VCF ground truth một lần (read_vcf_columns) và ghi các cột ra .npy: vị trí int32,
+    mã contig / allele, mã kiểu gen int8 và AF float32 (chỉ hạ độ chính xác khi ghi cache;
+    process_vcf vẫn trả AF float64). Mỗi mảng ghi ra .part rồi os.replace.
+    """
+    columns = read_vcf_columns(vcf_path)
+    files = truth_cache_files(vcf_path)
+    os.makedirs(truth_cache_dir(vcf_path), exist_ok=True)
+    for name, path in files.items():
+        values = columns[name].astype(ARRAYS[name], copy=False) if name in ARRAYS else columns[name]
+        tmp_path = f"{path}.part.npy"
+        np.save(tmp_path, values)
+        os.replace(tmp_path, path)
+    registry.record(**truth_cache_resources(vcf_path), full=False)
+    logger.info(f"Truth cache written for {vcf_path}: {len(columns['positions'])} records")
+
+
+def ensure_truth_cache(vcf_path):
+    """
+    Tạo (lại) cache nếu chưa có hoặc VCF nguồn đã đổi (theo checksum nhanh trong resource registry).
+    """
+    with _cache_locks[vcf_path]:
+        stale = registry.stale(**truth_cache_resources(vcf_path))
+        if stale:
+            logger.info(f"Building truth cache for {vcf_path}: {next(iter(stale.values()))}")
+            write_truth_cache(vcf_path)
+    return truth_cache_files(vcf_path)
+
+
+def load_truth(vcf_path, method_name="Truth"):
+    """
+    DataFrame ground truth giống process_vcf(vcf_path, method_name) (CHROM, POS, REF, ALT, AF_{m}, GT_{m}, {m}),
+    dựng từ cache nhị phân memory-mapped thay vì parse lại VCF cho mỗi lần so sánh.
+    """
+    files = ensure_truth_cache(vcf_path)
+    columns = {name: np.load(files[name], mmap_mode="r") for name in ARRAYS}
+    columns.update({name: np.load(files[name]) for name in TABLES})
+    return vcf_frame(columns, method_name)
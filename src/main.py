@@ -1,29 +1,121 @@
 from pipeline.generate import generate_single_sample, generate_nipt_sample
 from pipeline.alignment import run_alignment_pipeline
 from pipeline.basevar import run_basevar
-from pipeline.glimpse import run_glimpse
+from pipeline.glimpse import run_glimpse, run_glimpse_batch
 from statistic.statistic import run_statistic
 
-from pipeline.reference_panel_prepare import run_prepare_reference_panel
+from pipeline.reference_panel_prepare import run_prepare_reference_panel, expected_resources
+from pipeline.ground_truth import run_ground_truth, expected_truths
 from helper.config import PARAMETERS, TRIO_DATA, PATHS
 from helper.metrics import get_fastq_coverage
 from helper.logger import setup_logger
 from helper.file_utils import extract_lane1_fq
 from helper.converter import convert_cram_to_fastq
 from helper.path_define import fastq_path, fastq_path_lane1, fastq_path_lane2, cram_path, fastq_single_path, fastq_nipt_path
+from helper.lifecycle import ArtifactTracker, DiskAdmission, estimated_fastq_bytes
+from helper.registry import registry
 import os, sys
-from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 
 logger = setup_logger(os.path.join(PATHS["logs"], "main.log"))
 
+# Chỉ nhận thêm mẫu mới khi ổ chứa file tạm còn đủ chỗ cho dung lượng dự kiến của mẫu
+admission = DiskAdmission(
+    PATHS.get("scratch_directory") or PATHS["result_directory"],
+    reserve_bytes=PARAMETERS["lifecycle"]["reserve_gb"] * 1e9
+)
 
-def pipeline_for_sample(fastq_dir):
-    logger.info(f"Run all pipeline for sample in {fastq_dir}")
-    run_alignment_pipeline(fastq_dir)
-    run_basevar(fastq_dir)
-    run_glimpse(fastq_dir)
-    run_statistic(fastq_dir)
+
+def run_bounded(function, samples, max_workers=PARAMETERS["lifecycle"]["max_parallel_samples"]):
+    """
+    Chạy function cho từng mẫu, tối đa max_workers mẫu cùng lúc; mẫu tiếp theo chỉ được lấy
+    từ samples khi có slot trống. Trả về kết quả theo thứ tự hoàn thành.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = set()
+        for sample in samples:
+            running.add(executor.submit(function, sample))
+            if len(running) >= max_workers:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(running):
+            yield future.result()
+
+def admit_sample(sample):
+    """
+    sample = (thư mục mẫu, coverage, hàm sinh FASTQ). Giữ chỗ đĩa theo kích thước FASTQ ước lượng
+    từ coverage trước khi sinh, nên cả việc sinh FASTQ cũng đi qua DiskAdmission.
+    """
+    sample_dir, coverage, _ = sample
+    tracker = ArtifactTracker(os.path.relpath(sample_dir, PATHS["result_directory"]))
+    admission.admit(sample_dir, tracker, fastq_bytes=estimated_fastq_bytes(coverage))
+    return tracker
+
+def pipeline_for_sample(sample):
+    sample_dir, _, generate = sample
+    tracker = admit_sample(sample)
+    fastq_dir = None
+    try:
+        fastq_dir = generate()
+        logger.info(f"Run all pipeline for sample in {fastq_dir}")
+        run_alignment_pipeline(fastq_dir, tracker)
+        run_basevar(fastq_dir, tracker)
+        run_glimpse(fastq_dir, tracker)
+        run_statistic(fastq_dir)
+    finally:
+        footprint = tracker.report()
+        logger.info(f"Peak intermediate footprint for {sample_dir}: {footprint['peak'] / 1e9:.2f} GB")
+        admission.release(sample_dir, tracker, fastq_dir)
+
+def prepare_sample(sample):
+    """
+    Sinh FASTQ + alignment + BaseVar của một mẫu (phần cần nhiều dung lượng đĩa); GLIMPSE chạy sau theo batch.
+    """
+    sample_dir, _, generate = sample
+    tracker = admit_sample(sample)
+    fastq_dir = None
+    try:
+        fastq_dir = generate()
+        logger.info(f"Run alignment and BaseVar for sample in {fastq_dir}")
+        run_alignment_pipeline(fastq_dir, tracker)
+        run_basevar(fastq_dir, tracker)
+    finally:
+        admission.release(sample_dir, tracker, fastq_dir)
+    return fastq_dir, tracker
+
+def finish_batch(batch):
+    """
+    GLIMPSE cho cả batch (panel của mỗi chunk chỉ nạp một lần), sau đó thống kê từng mẫu.
+    """
+    fastq_dirs = [fastq_dir for fastq_dir, _ in batch]
+    run_glimpse_batch(fastq_dirs, dict(batch))
+    for fastq_dir, tracker in batch:
+        run_statistic(fastq_dir)
+        footprint = tracker.report()
+        logger.info(f"Peak intermediate footprint for {fastq_dir}: {footprint['peak'] / 1e9:.2f} GB")
+
+def run_batched(samples):
+    """
+    Gom các mẫu đã xong BaseVar thành batch glimpse.batch_size mẫu để phase chung
+    (mẫu được sinh dần khi có slot trống, tối đa lifecycle.max_parallel_samples mẫu cùng lúc).
+    """
+    batch_size = PARAMETERS["glimpse"]["batch_size"]
+    with ThreadPoolExecutor(max_workers=1) as batch_executor:
+        batch_futures = []
+        batch = []
+        for prepared in run_bounded(prepare_sample, samples):
+            batch.append(prepared)
+            if len(batch) == batch_size:
+                batch_futures.append(batch_executor.submit(finish_batch, batch))
+                batch = []
+        if batch:
+            batch_futures.append(batch_executor.submit(finish_batch, batch))
+
+        for future in batch_futures:
+            future.result()
 
 def prepare_data(name):
     print(f"Preparing data for {name}")
@@ -37,6 +129,9 @@ def process_trio(trio_name, trio_info):
     """
     logger.info(f"######## PROCESSING TRIO: {trio_name} ########")
 
+    # Ground truth của cả trio: mỗi chromosome chỉ quét call set một lần (bỏ qua nếu đã có)
+    run_ground_truth([trio_name])
+
     child_name = trio_info["child"]
     mother_name = trio_info["mother"]
     father_name = trio_info["father"]
@@ -49,14 +144,43 @@ def process_trio(trio_name, trio_info):
         #child_avg_coverage = future_child.result()
 
 
-    for index in range(PARAMETERS["startSampleIndex"], PARAMETERS["endSampleIndex"] + 1):
-        logger.info(f"######## PROCESSING index {index} ########")
+    def generate_samples():
+        # FASTQ chưa được sinh ở đây: mỗi mẫu là (thư mục, coverage, hàm sinh), worker sinh sau khi được admit
+        for index in range(PARAMETERS["startSampleIndex"], PARAMETERS["endSampleIndex"] + 1):
+            logger.info(f"######## PROCESSING index {index} ########")
+
+            for coverage in PARAMETERS["coverage"]:
+                yield (
+                    fastq_single_path(mother_name, coverage, index), coverage,
+                    partial(generate_single_sample, mother_name, coverage, index)
+                )
 
-        for coverage in PARAMETERS["coverage"]:
-            pipeline_for_sample(generate_single_sample(mother_name, coverage, index))
+                for ff in PARAMETERS["ff"]:
+                    yield (
+                        fastq_nipt_path(child_name, mother_name, father_name, coverage, ff, index), coverage,
+                        partial(generate_nipt_sample, child_name, mother_name, father_name, coverage, ff, index)
+                    )
 
-            for ff in PARAMETERS["ff"]:
-                pipeline_for_sample(generate_nipt_sample(child_name, mother_name, father_name, coverage, ff, index))
+    if PARAMETERS["glimpse"]["batch_size"] > 1:
+        run_batched(generate_samples())
+        return
+
+    for _ in run_bounded(pipeline_for_sample, generate_samples()):
+        pass
+
+
+def verify_resources(full=False):
+    """
+    Kiểm tra nhanh toàn vẹn các file reference đã đăng ký và mọi file mà `prepare` phải tạo ra
+    (không tạo lại gì; file thiếu hoặc chưa đăng ký cũng là lỗi). full=True đọc lại toàn bộ file để so sha1.
+    """
+    expected = expected_resources() + expected_truths()
+    problems = registry.verify(full, expected)
+    for path, problem in problems.items():
+        logger.error(f"{path}: {problem}")
+        print(f"{path}: {problem}")
+    print(f"{len(set(registry.data) | set(expected))} resources checked, {len(problems)} problems")
+    return 1 if problems else 0
 
 
 def main():
@@ -64,6 +188,14 @@ def main():
     if len(sys.argv) < 2:
         logger.error("Please provide a trio name to process.")
         sys.exit(1)
+
+    # python main.py verify [--full] | python main.py prepare
+    if sys.argv[1] == "verify":
+        sys.exit(verify_resources("--full" in sys.argv[2:]))
+    if sys.argv[1] == "prepare":
+        run_prepare_reference_panel()
+        run_ground_truth()
+        return
     
     trio_name = sys.argv[1]  
     if trio_name not in TRIO_DATA:
@@ -2,20 +2,30 @@ import os
 import subprocess
 import shutil
 from helper.config import TOOLS, PATHS, PARAMETERS
-from helper.path_define import samid, tmp_outdir, batch1_final_outdir, bamlist_dir
+from helper.path_define import samid, tmp_outdir, batch1_final_outdir, bamlist_dir, final_alignment_suffix, alignment_index_suffix, is_nipt
+from helper.file_utils import check_free_space, move_atomic
+from helper.lifecycle import ArtifactTracker
 from helper.logger import setup_logger
+from helper.bam_scanner import scan_bam
+from helper.binned_depth import bins_suffix, index_path
 
 # Cấu hình từ JSON
 REF = PATHS["ref"]
 GATK_BUNDLE_DIR = PATHS["gatk_bundle_dir"]
 
+# BAM trung gian chỉ tồn tại vài phút nên ghi ở mức nén thấp (0 = không nén),
+# BAM cuối có thể chuyển sang CRAM
+INTERMEDIATE_LEVEL = PARAMETERS["compression"]["intermediate_level"]
+INTERMEDIATE_FMT = f"bam,level={INTERMEDIATE_LEVEL}"
+
 logger = setup_logger(os.path.join(PATHS["logs"], "alignment_pipeline.log"))
 
 
-def run_bwa_alignment(sample_id, fq, outdir, ref_index_prefix=REF, bwa=TOOLS["bwa"], samtools=TOOLS["samtools"]):
+def run_bwa_alignment(sample_id, fq, outdir, ref_index_prefix=REF, bwa=TOOLS["bwa"], samtools=TOOLS["samtools"], tracker=None):
     """
     Runs a pipeline for alignment and BAM file processing using BWA and Samtools.
     """
+    tracker = tracker or ArtifactTracker(sample_id)
     logger.info(f"Calculating {fq}. We'll save it in {outdir}")
 
     try:
@@ -34,6 +44,7 @@ def run_bwa_alignment(sample_id, fq, outdir, ref_index_prefix=REF, bwa=TOOLS["bw
         print("BWA ALN COMMAND:", " ".join(bwa_aln_cmd))
         with open(sai_file, "w") as sai_out:
             subprocess.run(bwa_aln_cmd, stdout=sai_out, check=True)
+        tracker.register(sai_file, consumers=["samse"])
 
         bwa_samse_cmd = [
             bwa, "samse", "-r",
@@ -41,7 +52,7 @@ def run_bwa_alignment(sample_id, fq, outdir, ref_index_prefix=REF, bwa=TOOLS["bw
             ref_index_prefix, sai_file, fq
         ]
 
-        samtools_view_cmd = [samtools, "view", "-h", "-Sb", "-@", f"{PARAMETERS['threads']}", "-"]
+        samtools_view_cmd = [samtools, "view", "-h", "--output-fmt", INTERMEDIATE_FMT, "-@", f"{PARAMETERS['threads']}", "-"]
 
         # Open the output BAM file for writing
         with open(bam_file, "wb") as bam_out:
@@ -56,21 +67,27 @@ def run_bwa_alignment(sample_id, fq, outdir, ref_index_prefix=REF, bwa=TOOLS["bw
             bwa_process.wait()  # Ensure BWA process completes
 
         logger.info("** BWA done **")
+        tracker.consumed("samse")
+        tracker.register(bam_file, consumers=["sort"])
 
         # Step 2: Sorting BAM
         logger.info("Sorting BAM...")
-        subprocess.run([samtools, "sort", "-@", f"{PARAMETERS['threads']}", "-O", "bam", "-o", sorted_bam, bam_file], check=True)
+        subprocess.run([samtools, "sort", "-@", f"{PARAMETERS['threads']}", "-l", f"{INTERMEDIATE_LEVEL}", "-O", "bam", "-o", sorted_bam, bam_file], check=True)
         logger.info("** BAM sorted done **")
+        tracker.consumed("sort")
+        tracker.register(sorted_bam, consumers=["markdup"])
 
         # Step 3: Removing duplicates
         logger.info("Removing duplicates...")
-        subprocess.run([samtools, "markdup", "-@", f"{PARAMETERS['threads']}", sorted_bam, rmdup_bam], check=True)
+        subprocess.run([samtools, "markdup", "-@", f"{PARAMETERS['threads']}", "--output-fmt", INTERMEDIATE_FMT, sorted_bam, rmdup_bam], check=True)
         logger.info("** rmdup done **")
+        tracker.consumed("markdup")
 
         # Step 4: Indexing BAM
         logger.info("Indexing BAM...")
         subprocess.run([samtools, "index", "-@", f"{PARAMETERS['threads']}", rmdup_bam], check=True)
         logger.info("** index done **")
+        tracker.register([rmdup_bam, f"{rmdup_bam}.bai"], consumers=["RealignerTargetCreator", "IndelRealigner"])
 
         # Step 5: Create finish flag
         with open(finish_flag, "w") as finish_file:
@@ -85,10 +102,11 @@ def run_bwa_alignment(sample_id, fq, outdir, ref_index_prefix=REF, bwa=TOOLS["bw
         logger.error("** [WORKFLOW_ERROR_INFO] bwa_sort_rmdup not done **")
         exit(1)
 
-def run_bwa_realign(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bundle_dir"], gatk=TOOLS["gatk"], java=TOOLS["java"]):
+def run_bwa_realign(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bundle_dir"], gatk=TOOLS["gatk"], java=TOOLS["java"], tracker=None):
     """
     Runs the RealignerTargetCreator step using GATK.
     """
+    tracker = tracker or ArtifactTracker(sample_id)
     logger.info("\nStarting realign pipeline...")
 
     try:
@@ -112,6 +130,8 @@ def run_bwa_realign(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bund
         ]
         subprocess.run(realigner_target_cmd, check=True)
         logger.info("** RealignerTargetCreator done **")
+        tracker.consumed("RealignerTargetCreator")
+        tracker.register(intervals_file, consumers=["IndelRealigner"])
 
         # Create finish flag for RealignerTargetCreator
         with open(realigner_target_finish_flag, "w") as flag:
@@ -131,10 +151,13 @@ def run_bwa_realign(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bund
             "-known", os.path.join(gatk_bundle_dir, "Mills_and_1000G_gold_standard.indels.hg38.vcf.gz"),
             "-known", os.path.join(gatk_bundle_dir, "Homo_sapiens_assembly38.known_indels.vcf.gz"),
             "--targetIntervals", intervals_file,
+            "--bam_compression", f"{INTERMEDIATE_LEVEL}",
             "-o", realigned_bam
         ]
         subprocess.run(indel_realigner_cmd, check=True)
         logger.info("** IndelRealigner done **")
+        tracker.consumed("IndelRealigner")
+        tracker.register(realigned_bam, consumers=["BaseRecalibrator", "PrintReads"])
 
         # Create finish flag for IndelRealigner
         with open(indel_realigner_finish_flag, "w") as flag:
@@ -153,7 +176,7 @@ def run_bwa_realign(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bund
 
     logger.info("Realign pipeline completed successfully.")
 
-def run_bqsr(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bundle_dir"], gatk=TOOLS["gatk"], samtools=TOOLS["samtools"], java=TOOLS["java"]):
+def run_bqsr(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bundle_dir"], gatk=TOOLS["gatk"], samtools=TOOLS["samtools"], java=TOOLS["java"], tracker=None):
     """
     Runs the Base Quality Score Recalibration (BQSR) pipeline using GATK and Samtools.
 
@@ -165,7 +188,9 @@ def run_bqsr(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bundle_dir"
         gatk (str): Path to the GATK executable (default: "gatk").
         samtools (str): Path to the Samtools executable (default: "samtools").
         java (str): Path to the Java executable (default: "java").
+        tracker (ArtifactTracker): Frees intermediates once their last consumer is done.
     """
+    tracker = tracker or ArtifactTracker(sample_id)
     try:
         # Paths to files
         realigned_bam = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.bam")
@@ -180,6 +205,7 @@ def run_bqsr(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bundle_dir"
         logger.info("Indexing realigned BAM...")
         subprocess.run([samtools, "index", "-@", f"{PARAMETERS['threads']}", realigned_bam], check=True)
         logger.info("** Index done **")
+        tracker.register(f"{realigned_bam}.bai", consumers=["BaseRecalibrator", "PrintReads"])
         with open(index_flag, "w") as flag:
             flag.write("Indexing completed successfully.")
 
@@ -201,6 +227,8 @@ def run_bqsr(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bundle_dir"
         ]
         subprocess.run(base_recal_cmd, check=True)
         logger.info("** BaseRecalibrator done **")
+        tracker.consumed("BaseRecalibrator")
+        tracker.register(recal_table, consumers=["PrintReads"])
         with open(recal_flag, "w") as flag:
             flag.write("BaseRecalibrator completed successfully.")
 
@@ -218,8 +246,12 @@ def run_bqsr(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bundle_dir"
             "-I", realigned_bam,
             "-o", bqsr_bam
         ]
+        if final_alignment_suffix() == ".cram":
+            # BAM này sẽ được chuyển sang CRAM ngay sau đó nên không cần nén kỹ
+            print_reads_cmd[-2:-2] = ["--bam_compression", f"{INTERMEDIATE_LEVEL}"]
         subprocess.run(print_reads_cmd, check=True)
         logger.info("** PrintReads done **")
+        tracker.consumed("PrintReads")
         with open(print_reads_flag, "w") as flag:
             flag.write("PrintReads completed successfully.")
 
@@ -245,107 +277,116 @@ def run_bqsr(sample_id, outdir, ref=REF, gatk_bundle_dir=PATHS["gatk_bundle_dir"
 
     logger.info("BQSR pipeline completed successfully.")
 
-def run_bam_stats(sample_id, outdir, samtools=TOOLS["samtools"]):
+def run_cram_conversion(sample_id, outdir, ref=REF, samtools=TOOLS["samtools"], tracker=None):
     """
-    Runs Samtools stats on the BQSR BAM file and generates statistics.
+    Chuyển BQSR BAM sang CRAM (tham chiếu tới ref) cho file kết quả lâu dài.
     """
+    tracker = tracker or ArtifactTracker(sample_id)
     try:
-        # Paths to input and output files
         bqsr_bam = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.bam")
-        bam_stats_file = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.bamstats")
-        bam_stats_flag = os.path.join(outdir, "bamstats.finish")
+        bqsr_cram = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.cram")
+        cram_flag = os.path.join(outdir, "cram.finish")
 
-        # Step: Run Samtools stats
-        logger.info("Running Samtools stats...")
-        with open(bam_stats_file, "w") as stats_out:
-            subprocess.run([samtools, "stats", "-@", f"{PARAMETERS['threads']}", bqsr_bam], stdout=stats_out, check=True)
-        logger.info("** bamstats done **")
+        tracker.register([bqsr_bam, f"{bqsr_bam}.bai"], consumers=["cram"])
 
-        # Create finish flag
-        with open(bam_stats_flag, "w") as flag:
-            flag.write("bamstats completed successfully.")
+        logger.info("Converting BQSR BAM to CRAM...")
+        subprocess.run([samtools, "view", "-C", "-T", ref, "-@", f"{PARAMETERS['threads']}", "-o", bqsr_cram, bqsr_bam], check=True)
+        subprocess.run([samtools, "index", "-@", f"{PARAMETERS['threads']}", bqsr_cram], check=True)
+        logger.info("** CRAM done **")
+        tracker.consumed("cram")
 
-        # Verify the flag
-        if not os.path.exists(bam_stats_flag):
-            raise FileNotFoundError("bamstats did not complete successfully.")
+        with open(cram_flag, "w") as flag:
+            flag.write("CRAM conversion completed successfully.")
 
     except subprocess.CalledProcessError as e:
-        logger.info(f"[WORKFLOW_ERROR_INFO] Command failed: {e.cmd}\nError: {e}")
-        exit(1)
-    except FileNotFoundError as e:
-        logger.info(f"[WORKFLOW_ERROR_INFO] {e}")
+        logger.error(f"[WORKFLOW_ERROR_INFO] Command failed: {e.cmd}\nError: {e}")
         exit(1)
 
-    logger.info("BAM stats pipeline completed successfully.")
-
+    logger.info("CRAM conversion completed successfully.")
 
-def run_bedtools(fq, sample_id, outdir, final_outdir, bedtools=TOOLS["bedtools"], bgzip=TOOLS["bgzip"], tabix=TOOLS["tabix"]):
+def run_bam_scan(sample_id, outdir, nipt=False):
     """
-    Runs Bedtools genome coverage analysis and compresses the output using bgzip.
+    Quét BQSR BAM/CRAM một lần để tạo thống kê, coverage bedgraph (bgzip + tabix) và depth theo chromosome.
+    Thay thế cho `samtools stats` và `bedtools genomecov` (mỗi lệnh đọc lại toàn bộ BAM).
     """
     try:
         # Paths to input and output files
-        bqsr_bam = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.bam")
+        bqsr_bam = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR{final_alignment_suffix()}")
+        bam_stats_file = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.bamstats")
         cvg_bed_gz = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.cvg.bed.gz")
-        finish_flag = os.path.join(outdir, "sorted_rmdup_realign_BQSR_cvg_bed.finish")
-        bam_list_file = bamlist_dir(fq)
+        depth_file = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR.depth.npz")
+        bins_files = {
+            bin_size: os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR{bins_suffix(bin_size)}")
+            for bin_size in PARAMETERS["depth"]["bin_sizes"]
+        }
+        finish_flag = os.path.join(outdir, "bam_scan.finish")
 
-        # Step 1: Bedtools genome coverage
-        logger.info("Running Bedtools genome coverage...")
-        bedtools_cmd = [
-            bedtools, "genomecov", "-ibam", bqsr_bam, "-bga", "-split"
-        ]
-        with open(cvg_bed_gz, "wb") as cvg_out:
-            subprocess.run(bedtools_cmd, stdout=subprocess.PIPE, check=True)
-            subprocess.run([bgzip], stdin=subprocess.PIPE, stdout=cvg_out, check=True)
-        logger.info("** sorted.rmdup.realign.BQSR.cvg.bed.gz done **")
+        # Mẫu NIPT chỉ cần binned depth, không cần bedgraph từng base
+        if nipt and not PARAMETERS["depth"]["nipt_bedgraph"]:
+            cvg_bed_gz = None
 
-        # Step 2: Index the compressed BED file
-        logger.info("Indexing the compressed BED file with Tabix...")
-        subprocess.run([tabix, "-p", "bed", "-@", f"{PARAMETERS['threads']}", cvg_bed_gz], check=True)
+        logger.info("Scanning BQSR BAM for stats and coverage...")
+        scan_bam(bqsr_bam, bam_stats_file, cvg_bed_gz, depth_file, threads=PARAMETERS["threads"], reference=REF, bins_paths=bins_files)
+        logger.info("** bamstats and coverage done **")
 
         # Create finish flag
         with open(finish_flag, "w") as flag:
-            flag.write("Bedtools pipeline completed successfully.")
+            flag.write("BAM scan completed successfully.")
 
         if not os.path.exists(finish_flag):
-            raise FileNotFoundError("Bedtools pipeline did not complete successfully.")
-
-        # Step 3: Move files to the final output directory, generate bam.list 
-        logger.info("Moving final files to the output directory...")
-        for file_suffix in [".bam", ".bam.bai", ".cvg.bed.gz", ".cvg.bed.gz.tbi"]:
-            src_file = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR{file_suffix}")
-            dst_file = os.path.join(final_outdir, os.path.basename(src_file))
-            if os.path.exists(src_file):
-                os.rename(src_file, dst_file)
-                if file_suffix == ".bam":
-                    with open(bam_list_file, "a") as bam_list:
-                        bam_list.write(f"{dst_file}\n")
-
-        # Step 4: Remove the temporary output directory
-        logger.info("Removing temporary output directory...")
-        shutil.rmtree(outdir)
-        logger.info(f"Temporary directory {outdir} deleted.")
+            raise FileNotFoundError("BAM scan did not complete successfully.")
 
-    except subprocess.CalledProcessError as e:
-        logger.error(f"[WORKFLOW_ERROR_INFO] Command failed: {e.cmd}\nError: {e}")
-        exit(1)
-    except FileNotFoundError as e:
-        logger.error(f"[WORKFLOW_ERROR_INFO] {e}")
+    except (OSError, ValueError) as e:
+        logger.error(f"[WORKFLOW_ERROR_INFO] BAM scan failed: {e}")
         exit(1)
 
-    logger.info("Bedtools pipeline completed successfully.")
+    logger.info("BAM scan pipeline completed successfully.")
 
 
-def run_alignment_pipeline(fq):
+def move_final_files(fq, sample_id, outdir, final_outdir):
+    """
+    Di chuyển các file kết quả cuối vào final_outdir, tạo bam.list và xóa thư mục tạm.
+    """
+    bam_list_file = bamlist_dir(fq)
+
+    logger.info("Moving final files to the output directory...")
+    alignment_suffix = final_alignment_suffix()
+    file_suffixes = [alignment_suffix, alignment_index_suffix(alignment_suffix), ".bamstats", ".cvg.bed.gz", ".cvg.bed.gz.tbi", ".depth.npz"]
+    for bin_size in PARAMETERS["depth"]["bin_sizes"]:
+        file_suffixes.append(bins_suffix(bin_size))
+        file_suffixes.append(index_path(bins_suffix(bin_size)))
+
+    for file_suffix in file_suffixes:
+        src_file = os.path.join(outdir, f"{sample_id}.sorted.rmdup.realign.BQSR{file_suffix}")
+        dst_file = os.path.join(final_outdir, os.path.basename(src_file))
+        if os.path.exists(src_file):
+            move_atomic(src_file, dst_file)
+            if file_suffix == alignment_suffix:
+                with open(bam_list_file, "a") as bam_list:
+                    bam_list.write(f"{dst_file}\n")
+
+    logger.info("Removing temporary output directory...")
+    shutil.rmtree(outdir)
+    logger.info(f"Temporary directory {outdir} deleted.")
+
+
+def run_alignment_pipeline(fq, tracker=None):
     """
     Thực hiện pipeline alignment cho một mẫu FASTQ.
     """
+    tracker = tracker or ArtifactTracker(samid(fq))
 
     if os.path.exists(batch1_final_outdir(fq)):
         logger.info(f"Đã có thư mục kết quả alignment cho mẫu {samid(fq)}")
         return
 
+    # Kiểm tra dung lượng trống của thư mục tạm (scratch) trước khi chạy
+    scratch_required = max(
+        PARAMETERS["scratch"]["min_free_gb"] * 1e9,
+        PARAMETERS["scratch"]["size_factor"] * os.path.getsize(fq),
+    )
+    check_free_space(tmp_outdir(fq), scratch_required)
+
     # Tạo các thư mục nếu chưa tồn tại
     os.makedirs(tmp_outdir(fq), exist_ok=True)
     os.makedirs(batch1_final_outdir(fq), exist_ok=True)
@@ -356,23 +397,28 @@ def run_alignment_pipeline(fq):
     logger.info(f"Thư mục kết quả cuối: {batch1_final_outdir(fq)}")
 
     # Step 1: Chạy BWA để căn chỉnh và loại bỏ bản sao (duplicates)
-    run_bwa_alignment(samid(fq), fq, tmp_outdir(fq))
+    run_bwa_alignment(samid(fq), fq, tmp_outdir(fq), tracker=tracker)
     logger.info(f"Hoàn thành BWA alignment. Sample: {samid(fq)}")
 
     # Step 2: Thực hiện realignment
-    run_bwa_realign(samid(fq), tmp_outdir(fq))
+    run_bwa_realign(samid(fq), tmp_outdir(fq), tracker=tracker)
     logger.info(f"Hoàn thành tmp_outdir(fq). Sample: {samid(fq)}")
 
     # Step 3: Recalibrate Base Quality Scores (BQSR)
-    run_bqsr(samid(fq), tmp_outdir(fq))
+    run_bqsr(samid(fq), tmp_outdir(fq), tracker=tracker)
     logger.info(f"Hoàn thành BQSR. Sample: {samid(fq)}")
 
-    # Step 4: Tạo thống kê BAM và coverage
-    run_bam_stats(samid(fq), tmp_outdir(fq))
+    if final_alignment_suffix() == ".cram":
+        run_cram_conversion(samid(fq), tmp_outdir(fq), tracker=tracker)
+        logger.info(f"Hoàn thành chuyển sang CRAM. Sample: {samid(fq)}")
+
+    # Step 4: Tạo thống kê BAM và coverage (một lần đọc BAM duy nhất)
+    run_bam_scan(samid(fq), tmp_outdir(fq), nipt=is_nipt(fq))
     logger.info(f"Hoàn thành thống kê và coverage cho BAM.")
 
     # Step 5: Di chuyển file kết quả cuối cùng vào batch1_final_files
-    run_bedtools(fq, samid(fq), tmp_outdir(fq), batch1_final_outdir(fq))
+    move_final_files(fq, samid(fq), tmp_outdir(fq), batch1_final_outdir(fq))
     logger.info(f"Kết quả đã được lưu tại {batch1_final_outdir(fq)}")
 
+    tracker.report()
     logger.info(f"=== Hoàn thành pipeline alignment cho mẫu {samid(fq)} ===")
@@ -1,9 +1,12 @@
-import subprocess
 import os
 from helper.config import TOOLS, PARAMETERS, PATHS
-from helper.path_define import basevar_outdir, bamlist_dir, vcf_list_path, basevar_vcf
+from helper.path_define import basevar_outdir, bamlist_dir, vcf_list_path, basevar_vcf, positions_path, basevar_manifest_path, samid
 from helper.logger import setup_logger
-from concurrent.futures import ThreadPoolExecutor
+from helper.lifecycle import ArtifactTracker
+from helper.region_planner import plan_regions
+from helper.bgzf import concat_vcfs
+from helper.region_manifest import RegionManifest, RUNNING, DONE, FAILED
+from helper.async_runner import runner, Job
 
 # Thiết lập logger
 logger = setup_logger(os.path.join(PATHS["logs"], "basevar_pipeline.log"))
@@ -11,9 +14,11 @@ logger = setup_logger(os.path.join(PATHS["logs"], "basevar_pipeline.log"))
 
 REF = PATHS["ref"]
 REF_FAI = PATHS["ref_fai"]
-BCFTOOLS = TOOLS["bcftools"]
-TABIX = TOOLS["tabix"]
+SITES_ONLY = PARAMETERS["basevar"]["sites_only"]
+OUTPUT_CVG = PARAMETERS["basevar"]["output_cvg"]
 DELTA = PARAMETERS["basevar"]["delta"]
+RETRIES = PARAMETERS["basevar"]["retries"]
+RETRY_BACKOFF = PARAMETERS["basevar"]["retry_backoff"]
 
 def load_reference_fai(in_fai, chroms=None):
     ref = []
@@ -28,11 +33,9 @@ def load_reference_fai(in_fai, chroms=None):
     return ref
 
 
-def run_basevar_region(fq, chromosome, chr_id, start, end, bamlist_path, outdir):
-    region = f"{chr_id}:{start}-{end}"
-    outfile_prefix = f"{chr_id}_{start}_{end}"
-    logger.info(f"Starting BaseVar for region {region}")
-
+def basevar_region_command(chromosome, start, end, bamlist_path, outdir):
+    region = f"{chromosome}:{start}-{end}"
+    outfile_prefix = f"{chromosome}_{start}_{end}"
     command = [
         TOOLS['basevar'], "basetype",
         "-t", f"{PARAMETERS['threads']}",
@@ -41,90 +44,217 @@ def run_basevar_region(fq, chromosome, chr_id, start, end, bamlist_path, outdir)
         "-r", region,
         "--min-af=0.001",
         "--output-vcf", f"{outdir}/{outfile_prefix}.vcf.gz",
-        "--output-cvg", f"{outdir}/{outfile_prefix}.cvg.tsv.gz",
         "--smart-rerun"
     ]
+    if SITES_ONLY:
+        # Chỉ gọi tại các site SNP biallelic của panel (statistic chỉ đánh giá ở các vị trí này)
+        command += ["--positions", positions_path(chromosome)]
+    if OUTPUT_CVG:
+        command += ["--output-cvg", f"{outdir}/{outfile_prefix}.cvg.tsv.gz"]
+    return command
 
-    log_file = f"{outdir}/{outfile_prefix}.log"
-    with open(log_file, "w") as log:
-        subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, check=True)
-        logger.info(f"Done BaseVar for region {region}")
 
-def run_basevar_step(fq, chromosome):
-    ref_fai = load_reference_fai(REF_FAI, [chromosome])
-    bamlist_path = bamlist_dir(fq)
-    outdir = basevar_outdir(fq)
-    os.makedirs(outdir,exist_ok=True)
+def region_outputs(outdir, chromosome, start, end):
+    outfile_prefix = f"{outdir}/{chromosome}_{start}_{end}"
+    region_files = [f"{outfile_prefix}.vcf.gz", f"{outfile_prefix}.vcf.gz.tbi"]
+    if OUTPUT_CVG:
+        region_files.append(f"{outfile_prefix}.cvg.tsv.gz")
+    return region_files
+
+
+def basevar_region_job(fq, chromosome, start, end, bamlist_path, outdir, tracker, manifest, on_done):
+    """
+    Job BaseVar cho một region: thử lại tối đa RETRIES lần (chờ RETRY_BACKOFF * 2^n giây giữa các lần).
+    Lỗi được ghi vào manifest thay vì hủy các region khác; on_done(chromosome) được gọi khi region
+    chạy xong và trả về job merge của chromosome nếu đây là region cuối cùng.
+    """
+    def on_success(job):
+        manifest.update(chromosome, start, end, DONE)
+        # File của từng region chỉ cần tới khi merge xong chromosome
+        tracker.register(region_outputs(outdir, chromosome, start, end), consumers=[f"merge:{chromosome}"])
+        return on_done(chromosome)
+
+    def on_failure(job, tail):
+        manifest.update(chromosome, start, end, FAILED, error=" | ".join(tail))
+        if job.attempts > RETRIES:
+            logger.error(f"BaseVar region {chromosome}:{start}-{end} failed after {job.attempts} attempts, see {job.log_path}")
 
-    tasks = []
-    for chr_id, reg_start, reg_end in ref_fai:
+    return Job(
+        f"basevar:{samid(fq)}:{chromosome}:{start}-{end}",
+        basevar_region_command(chromosome, start, end, bamlist_path, outdir),
+        resource="basevar",
+        log_path=f"{outdir}/{chromosome}_{start}_{end}.log",
+        retries=RETRIES,
+        backoff=RETRY_BACKOFF,
+        fatal=False,
+        on_start=lambda job: manifest.update(chromosome, start, end, RUNNING),
+        on_success=on_success,
+        on_failure=on_failure,
+    )
+
+def fixed_regions(chromosomes):
+    """
+    Chia mỗi chromosome thành các region cố định độ dài DELTA (cách chia cũ).
+    """
+    plan = {}
+    for chr_id, reg_start, reg_end in load_reference_fai(REF_FAI, chromosomes):
+        plan[chr_id] = []
         for i in range(reg_start - 1, reg_end, DELTA):
-            start = i + 1
             end = min(i + DELTA, reg_end)
-            tasks.append((fq, chromosome, chr_id, start, end, bamlist_path, outdir))
+            plan[chr_id].append((i + 1, end, end - i))
+    return plan
+
+
+def plan_basevar_regions(fq, chromosomes):
+    """
+    Lập kế hoạch region cho BaseVar theo chi phí dự kiến (read từ BAM index, N-gap, site của panel).
+    """
+    if SITES_ONLY:
+        missing = [chromosome for chromosome in chromosomes if not os.path.exists(positions_path(chromosome))]
+        if missing:
+            logger.error(f"Panel positions files missing for {missing}, run reference panel preparation first.")
+            raise RuntimeError(f"Panel positions files missing for {missing}")
 
-    with ThreadPoolExecutor(max_workers=PARAMETERS['threads']) as executor:
-        executor.map(lambda args: run_basevar_region(*args), tasks)
+    if not PARAMETERS["basevar"]["planner"]["enabled"]:
+        return fixed_regions(chromosomes)
 
-    logger.info(f"All BaseVar jobs for {chromosome} are done!")
+    with open(bamlist_dir(fq)) as fh:
+        bam_paths = [line.strip() for line in fh if line.strip()]
+    return plan_regions(bam_paths, chromosomes, sites_only=SITES_ONLY)
 
 
-def create_vcf_list(fq, chromosome):
+def region_vcf(outdir, chromosome, start, end):
+    return os.path.join(outdir, f"{chromosome}_{start}_{end}.vcf.gz")
+
+
+def create_vcf_list(fq, chromosome, regions):
+    """
+    Danh sách VCF của các region theo đúng thứ tự vị trí trên chromosome (theo kế hoạch region).
+    """
     vcf_list = vcf_list_path(fq, chromosome)
     logger.info(f"Creating VCF list for chromosome {chromosome}")
+    vcf_files = [region_vcf(basevar_outdir(fq), chromosome, start, end) for start, end, _ in sorted(regions)]
     with open(vcf_list, "w") as f:
-        for root, _, files in os.walk(basevar_outdir(fq)):
-            for file in files:
-                if file.endswith(".vcf.gz") and f"{chromosome}_" in file:
-                    f.write(os.path.join(root, file) + "\n")
+        for vcf_file in vcf_files:
+            f.write(vcf_file + "\n")
     logger.info(f"VCF list saved at {vcf_list}")
-    return vcf_list
+    return vcf_files
 
-def merge_vcf_files(fq, chromosome):
-    vcf_list_path = create_vcf_list(fq, chromosome)
+def merge_vcf_files(fq, chromosome, regions):
+    """
+    Nối các VCF region (rời nhau, đã sắp xếp) ở mức block BGZF và tạo index trong cùng một lần ghi,
+    thay cho `bcftools concat -a --rm-dups` (cần index đầu vào và sắp xếp lại).
+    """
+    vcf_files = create_vcf_list(fq, chromosome, regions)
     merged_vcf = basevar_vcf(fq, chromosome)
 
-    command = [
-        BCFTOOLS, "concat",
-        "--threads", f"{PARAMETERS['threads']}",
-        "-a", "--rm-dups", "all",
-        "-O", "z",
-        "-o", merged_vcf
-    ] + [line.strip() for line in open(vcf_list_path)]
-
     logger.info(f"Merging VCF files for chromosome {chromosome}")
-    process = subprocess.run(command, capture_output=True, text=True)
-    if process.returncode != 0:
-        logger.error(f"VCF merge failed: {process.stderr}")
-        raise RuntimeError(f"VCF merge failed: {process.stderr}")
-    logger.info(f"Merged VCF file created at {merged_vcf}")
+    # Ghi ra file tạm để một lần merge dở dang không bị coi là kết quả hoàn chỉnh
+    tmp_vcf = f"{merged_vcf}.part"
+    try:
+        concat_vcfs(vcf_files, tmp_vcf)
+        os.replace(f"{tmp_vcf}.tbi", f"{merged_vcf}.tbi")
+        os.replace(tmp_vcf, merged_vcf)
+    except (OSError, ValueError) as e:
+        logger.error(f"VCF merge failed: {e}")
+        raise RuntimeError(f"VCF merge failed: {e}")
+    logger.info(f"Merged and indexed VCF file created at {merged_vcf}")
+    return merged_vcf
+
+
+def merge_chromosome(fq, chromosome, regions, tracker, manifest):
+    """
+    Merge và index kết quả BaseVar của một chromosome ngay khi các region của nó chạy xong.
+    Không merge nếu manifest còn region chưa xong.
+    """
+    incomplete = manifest.incomplete(chromosome)
+    if incomplete:
+        logger.error(f"Refusing to merge {chromosome}: {len(incomplete)} regions not done {incomplete[:5]}")
+        raise RuntimeError(f"Refusing to merge {chromosome}: {len(incomplete)} regions not done")
+
+    merged_vcf = merge_vcf_files(fq, chromosome, regions)
+    tracker.consumed(f"merge:{chromosome}")
+    logger.info(f"Completed processing for chromosome {chromosome}")
     return merged_vcf
 
-def index_vcf_file(vcf_path):
-    command = [TABIX, "-f", "-@", f"{PARAMETERS['threads']}", "-p", "vcf", vcf_path]
 
-    logger.info(f"Indexing VCF file {vcf_path}")
-    process = subprocess.run(command, capture_output=True, text=True)
-    if process.returncode != 0:
-        logger.error(f"VCF indexing failed: {process.stderr}")
-        raise RuntimeError(f"VCF indexing failed: {process.stderr}")
-    logger.info(f"VCF file indexed at {vcf_path}")
+def run_basevar(fq, tracker=None):
+    tracker = tracker or ArtifactTracker(fq)
 
-def run_basevar(fq):
+    chromosomes = []
     for chromosome in PARAMETERS["chrs"]:
         if os.path.exists(basevar_vcf(fq, chromosome)):
             logger.info(f"Đã có kết quả basevar cho mẫu {fq} với {chromosome}.")
-            return
+            continue
+        chromosomes.append(chromosome)
+    if not chromosomes:
+        return
+
+    bamlist_path = bamlist_dir(fq)
+    outdir = basevar_outdir(fq)
+    os.makedirs(outdir, exist_ok=True)
+
+    # Chạy lại dùng đúng kế hoạch region đã lưu, chỉ lập kế hoạch cho chromosome mới
+    manifest = RegionManifest(basevar_manifest_path(fq))
+    unplanned = [chromosome for chromosome in chromosomes if manifest.plan(chromosome) is None]
+    if unplanned:
+        new_plan = plan_basevar_regions(fq, unplanned)
+        for chromosome in unplanned:
+            manifest.set_plan(chromosome, new_plan[chromosome])
+    plan = {chromosome: manifest.plan(chromosome) for chromosome in chromosomes}
 
-        # Step 1: Run BaseVar for the chromosome
-        run_basevar_step(fq, chromosome)
+    # Chỉ chạy region chưa xong (hoặc đã xong nhưng mất file VCF)
+    def needs_run(chromosome, start, end):
+        return manifest.status(chromosome, start, end) != DONE or \
+            not os.path.exists(region_vcf(outdir, chromosome, start, end))
 
-        # Step 2: Merge VCF files for the chromosome
-        merged_vcf = merge_vcf_files(fq, chromosome)
+    # Một hàng đợi chung cho mọi region của mọi chromosome, region tốn kém nhất chạy trước
+    pending = sorted(
+        (
+            (cost, chromosome, start, end)
+            for chromosome in chromosomes for start, end, cost in plan[chromosome]
+            if needs_run(chromosome, start, end)
+        ),
+        reverse=True
+    )
+    remaining = {chromosome: 0 for chromosome in chromosomes}
+    for _, chromosome, _, _ in pending:
+        remaining[chromosome] += 1
+    logger.info(f"Queued {len(pending)} BaseVar regions over {len(chromosomes)} chromosomes for {fq}")
 
-        # Step 3: Index the merged VCF file
-        index_vcf_file(merged_vcf)
+    def merge_job(chromosome):
+        return Job(
+            f"basevar_merge:{samid(fq)}:{chromosome}",
+            function=lambda: merge_chromosome(fq, chromosome, plan[chromosome], tracker, manifest),
+            resource="basevar_merge",
+            fatal=False,
+        )
+
+    def on_region_done(chromosome):
+        remaining[chromosome] -= 1
+        if remaining[chromosome] > 0:
+            return []
+        # Merge + index chromosome này song song với các region còn lại trong hàng đợi
+        logger.info(f"All BaseVar jobs for {chromosome} are done!")
+        return [merge_job(chromosome)]
+
+    jobs = []
+    for chromosome, count in remaining.items():
+        if not plan[chromosome]:
+            logger.warning(f"No callable BaseVar region for {chromosome}, skipping merge.")
+        elif count == 0:
+            # Mọi region đã xong từ lần chạy trước, chỉ còn thiếu bước merge
+            jobs.append(merge_job(chromosome))
+    jobs += [
+        basevar_region_job(fq, chromosome, start, end, bamlist_path, outdir, tracker, manifest, on_region_done)
+        for _, chromosome, start, end in pending
+    ]
 
-        logger.info(f"Completed processing for chromosome {chromosome}")
+    results = runner.run(jobs)
 
+    tracker.report()
+    failed_jobs = [name for name, returncode in results.items() if returncode != 0]
+    if failed_jobs:
+        logger.error(f"{len(failed_jobs)} BaseVar jobs failed for {fq}: {failed_jobs[:10]}")
+        raise RuntimeError(f"{len(failed_jobs)} BaseVar jobs failed for {fq}, rerun to retry only the failed regions")
     logger.info(f"Completed BaseVar pipeline for {fq}")
@@ -1,60 +1,146 @@
 import subprocess
-import os, re
+import os
+import hashlib
 from helper.config import TOOLS, PARAMETERS, PATHS
-from helper.path_define import bamlist_dir, glimpse_outdir
-from helper.path_define import filtered_vcf_path, filtered_tsv_path, chunks_path, norm_vcf_path, glimpse_vcf
+from helper.path_define import bamlist_dir, glimpse_outdir, cell_id, glimpse_batch_dir
+from helper.path_define import filtered_vcf_path, filtered_tsv_path, chunks_path, norm_vcf_path, glimpse_vcf, split_reference_bin
 from helper.logger import setup_logger
+from helper.lifecycle import ArtifactTracker
+from helper.async_runner import runner, Job, JobFailed
+from helper.bgzf import has_eof, concat_vcfs
+from helper.chunk_planner import record_phase_timing
+from helper.region_planner import load_chromosome_lengths
+from helper.site_index import has_site_index, load_site_index
+from concurrent.futures import ThreadPoolExecutor
 
 # Thiết lập logger
 logger = setup_logger(os.path.join(PATHS["logs"], "glimpse_pipeline.log"))
 
 
 BCFTOOLS = TOOLS["bcftools"]
-BGZIP = TOOLS["bgzip"]
 TABIX = TOOLS["tabix"]
 GLIMPSE_PHASE = TOOLS["GLIMPSE_phase"]
 GLIMPSE_LIGATE = TOOLS["GLIMPSE_ligate"]
 REF = PATHS["ref"]
 MAP_PATH = PATHS["map_path"]
-
-def compute_gls(fq, chromosome):
-    glpath = os.path.join(glimpse_outdir(fq), "GL_file")
-    os.makedirs(glpath, exist_ok=True)
-
-    bamlist = bamlist_dir(fq)
-    with open(bamlist, "r") as bam_file:
-        bam_lines = bam_file.readlines()
-
-    for line in bam_lines:
-        line = line.strip()
-        filename = os.path.basename(line)
-        name = filename.split(".")[0]
-
-        output_vcf = os.path.join(glpath, f"{name}.{chromosome}.vcf.gz")
+PHASE_THREADS = PARAMETERS["glimpse"]["phase_threads"]
+MEMORY = PARAMETERS["glimpse"]["memory"]
+MODE = PARAMETERS["glimpse"]["mode"]
+GL_REGION_MB = PARAMETERS["glimpse"]["gl_region_mb"]
+
+def read_bam_list(fq):
+    with open(bamlist_dir(fq), "r") as bam_file:
+        return [line.strip() for line in bam_file if line.strip()]
+
+
+def gl_sample_name(bam_path):
+    return os.path.basename(bam_path).split(".")[0]
+
+
+def gl_regions(chromosome):
+    """
+    Chia chromosome thành các region GL_REGION_MB Mb để tính GL song song; region không có site
+    nào của panel (theo site index) thì bỏ qua.
+    """
+    length = load_chromosome_lengths(PATHS["ref_fai"], [chromosome])[chromosome]
+    step = int(GL_REGION_MB * 1000000)
+    regions = [(start + 1, min(start + step, length)) for start in range(0, length, step)]
+    if has_site_index(chromosome):
+        index = load_site_index(chromosome)
+        regions = [(start, end) for start, end in regions if index.count(start, end) > 0]
+    return regions
+
+
+def sample_gl_jobs(fq, chromosome, bam_path, regions, sample_vcf, tracker):
+    """
+    Các job GL theo region của một mẫu; job cuối cùng xong sẽ sinh job nối các region
+    ở mức block BGZF (kèm index) thành file GL của mẫu.
+    """
+    name = gl_sample_name(bam_path)
+    glpath = os.path.dirname(sample_vcf)
+    region_vcfs = [os.path.join(glpath, f"{name}.{chromosome}_{start}_{end}.vcf.gz") for start, end in regions]
+    remaining = {"count": len(regions)}
+
+    def concat():
+        concat_vcfs(region_vcfs, f"{sample_vcf}.part")
+        os.replace(f"{sample_vcf}.part.tbi", f"{sample_vcf}.tbi")
+        os.replace(f"{sample_vcf}.part", sample_vcf)
+
+    def on_concat(job):
+        tracker.register([sample_vcf, f"{sample_vcf}.tbi"], consumers=[f"merge_gls:{chromosome}"])
+        tracker.consumed(f"concat_gls:{name}:{chromosome}")
+
+    def on_region(region_vcf):
+        def on_success(job):
+            tracker.register([region_vcf], consumers=[f"concat_gls:{name}:{chromosome}"])
+            remaining["count"] -= 1
+            if remaining["count"] > 0:
+                return []
+            return [Job(f"gl_concat:{cell_id(fq)}:{name}:{chromosome}", function=concat, resource="gl", on_success=on_concat)]
+        return on_success
+
+    jobs = []
+    for (start, end), region_vcf in zip(regions, region_vcfs):
         command = [
             BCFTOOLS, "mpileup",
             "-f", REF, "-I", "-E", "-a", "FORMAT/DP",
-            "-T", filtered_vcf_path(chromosome), "-r", chromosome, line, "-Ou"
+            "-T", filtered_vcf_path(chromosome), "-r", f"{chromosome}:{start}-{end}", bam_path, "-Ou"
         ]
         call_command = [
             BCFTOOLS, "call", "-Aim", "-C", "alleles",
-            "-T", filtered_tsv_path(chromosome), "-Oz", "-o", output_vcf
+            "-T", filtered_tsv_path(chromosome), "-Oz", "-o", region_vcf
         ]
+        jobs.append(Job(
+            f"gl:{cell_id(fq)}:{name}:{chromosome}:{start}-{end}",
+            [command, call_command],
+            resource="gl",
+            log_path=f"{region_vcf}.log",
+            on_success=on_region(region_vcf)
+        ))
+    return jobs
+
+
+def compute_gls(fq, chromosome, tracker):
+    """
+    Tính GL (bcftools mpileup | call) song song theo từng region và từng mẫu qua async runner
+    (resource "gl"). Trả về danh sách VCF GL của từng mẫu theo thứ tự trong bam list.
+    """
+    glpath = os.path.join(glimpse_outdir(fq), "GL_file")
+    os.makedirs(glpath, exist_ok=True)
 
-        logger.info(f"Computing GL for sample {name}, chromosome {chromosome}")
-        mpileup_process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        call_process = subprocess.run(call_command, stdin=mpileup_process.stdout, capture_output=True, text=True)
-        mpileup_process.stdout.close()
-
-        if call_process.returncode != 0:
-            logger.error(f"Error in GL computation for sample {name}: {call_process.stderr}")
-            raise RuntimeError(f"Error in GL computation for sample {name}: {call_process.stderr}")
-
-        index_command = [TABIX, "-f", output_vcf]
-        subprocess.run(index_command, check=True)
-
+    regions = gl_regions(chromosome)
+    sample_vcfs = []
+    jobs = []
+    for bam_path in read_bam_list(fq):
+        name = gl_sample_name(bam_path)
+        sample_vcf = os.path.join(glpath, f"{name}.{chromosome}.vcf.gz")
+        sample_vcfs.append(sample_vcf)
+        if os.path.exists(sample_vcf) and os.path.exists(f"{sample_vcf}.tbi"):
+            logger.info(f"GL for sample {name}, chromosome {chromosome} already exists, skipping")
+            tracker.register([sample_vcf, f"{sample_vcf}.tbi"], consumers=[f"merge_gls:{chromosome}"])
+            continue
+
+        logger.info(f"Computing GL for sample {name}, chromosome {chromosome} over {len(regions)} regions")
+        jobs += sample_gl_jobs(fq, chromosome, bam_path, regions, sample_vcf, tracker)
+
+    try:
+        runner.run(jobs)
+    except JobFailed as e:
+        logger.error(f"Error in GL computation for chromosome {chromosome}: {e}")
+        raise RuntimeError(f"Error in GL computation for chromosome {chromosome}: {e}")
+    return sample_vcfs
+
+
+def merge_gls(fq, chromosome, tracker, sample_vcfs):
+    """
+    Gộp GL của các mẫu thành một VCF; chỉ có một mẫu thì dùng luôn file GL của mẫu đó.
+    """
+    if len(sample_vcfs) == 1:
+        logger.info(f"Single sample for chromosome {chromosome}, skipping GL merge")
+        tracker.register([sample_vcfs[0], f"{sample_vcfs[0]}.tbi"], consumers=[f"phase:{chromosome}"])
+        tracker.consumed(f"merge_gls:{chromosome}")
+        return sample_vcfs[0]
 
-def merge_gls(fq, chromosome):
     glpath = os.path.join(glimpse_outdir(fq), "GL_file")
     glmergepath = os.path.join(glimpse_outdir(fq), "GL_file_merged")
     os.makedirs(glmergepath, exist_ok=True)
@@ -63,12 +149,11 @@ def merge_gls(fq, chromosome):
     merged_vcf = os.path.join(glmergepath, f"glimpse.{chromosome}.vcf.gz")
 
     with open(gl_list_path, "w") as gl_list:
-        for file in os.listdir(glpath):
-            if file.endswith(f".{chromosome}.vcf.gz"):
-                gl_list.write(os.path.join(glpath, file) + "\n")
+        for sample_vcf in sample_vcfs:
+            gl_list.write(sample_vcf + "\n")
 
     command = [
-        BCFTOOLS, "merge", "-m", "none", 
+        BCFTOOLS, "merge", "-m", "none",
         "-r", chromosome, "-Oz", "-o", merged_vcf, "-l", gl_list_path
     ]
 
@@ -80,86 +165,217 @@ def merge_gls(fq, chromosome):
 
     index_command = [TABIX, "-f", "-@", f"{PARAMETERS['threads']}", merged_vcf]
     subprocess.run(index_command, check=True)
+    tracker.consumed(f"merge_gls:{chromosome}")
+    tracker.register([merged_vcf, f"{merged_vcf}.tbi"], consumers=[f"phase:{chromosome}"])
 
     logger.info(f"Merged GL file created at {merged_vcf}")
-
-def phase_genome(fq, chromosome):
-    glmergepath = os.path.join(glimpse_outdir(fq), "GL_file_merged")
-    imputed_path = os.path.join(glimpse_outdir(fq), "imputed_file")
-    os.makedirs(imputed_path, exist_ok=True)
-
-    map_file = os.path.join(MAP_PATH, f"{chromosome}.b38.gmap.gz")
-    reference_vcf = norm_vcf_path(chromosome)
-    chunk_file = chunks_path(chromosome)
-    merged_vcf = os.path.join(glmergepath, f"glimpse.{chromosome}.vcf.gz")
-
-    with open(chunk_file, "r") as chunks:
+    return merged_vcf
+
+
+def phase_input(fq, gl_vcf):
+    """
+    Tham số đầu vào của GLIMPSE2_phase: GL đã tính sẵn, hoặc đọc thẳng BAM/CRAM (mode "bam").
+    """
+    if gl_vcf is not None:
+        return ["--input-gl", gl_vcf]
+    args = ["--bam-list", bamlist_dir(fq)]
+    if any(path.endswith(".cram") for path in read_bam_list(fq)):
+        args += ["--fasta", REF]
+    return args
+
+
+def region_length(region):
+    start, end = region.rsplit(":", 1)[1].split("-")
+    return int(end) - int(start) + 1
+
+
+def read_chunks(chromosome, chunk_file=None, panel=None):
+    """
+    Đọc file chunk của GLIMPSE2_chunk: [(chunk_id, input_region, output_region, n_variants), ...]
+    Số variant của panel trong chunk lấy từ cột 7; file chunk cũ không có cột này thì ước lượng
+    theo độ dài input region (~1 variant / 30 bp với panel biallelic SNP MAF > 0.001).
+    """
+    chunks = []
+    with open(chunk_file or chunks_path(chromosome, panel), "r") as chunks:
         for line in chunks:
             fields = line.strip().split()
-            chunk_id = f"{int(fields[0]):02d}"
-            input_region = fields[2]
-            output_region = fields[3]
-            output_vcf = os.path.join(imputed_path, f"glimpse.{chromosome}.{chunk_id}.imputed.vcf")
+            if not fields:
+                continue
+            if len(fields) > 6 and fields[6].isdigit():
+                n_variants = int(fields[6])
+            else:
+                n_variants = region_length(fields[2]) // 30
+            chunks.append((f"{int(fields[0]):02d}", fields[2], fields[3], n_variants))
+    return chunks
+
+
+def chunk_memory_gb(n_variants):
+    """
+    Bộ nhớ dự kiến của GLIMPSE2_phase cho một chunk, tăng tuyến tính theo số variant của panel.
+    """
+    return MEMORY["base_gb"] + MEMORY["gb_per_kvariant"] * n_variants / 1000
+
+
+def chromosome_memory_gb(chromosome):
+    """
+    Bộ nhớ đỉnh dự kiến của một chromosome (chunk lớn nhất) và tổng số variant để sắp xếp thứ tự chạy.
+    """
+    chunks = read_chunks(chromosome)
+    n_variants = [chunk[3] for chunk in chunks]
+    return chunk_memory_gb(max(n_variants, default=0)), sum(n_variants)
+
+
+def chunk_output(imputed_path, chromosome, chunk_id):
+    return os.path.join(imputed_path, f"glimpse.{chromosome}.{chunk_id}.imputed.bcf")
+
+
+def chunk_signature(chromosome, input_region, output_region, panel=None):
+    """
+    Nội dung file .region ghi cạnh BCF của chunk: region và reference panel đã dùng để phase.
+    """
+    return f"{input_region}\t{output_region}\t{norm_vcf_path(chromosome, panel)}\n"
+
+
+def chunk_done(output_vcf, signature):
+    """
+    Chunk đã phase xong theo đúng kế hoạch chunk hiện tại: BCF trọn vẹn (có block EOF), index
+    được tạo sau BCF và file .region khớp signature (file chunk hoặc panel đổi thì chunk cũ
+    trùng chunk id không được tính là xong).
+    """
+    index = f"{output_vcf}.csi"
+    region_file = f"{output_vcf}.region"
+    if not (os.path.exists(output_vcf) and os.path.exists(index) and os.path.exists(region_file)):
+        return False
+    with open(region_file) as fh:
+        if fh.read() != signature:
+            return False
+    return has_eof(output_vcf) and os.path.getmtime(index) >= os.path.getmtime(output_vcf)
+
+
+def phase_genome(workdir, label, chromosome, tracker, input_args, n_targets=1, chunk_file=None, panel=None):
+    """
+    Phase các chunk của chromosome song song (resource "phase", mỗi chunk dùng PHASE_THREADS luồng),
+    bỏ qua chunk đã có kết quả hợp lệ từ lần chạy trước. workdir là glimpse_outdir của mẫu
+    hoặc thư mục của một batch nhiều mẫu. Thời gian của mỗi chunk được ghi lại cho chunk planner.
+    chunk_file khác file chunk chuẩn (dùng khi benchmark) thì luôn đọc panel VCF; panel chọn
+    reference panel (mặc định panel.active).
+    """
+    imputed_path = os.path.join(workdir, "imputed_file")
+    os.makedirs(imputed_path, exist_ok=True)
 
+    map_file = os.path.join(MAP_PATH, f"{chromosome}.b38.gmap.gz")
+    reference_vcf = norm_vcf_path(chromosome, panel)
+
+    jobs = []
+    timings = {}
+    for chunk_id, input_region, output_region, n_variants in read_chunks(chromosome, chunk_file, panel):
+        output_vcf = chunk_output(imputed_path, chromosome, chunk_id)
+        region_file = f"{output_vcf}.region"
+        outputs = [output_vcf, f"{output_vcf}.csi", region_file]
+        signature = chunk_signature(chromosome, input_region, output_region, panel)
+        if chunk_done(output_vcf, signature):
+            logger.info(f"Chunk {chunk_id} of {chromosome} already phased, skipping")
+            tracker.register(outputs, consumers=[f"ligate:{chromosome}"])
+            continue
+        # Kết quả cũ (nếu có) thuộc kế hoạch chunk khác hoặc chưa xong: bỏ signature trước khi chạy lại
+        if os.path.exists(region_file):
+            os.remove(region_file)
+
+        reference_bin = split_reference_bin(chromosome, input_region, panel=panel)
+        if chunk_file is None and os.path.exists(reference_bin):
+            # Panel đã được tách sẵn (kèm map và region) khi chuẩn bị reference panel
+            command = [
+                GLIMPSE_PHASE,
+                *input_args,
+                "--reference", reference_bin,
+                "--threads", f"{PHASE_THREADS}",
+                "--output", output_vcf
+            ]
+        else:
             command = [
                 GLIMPSE_PHASE,
-                "--input-gl", merged_vcf,
+                *input_args,
                 "--reference", reference_vcf,
                 "--map", map_file,
                 "--input-region", input_region,
                 "--output-region", output_region,
+                "--threads", f"{PHASE_THREADS}",
                 "--output", output_vcf
             ]
 
-            logger.info(f"Phasing chromosome {chromosome}, chunk {chunk_id}")
-            process = subprocess.run(command, capture_output=True, text=True)
-            if process.returncode != 0:
-                logger.error(f"Error phasing chromosome {chromosome}, chunk {chunk_id}: {process.stderr}")
-                raise RuntimeError(f"Error phasing chromosome {chromosome}, chunk {chunk_id}: {process.stderr}")
-
-            bgzip_command = [BGZIP, output_vcf]
-            tabix_command = [TABIX, "-f", "-@", f"{PARAMETERS['threads']}", f"{output_vcf}.gz"]
-
-            subprocess.run(bgzip_command, check=True)
-            subprocess.run(tabix_command, check=True)
-
-def extract_chunk_id(fq, chromosome):
-    imputed_path = os.path.join(glimpse_outdir(fq), "imputed_file")
-    merged_path = os.path.join(glimpse_outdir(fq), "imputed_file_merged")
+        def index_job(job, chunk_id=chunk_id, input_region=input_region, n_variants=n_variants, output_vcf=output_vcf, outputs=outputs, signature=signature):
+            timings[chunk_id] = job.elapsed
+            record_phase_timing(chromosome, chunk_id, input_region, n_variants, n_targets, PHASE_THREADS, job.elapsed, panel)
+
+            def indexed(job):
+                with open(f"{output_vcf}.region", "w") as out:
+                    out.write(signature)
+                tracker.register(outputs, consumers=[f"ligate:{chromosome}"])
+
+            return [Job(
+                f"phase_index:{label}:{chromosome}:{chunk_id}",
+                [BCFTOOLS, "index", "-f", output_vcf],
+                resource="phase",
+                on_success=indexed
+            )]
+
+        jobs.append(Job(
+            f"phase:{label}:{chromosome}:{chunk_id}",
+            command,
+            resource="phase",
+            memory=chunk_memory_gb(n_variants),
+            log_path=os.path.join(imputed_path, f"glimpse.{chromosome}.{chunk_id}.log"),
+            on_success=index_job
+        ))
+
+    logger.info(f"Phasing chromosome {chromosome} for {label}: {len(jobs)} chunks to run")
+    try:
+        runner.run(jobs)
+    except JobFailed as e:
+        logger.error(f"Error phasing chromosome {chromosome}: {e}")
+        raise RuntimeError(f"Error phasing chromosome {chromosome}: {e}")
+
+    tracker.consumed(f"phase:{chromosome}")
+    return timings
+
+def extract_chunk_id(workdir, chromosome, chunk_file=None, panel=None):
+    """
+    Ghi danh sách VCF của các chunk theo thứ tự trong file chunk; chỉ ligate khi mọi chunk đã xong.
+    """
+    imputed_path = os.path.join(workdir, "imputed_file")
+    merged_path = os.path.join(workdir, "imputed_file_merged")
     os.makedirs(merged_path, exist_ok=True)
 
     imputed_list = os.path.join(imputed_path, f"glimpse.{chromosome}_imputed_list.txt")
+    chunks = read_chunks(chromosome, chunk_file, panel)
+    files = [chunk_output(imputed_path, chromosome, chunk_id) for chunk_id, _, _, _ in chunks]
 
-    # Hàm trích xuất chunk_id từ tên file
-    def get_chunk_id(filename):
-        match = re.search(rf"glimpse\.{chromosome}\.(\d+)\.imputed\.vcf\.gz", filename)
-        return int(match.group(1)) if match else float('inf')
-
-    # Lấy danh sách file phù hợp
-    files = [
-        file for file in os.listdir(imputed_path)
-        if file.startswith(f"glimpse.{chromosome}.") and file.endswith(".imputed.vcf.gz")
+    missing = [
+        file for file, (_, input_region, output_region, _) in zip(files, chunks)
+        if not chunk_done(file, chunk_signature(chromosome, input_region, output_region, panel))
     ]
+    if missing:
+        logger.error(f"Cannot ligate {chromosome}: {len(missing)} chunks not phased {missing[:5]}")
+        raise RuntimeError(f"Cannot ligate {chromosome}: {len(missing)} chunks not phased")
 
-    # Sắp xếp file theo chunk_id tăng dần
-    sorted_files = sorted(files, key=get_chunk_id)
-
-    # Ghi danh sách file đã sắp xếp vào imputed_list
     with open(imputed_list, "w") as imp_list:
-        for file in sorted_files:
-            imp_list.write(os.path.join(imputed_path, file) + "\n")
+        for file in files:
+            imp_list.write(file + "\n")
 
 
-def ligate_genome(fq, chromosome):
-    imputed_path = os.path.join(glimpse_outdir(fq), "imputed_file")
-    merged_path = os.path.join(glimpse_outdir(fq), "imputed_file_merged")
+def ligate_genome(workdir, chromosome, tracker):
+    imputed_path = os.path.join(workdir, "imputed_file")
+    merged_path = os.path.join(workdir, "imputed_file_merged")
     os.makedirs(merged_path, exist_ok=True)
 
     imputed_list = os.path.join(imputed_path, f"glimpse.{chromosome}_imputed_list.txt")
-    output_vcf = os.path.join(merged_path, f"glimpse.{chromosome}_imputed.vcf")
+    output_vcf = os.path.join(merged_path, f"glimpse.{chromosome}_imputed.bcf")
+    # Ghi ra file tạm (GLIMPSE2_ligate chọn định dạng theo đuôi .bcf), index xong mới đổi tên,
+    # để lần chạy bị ngắt không để lại BCF dở dang ở đường dẫn cuối cùng
+    tmp_vcf = os.path.join(merged_path, f"glimpse.{chromosome}_imputed.part.bcf")
 
     command = [
-        GLIMPSE_LIGATE, "--input", imputed_list, "--output", output_vcf
+        GLIMPSE_LIGATE, "--input", imputed_list, "--output", tmp_vcf
     ]
 
     logger.info(f"Ligating genome for chromosome {chromosome}")
@@ -168,31 +384,184 @@ def ligate_genome(fq, chromosome):
         logger.error(f"Error ligating chromosome {chromosome}: {process.stderr}")
         raise RuntimeError(f"Error ligating chromosome {chromosome}: {process.stderr}")
 
-    bgzip_command = [BGZIP, output_vcf]
-    tabix_command = [TABIX, "-f", "-@", f"{PARAMETERS['threads']}", f"{output_vcf}.gz"]
+    # GLIMPSE2_ligate ghi thẳng BCF, chỉ cần tạo index
+    index_command = [BCFTOOLS, "index", "-f", "--threads", f"{PARAMETERS['threads']}", tmp_vcf]
+    subprocess.run(index_command, check=True)
+    os.replace(f"{tmp_vcf}.csi", f"{output_vcf}.csi")
+    os.replace(tmp_vcf, output_vcf)
+    tracker.consumed(f"ligate:{chromosome}")
+    return output_vcf
+
+def run_chromosome(fq, chromosome, tracker):
+    logger.info(f"Starting pipeline for chromosome {chromosome}...")
+    workdir = glimpse_outdir(fq)
+
+    if MODE == "bam":
+        # GLIMPSE2_phase tự tính likelihood từ BAM/CRAM tại các site của panel
+        phase_genome(workdir, cell_id(fq), chromosome, tracker, phase_input(fq, None))
+    else:
+        # Step 1: Compute GLs
+        sample_vcfs = compute_gls(fq, chromosome, tracker)
 
-    subprocess.run(bgzip_command, check=True)
-    subprocess.run(tabix_command, check=True)
+        # Step 2: Merge GLs
+        gl_vcf = merge_gls(fq, chromosome, tracker, sample_vcfs)
 
-def run_glimpse(fq):
-    for chromosome in PARAMETERS["chrs"]:
-        if os.path.exists(glimpse_vcf(fq, chromosome)):
-            logger.info(f"Đã có kết quả glimpse cho mẫu {fq} với {chromosome}")
-            return
+        # Step 3: Phase genome
+        phase_genome(workdir, cell_id(fq), chromosome, tracker, phase_input(fq, gl_vcf), n_targets=len(sample_vcfs))
 
-        logger.info(f"Starting pipeline for chromosome {chromosome}...")
+    # Step 4: Ligate genome
+    extract_chunk_id(workdir, chromosome)
+    ligate_genome(workdir, chromosome, tracker)
 
-        # Step 1: Compute GLs
-        compute_gls(fq, chromosome)
+    logger.info(f"Pipeline completed for chromosome {chromosome}.")
 
-        # Step 2: Merge GLs
-        merge_gls(fq, chromosome)
 
-        # Step 3: Phase genome
-        phase_genome(fq, chromosome)
+def run_chromosomes(label, chromosomes, run_one):
+    """
+    Chạy các chromosome đồng thời. Bộ nhớ được giới hạn ở mức chunk (runner.memory_gb, theo số
+    variant của từng chunk); chromosome nhiều variant được đưa vào trước để chunk của các
+    chromosome ngắn lấp chỗ trống còn lại về sau.
+    """
+    estimates = {chromosome: chromosome_memory_gb(chromosome) for chromosome in chromosomes}
+    chromosomes = sorted(chromosomes, key=lambda chromosome: estimates[chromosome][1], reverse=True)
+    for chromosome in chromosomes:
+        logger.info(f"{chromosome}: peak phase memory ~{estimates[chromosome][0]:.1f} GB, {estimates[chromosome][1]} panel variants")
+
+    with ThreadPoolExecutor(max_workers=len(chromosomes)) as executor:
+        futures = {executor.submit(run_one, chromosome): chromosome for chromosome in chromosomes}
+
+    failed = []
+    for future, chromosome in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            logger.error(f"GLIMPSE failed for {chromosome}: {e}")
+            failed.append(chromosome)
+    if failed:
+        raise RuntimeError(f"GLIMPSE failed for {label} on {failed}")
+
 
-        # Step 4: Ligate genome
-        extract_chunk_id(fq, chromosome)
-        ligate_genome(fq, chromosome)
+def imputed_done(output_vcf):
+    """
+    Kết quả GLIMPSE cuối cùng của một chromosome dùng được: BCF trọn vẹn (có block EOF) và có index.
+    """
+    return os.path.exists(output_vcf) and os.path.exists(f"{output_vcf}.csi") and has_eof(output_vcf)
 
-        logger.info(f"Pipeline completed for chromosome {chromosome}.")
+
+def run_glimpse(fq, tracker=None):
+    tracker = tracker or ArtifactTracker(fq)
+
+    chromosomes = []
+    for chromosome in PARAMETERS["chrs"]:
+        if imputed_done(glimpse_vcf(fq, chromosome)):
+            logger.info(f"Đã có kết quả glimpse cho mẫu {fq} với {chromosome}")
+            continue
+        chromosomes.append(chromosome)
+    if not chromosomes:
+        return
+
+    run_chromosomes(fq, chromosomes, lambda chromosome: run_chromosome(fq, chromosome, tracker))
+
+
+def batch_name(fqs):
+    """
+    Tên batch cố định theo tập mẫu (đường dẫn FASTQ đầy đủ, không trùng giữa các coverage / ff / lần lặp),
+    để chạy lại dùng lại được các chunk đã phase.
+    """
+    digest = hashlib.sha1("\n".join(sorted(os.path.abspath(fq) for fq in fqs)).encode()).hexdigest()[:12]
+    return f"batch_{digest}"
+
+
+def write_batch_bam_list(workdir, fqs):
+    """
+    bam list của batch: mỗi dòng "đường dẫn BAM/CRAM<TAB>tên mẫu", tên mẫu là cell_id (duy nhất
+    trong batch, khác với samid) để tách lại kết quả sau khi phase.
+    """
+    bam_list = os.path.join(workdir, "bam.list")
+    has_cram = False
+    with open(bam_list, "w") as out:
+        for fq in fqs:
+            for bam_path in read_bam_list(fq):
+                has_cram = has_cram or bam_path.endswith(".cram")
+                out.write(f"{bam_path}\t{cell_id(fq)}\n")
+    args = ["--bam-list", bam_list]
+    if has_cram:
+        args += ["--fasta", REF]
+    return args
+
+
+def split_batch(batch_vcf, fqs, chromosome, name):
+    """
+    Tách kết quả ligate của batch thành BCF của từng mẫu (đường dẫn glimpse_vcf mà statistic đọc),
+    tính lại INFO/AF theo riêng mẫu đó.
+    """
+    jobs = []
+    for fq in fqs:
+        output_vcf = glimpse_vcf(fq, chromosome)
+        if imputed_done(output_vcf):
+            continue
+        os.makedirs(os.path.dirname(output_vcf), exist_ok=True)
+        tmp_vcf = f"{output_vcf}.part"
+
+        def finalize(job, fq=fq, output_vcf=output_vcf, tmp_vcf=tmp_vcf):
+            def rename(job):
+                os.replace(f"{tmp_vcf}.csi", f"{output_vcf}.csi")
+                os.replace(tmp_vcf, output_vcf)
+            return [Job(f"split_index:{cell_id(fq)}:{chromosome}", [BCFTOOLS, "index", "-f", tmp_vcf], resource="phase", on_success=rename)]
+
+        jobs.append(Job(
+            f"split:{name}:{cell_id(fq)}:{chromosome}",
+            [
+                [BCFTOOLS, "view", "-s", cell_id(fq), "-Ou", batch_vcf],
+                [BCFTOOLS, "+fill-tags", "-", "-Ob", "-o", tmp_vcf, "--", "-t", "AF"]
+            ],
+            resource="phase",
+            log_path=f"{tmp_vcf}.log",
+            on_success=finalize
+        ))
+
+    try:
+        runner.run(jobs)
+    except JobFailed as e:
+        logger.error(f"Error splitting batch {name} on {chromosome}: {e}")
+        raise RuntimeError(f"Error splitting batch {name} on {chromosome}: {e}")
+
+
+def run_glimpse_batch(fqs, trackers=None):
+    """
+    Phase nhiều mẫu trong cùng một lần gọi GLIMPSE2_phase cho mỗi chunk (mode "bam"), để panel
+    và genetic map của chunk chỉ được nạp một lần cho cả batch, rồi tách kết quả về từng mẫu.
+    Chỉ dùng khi glimpse.mode = "bam" (phải bật rõ ràng, mặc định là "gl"); mode "gl" chạy từng mẫu.
+    """
+    if len(fqs) > 1 and MODE != "bam":
+        logger.warning(f"glimpse.batch_size > 1 requires glimpse.mode = \"bam\" (current: {MODE}); phasing samples one by one")
+    if len(fqs) == 1 or MODE != "bam":
+        for fq in fqs:
+            run_glimpse(fq, (trackers or {}).get(fq))
+        return
+
+    name = batch_name(fqs)
+    workdir = glimpse_batch_dir(name)
+    os.makedirs(workdir, exist_ok=True)
+    tracker = ArtifactTracker(name)
+    logger.info(f"GLIMPSE batch {name}: {[cell_id(fq) for fq in fqs]}")
+
+    chromosomes = [
+        chromosome for chromosome in PARAMETERS["chrs"]
+        if not all(imputed_done(glimpse_vcf(fq, chromosome)) for fq in fqs)
+    ]
+    if not chromosomes:
+        return
+    input_args = write_batch_bam_list(workdir, fqs)
+
+    def run_one(chromosome):
+        phase_genome(workdir, name, chromosome, tracker, input_args, n_targets=len(fqs))
+        extract_chunk_id(workdir, chromosome)
+        batch_vcf = ligate_genome(workdir, chromosome, tracker)
+        tracker.register([batch_vcf, f"{batch_vcf}.csi"], consumers=[f"split:{chromosome}"])
+        split_batch(batch_vcf, fqs, chromosome, name)
+        tracker.consumed(f"split:{chromosome}")
+        logger.info(f"Batch {name} completed for chromosome {chromosome}.")
+
+    run_chromosomes(name, chromosomes, run_one)
+    tracker.report()
@@ -0,0 +1,155 @@
+import os
+import shutil
+import threading
+from collections import defaultdict
+from helper.config import TOOLS, PARAMETERS, PATHS, TRIO_DATA
+from helper.path_define import get_vcf_ref, ground_truth_path
+from helper.logger import setup_logger
+from helper.async_runner import runner, Job, JobFailed
+from helper.registry import registry
+
+# Thiết lập logger
+logger = setup_logger(os.path.join(PATHS["logs"], "ground_truth.log"))
+
+
+BCFTOOLS = TOOLS["bcftools"]
+TRUTH_FILTER = ["-m", "2", "-M", "2"]
+
+_chromosome_locks = defaultdict(threading.Lock)
+
+
+def trio_samples(trios=None):
+    """
+    Tất cả mẫu (child, mother, father) của các trio trong conf/trio.json.
+    """
+    trios = TRIO_DATA if trios is None else {name: TRIO_DATA[name] for name in trios}
+    return sorted({sample for trio in trios.values() for sample in trio.values()})
+
+
+def truth_resources(chromosome):
+    return {
+        "inputs": [get_vcf_ref(chromosome)],
+        "params": {"filter": TRUTH_FILTER},
+        "tools": [BCFTOOLS],
+    }
+
+
+def truth_outputs(sample, chromosome):
+    path = ground_truth_path(sample, chromosome)
+    return [path, f"{path}.tbi"]
+
+
+def expected_truths():
+    """
+    Mọi file ground truth mà `python main.py prepare` phải tạo ra (mọi mẫu trio, mọi chromosome).
+    """
+    return [path for chromosome in PARAMETERS["chrs"] for sample in trio_samples() for path in truth_outputs(sample, chromosome)]
+
+
+def stale_samples(samples, chromosome):
+    """
+    Các mẫu chưa có ground truth hợp lệ cho chromosome (thiếu, hỏng hoặc call set đã đổi).
+    """
+    stale = registry.stale([path for sample in samples for path in truth_outputs(sample, chromosome)], **truth_resources(chromosome))
+    return [sample for sample in samples if any(path in stale for path in truth_outputs(sample, chromosome))]
+
+
+def split_dir(chromosome):
+    return os.path.join(PATHS["vcf_directory"], f".split_{chromosome}")
+
+
+def extract_truth_job(chromosome, samples):
+    """
+    Một lần đọc call set của chromosome cho tất cả mẫu: bcftools view -s (các mẫu cần) | +split,
+    mỗi mẫu một file {sample}_{chromosome}.vcf.gz; sau đó index và đăng ký từng file.
+    """
+    tmp_dir = split_dir(chromosome)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    # +split -S: cột 1 là tên mẫu, cột 2 là tên file đầu ra (không kèm phần mở rộng)
+    samples_file = os.path.join(tmp_dir, "samples.tsv")
+    with open(samples_file, "w") as out:
+        for sample in samples:
+            out.write(f"{sample}\t{os.path.basename(ground_truth_path(sample, chromosome))[:-len('.vcf.gz')]}\n")
+
+    commands = [
+        [BCFTOOLS, "view", "-s", ",".join(samples), *TRUTH_FILTER, "-Ou", "--threads", f"{PARAMETERS['threads']}", get_vcf_ref(chromosome)],
+        [BCFTOOLS, "+split", "-", "-S", samples_file, "-Oz", "-o", tmp_dir],
+    ]
+
+    def index_jobs(job):
+        jobs = []
+        for sample in samples:
+            output = ground_truth_path(sample, chromosome)
+            tmp_vcf = os.path.join(tmp_dir, os.path.basename(output))
+
+            def finalize(job, output=output, tmp_vcf=tmp_vcf):
+                os.replace(f"{tmp_vcf}.tbi", f"{output}.tbi")
+                os.replace(tmp_vcf, output)
+                registry.record([output, f"{output}.tbi"], **truth_resources(chromosome))
+
+            jobs.append(Job(f"truth_index:{sample}:{chromosome}", [BCFTOOLS, "index", "-t", "-f", tmp_vcf], resource="truth", on_success=finalize))
+        return jobs
+
+    return Job(
+        f"truth:{chromosome}",
+        commands,
+        resource="truth",
+        log_path=os.path.join(tmp_dir, "split.log"),
+        on_success=index_jobs
+    )
+
+
+def extract_ground_truth(samples, chromosomes=None):
+    """
+    Tách ground truth của các mẫu, song song theo chromosome (resource "truth"). Mỗi chromosome
+    chỉ đọc call set một lần cho mọi mẫu còn thiếu; mẫu đã có kết quả hợp lệ được bỏ qua.
+    """
+    chromosomes = chromosomes or PARAMETERS["chrs"]
+    jobs = []
+    extracted = []
+    locked = []
+    try:
+        # Khóa theo thứ tự cố định để hai lần gọi đồng thời không chờ nhau vòng tròn
+        for chromosome in sorted(chromosomes):
+            lock = _chromosome_locks[chromosome]
+            lock.acquire()
+            locked.append(lock)
+            missing = stale_samples(samples, chromosome)
+            if not missing:
+                continue
+            logger.info(f"Extracting ground truth for {chromosome}: {missing}")
+            jobs.append(extract_truth_job(chromosome, missing))
+            extracted.append(chromosome)
+
+        try:
+            runner.run(jobs)
+        except JobFailed as e:
+            logger.error(f"Error extracting ground truth: {e}")
+            raise RuntimeError(f"Error extracting ground truth: {e}")
+        for chromosome in extracted:
+            shutil.rmtree(split_dir(chromosome), ignore_errors=True)
+    finally:
+        for lock in locked:
+            lock.release()
+
+
+def ground_truth_vcf(name, chromosome):
+    """
+    VCF ground truth của một mẫu trên một chromosome; nếu chưa có thì tách (cùng lúc cho mọi mẫu
+    của các trio đang thiếu chromosome này, để không phải quét lại call set cho từng mẫu).
+    """
+    path = ground_truth_path(name, chromosome)
+    if not stale_samples([name], chromosome):
+        return path
+
+    extract_ground_truth(sorted(set(trio_samples()) | {name}), [chromosome])
+    return path
+
+
+def run_ground_truth(trios=None):
+    """
+    Chuẩn bị ground truth cho mọi mẫu của các trio (mặc định toàn bộ conf/trio.json).
+    """
+    extract_ground_truth(trio_samples(trios))
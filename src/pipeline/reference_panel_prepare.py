@@ -1,8 +1,22 @@
 import subprocess
 import os
+import sys
+import json
+import shutil
+import threading
+import pandas as pd
 from helper.config import TOOLS, PARAMETERS, PATHS
-from helper.path_define import vcf_prefix, get_vcf_path, filtered_tsv_path, filtered_vcf_path, chunks_path, norm_vcf_path
+from helper.path_define import vcf_prefix, get_vcf_path, filtered_tsv_path, filtered_vcf_path, chunks_path, norm_vcf_path, positions_path
+from helper.path_define import split_reference_prefix, split_reference_bin
+from helper.path_define import FULL_PANEL, active_panel, population_path, panel_samples_path, panel_parts_dir
 from helper.logger import setup_logger
+from helper.async_runner import runner, Job, JobFailed
+from helper.chunk_planner import plan_chunk_params, write_chunk_params, phase_targets
+from helper.region_planner import load_chromosome_lengths
+from helper.bgzf import concat_vcfs, concat_bgzf, has_eof
+from helper.registry import registry
+from helper.site_index import site_index_files, write_site_index
+from pipeline.ground_truth import trio_samples
 from concurrent.futures import ThreadPoolExecutor
 
 # Thiết lập logger
@@ -13,193 +27,515 @@ BCFTOOLS = TOOLS["bcftools"]
 BGZIP = TOOLS["bgzip"]
 TABIX = TOOLS["tabix"]
 GLIMPSE_CHUNK = TOOLS["GLIMPSE_chunk"]
+GLIMPSE_SPLIT_REFERENCE = TOOLS["GLIMPSE_split_reference"]
+MAP_PATH = PATHS["map_path"]
 reference_path = PATHS["reference_path"]
+SUBSETS = PARAMETERS["panel"]["subsets"]
+REGION_MB = PARAMETERS["panel"]["region_mb"]
+REGION_MEMORY_GB = PARAMETERS["panel"]["region_memory_gb"]
+MAF = PARAMETERS["maf"]
+PANEL_TEE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "helper", "panel_tee.py")
+PART_SUFFIXES = ("panel.vcf.gz", "sites.vcf.gz", "sites.tsv.gz", "sites.pos.txt", "index.positions.i32", "index.alleles.u8", "index.af.f32")
 
-def check_reference_panel(chromosome):
+_samples_lock = threading.Lock()
+
+def panel_url(chromosome):
+    return f"http://ftp.1000genomes.ebi.ac.uk/vol1/ftp/data_collections/1000G_2504_high_coverage/working/20201028_3202_phased/CCDG_14151_B01_GRM_WGS_2020-08-05_{chromosome}.filtered.shapeit2-duohmm-phased.vcf.gz"
+
+def normalize_resources(chromosome, panel):
     """
-    Kiểm tra dữ liệu reference panel đã tồn tại hay chưa.
+    Output, input, tham số và công cụ của bước normalize (dùng cho resource registry).
     """
-    prefix = vcf_prefix(chromosome)
-    required_files = [
-        f"{reference_path}/{prefix}.biallelic.snp.maf0.001.vcf.gz",
-        f"{reference_path}/{prefix}.biallelic.snp.maf0.001.vcf.gz.tbi",
-        f"{reference_path}/{prefix}.biallelic.snp.maf0.001.sites.tsv.gz",
-        f"{reference_path}/{prefix}.chunks.txt"
-    ]
-    for file in required_files:
-        if not os.path.exists(file):
-            return False
-    return True
+    panel = active_panel(panel)
+    inputs = [get_vcf_path(chromosome)]
+    if panel != FULL_PANEL:
+        inputs.append(panel_samples_path(panel))
+    return {
+        "outputs": [
+            norm_vcf_path(chromosome, panel), f"{norm_vcf_path(chromosome, panel)}.tbi",
+            filtered_vcf_path(chromosome, panel), f"{filtered_vcf_path(chromosome, panel)}.tbi",
+            filtered_tsv_path(chromosome, panel), f"{filtered_tsv_path(chromosome, panel)}.tbi",
+            positions_path(chromosome, panel),
+            *site_index_files(chromosome, panel).values()
+        ],
+        "inputs": inputs,
+        "params": {"panel": SUBSETS.get(panel, panel), "maf": MAF},
+        "tools": [BCFTOOLS, BGZIP, TABIX, PANEL_TEE],
+    }
+
+def chunk_resources(chromosome, panel):
+    chunking = PARAMETERS["glimpse"]["chunking"]
+    return {
+        "outputs": [chunks_path(chromosome, panel)],
+        "inputs": [norm_vcf_path(chromosome, panel) if chunking["enabled"] else get_vcf_path(chromosome)],
+        "params": {"chunking": chunking if chunking["enabled"] else "fixed_2mb", "n_targets": phase_targets()},
+        "tools": [GLIMPSE_CHUNK],
+    }
+
+def split_reference_resources(chromosome, panel):
+    return {
+        "inputs": [norm_vcf_path(chromosome, panel), os.path.join(MAP_PATH, f"{chromosome}.b38.gmap.gz"), chunks_path(chromosome, panel)],
+        "params": {},
+        "tools": [GLIMPSE_SPLIT_REFERENCE],
+    }
+
+def check_reference_panel(chromosome, panel=None):
+    """
+    Kiểm tra reference panel (đầy đủ hoặc panel con) đã được tạo đầy đủ theo resource registry:
+    mọi file dẫn xuất còn nguyên vẹn và input, tham số, phiên bản công cụ không đổi.
+    """
+    if not registry.is_fresh(**normalize_resources(chromosome, panel)):
+        return False
+    if not registry.is_fresh(**chunk_resources(chromosome, panel)):
+        return False
+    return not missing_split_reference(chromosome, panel)
+
+def chunk_regions(chromosome, panel=None):
+    """
+    (input_region, output_region) của các chunk trong file chunk.
+    """
+    regions = []
+    with open(chunks_path(chromosome, panel)) as chunk_file:
+        for line in chunk_file:
+            fields = line.strip().split()
+            if fields:
+                regions.append((fields[2], fields[3]))
+    return regions
+
+def missing_split_reference(chromosome, panel=None):
+    """
+    Các chunk chưa có file .bin hợp lệ của GLIMPSE2_split_reference (thiếu, hỏng, hoặc panel/map/file
+    chunk đã đổi so với lúc tạo).
+    """
+    if not os.path.exists(chunks_path(chromosome, panel)):
+        return None
+    regions = chunk_regions(chromosome, panel)
+    bins = {split_reference_bin(chromosome, input_region, panel=panel): (input_region, output_region) for input_region, output_region in regions}
+    stale = registry.stale(list(bins), **split_reference_resources(chromosome, panel))
+    return [bins[path] for path in bins if path in stale]
 
 def download_reference_panel(chromosome):
     """
     Download reference panel from 1KGP FTP if not already exists.
+    wget -c tải tiếp file bị ngắt giữa chừng; file chỉ được đăng ký khi có block EOF của BGZF.
     """
-    url = f"http://ftp.1000genomes.ebi.ac.uk/vol1/ftp/data_collections/1000G_2504_high_coverage/working/20201028_3202_phased/CCDG_14151_B01_GRM_WGS_2020-08-05_{chromosome}.filtered.shapeit2-duohmm-phased.vcf.gz"
+    url = panel_url(chromosome)
     vcf_path = get_vcf_path(chromosome)
     index_path = f"{vcf_path}.tbi"
 
-    if os.path.exists(vcf_path) and os.path.exists(index_path):
+    if registry.is_fresh([vcf_path, index_path], params={"url": url}):
         logger.info(f"Reference panel for {chromosome} already exists. Skipping download.")
         return vcf_path
 
     logger.info(f"Downloading reference panel for chromosome {chromosome}...")
-    commands = [
-        ["wget", "-c", url, "-P", reference_path],
-        ["wget", "-c", f"{url}.tbi", "-P", reference_path]
+    jobs = [
+        Job(f"download:{chromosome}", ["wget", "-c", url, "-P", reference_path], resource="download"),
+        Job(f"download_index:{chromosome}", ["wget", "-c", f"{url}.tbi", "-P", reference_path], resource="download"),
     ]
-    
-    for command in commands:
-        process = subprocess.run(command, capture_output=True, text=True)
-        if process.returncode != 0:
-            logger.error(f"Error downloading file: {process.stderr}")
-            raise RuntimeError(f"Error downloading file: {process.stderr}")
+    try:
+        runner.run(jobs)
+    except JobFailed as e:
+        logger.error(f"Error downloading file: {e}")
+        raise RuntimeError(f"Error downloading file: {e}")
+
+    for path in (vcf_path, index_path):
+        if not has_eof(path):
+            logger.error(f"Downloaded file is truncated: {path}")
+            raise RuntimeError(f"Downloaded file is truncated: {path}")
+    registry.record([vcf_path, index_path], params={"url": url})
 
     logger.info(f"Downloaded reference panel for chromosome {chromosome}.")
     return vcf_path
 
-def normalize_and_filter_reference(chromosome):
+def download_population_file():
     """
-    Normalize and filter the reference panel.
+    Bảng quần thể / siêu quần thể của 3202 mẫu 1KGP, dùng để chọn mẫu cho panel con.
     """
-    vcf_path = get_vcf_path(chromosome)
-    output_vcf = norm_vcf_path(chromosome)
-
-    if os.path.exists(output_vcf) and os.path.exists(f"{output_vcf}.tbi"):
-        logger.info(f"Filtered VCF already exists. Skipping normalization and filtering.")
-        return output_vcf
+    path = population_path()
+    url = PARAMETERS["panel"]["population_url"]
+    if registry.is_fresh([path], params={"url": url}):
+        return path
 
-    logger.info(f"Normalizing and filtering VCF for chromosome {chromosome}...")
-    command = [
-        BCFTOOLS, "norm", "-m", "-any", vcf_path, "-Ou",
-        "--threads", f"{PARAMETERS['threads']}", "|",
-        BCFTOOLS, "view", "-m", "2", "-M", "2", "-v", "snps", "-i", "'MAF>0.001'",
-        "--threads", f"{PARAMETERS['threads']}", "-Oz", "-o", output_vcf
-    ]
-
-    process = subprocess.run(" ".join(command), shell=True, capture_output=True, text=True)
+    logger.info("Downloading 1KGP population table...")
+    process = subprocess.run(["wget", "-N", url, "-P", reference_path], capture_output=True, text=True)
     if process.returncode != 0:
-        logger.error(f"Error normalizing and filtering: {process.stderr}")
-        raise RuntimeError(f"Error normalizing and filtering: {process.stderr}")
+        logger.error(f"Error downloading file: {process.stderr}")
+        raise RuntimeError(f"Error downloading file: {process.stderr}")
+    registry.record([path], params={"url": url})
+    return path
 
-    index_command = [BCFTOOLS, "index", "-f", output_vcf]
-    subprocess.run(index_command, check=True)
+def subset_samples(panel):
+    """
+    Danh sách mẫu của panel con theo cấu hình panel.subsets: populations, super_populations
+    và/hoặc samples_file (mỗi dòng một mẫu); các tiêu chí được hợp lại với nhau.
+    exclude_trios=true bỏ các mẫu trio trong conf/trio.json (mẫu đích của benchmark không được nằm trong panel).
+    """
+    definition = SUBSETS[panel]
+    samples = set()
+    if definition.get("samples_file"):
+        with open(definition["samples_file"]) as samples_file:
+            samples.update(line.strip() for line in samples_file if line.strip())
+
+    if definition.get("populations") or definition.get("super_populations"):
+        table = pd.read_csv(download_population_file(), sep=r"\s+")
+        selected = table["Population"].isin(definition.get("populations", [])) \
+            | table["Superpopulation"].isin(definition.get("super_populations", []))
+        samples.update(table.loc[selected, "SampleID"])
+
+    if definition.get("exclude_trios"):
+        samples.difference_update(trio_samples())
+
+    if not samples:
+        logger.error(f"Panel subset {panel} selects no samples: {definition}")
+        raise RuntimeError(f"Panel subset {panel} selects no samples: {definition}")
+    return sorted(samples)
+
+def write_subset_samples(panel):
+    """
+    Ghi file mẫu (cho bcftools view -S) của panel con, dùng chung cho mọi chromosome.
+    """
+    output = panel_samples_path(panel)
+    definition = SUBSETS[panel]
+    with _samples_lock:
+        inputs = [definition["samples_file"]] if definition.get("samples_file") else []
+        if definition.get("populations") or definition.get("super_populations"):
+            inputs.append(download_population_file())
+        params = {**definition, "excluded": trio_samples() if definition.get("exclude_trios") else []}
+        if registry.is_fresh([output], inputs=inputs, params=params):
+            return output
+        samples = subset_samples(panel)
+        with open(f"{output}.tmp", "w") as out:
+            out.write("\n".join(samples) + "\n")
+        os.replace(f"{output}.tmp", output)
+        registry.record([output], inputs=inputs, params=params)
+    logger.info(f"Panel subset {panel}: {len(samples)} samples written to {output}")
+    return output
+
+def panel_regions(chromosome):
+    """
+    Chia chromosome thành các region REGION_MB Mb để normalize panel song song.
+    """
+    length = load_chromosome_lengths(PATHS["ref_fai"], [chromosome])[chromosome]
+    step = int(REGION_MB * 1000000)
+    return [(start + 1, min(start + step, length)) for start in range(0, length, step)]
 
-    logger.info(f"Filtered VCF created at {output_vcf}.")
-    return output_vcf
+def region_parts(parts_dir, start, end):
+    """
+    Các file kết quả của một region: panel, sites VCF, TSV, vị trí và ba mảng của site index
+    (theo thứ tự PART_SUFFIXES).
+    """
+    return [os.path.join(parts_dir, f"region_{start}_{end}.{suffix}") for suffix in PART_SUFFIXES]
 
-def process_snp_sites(chromosome):
+def filter_commands(chromosome, start, end, panel):
     """
-    Process SNP sites.
+    Pipeline normalize và lọc một region, ghi VCF không nén ra stdout cho panel_tee.
+    Panel con chọn mẫu trước khi normalize rồi tính lại AC/AN/AF/MAF theo tập mẫu mới
+    (site hiếm trong 3202 mẫu nhưng phổ biến trong quần thể con vẫn được giữ).
     """
-    vcf_path = norm_vcf_path(chromosome)
-    filtered_vcf = filtered_vcf_path(chromosome)
-    tsv_output = filtered_tsv_path(chromosome)
+    region = f"{chromosome}:{start}-{end}"
+    if panel == FULL_PANEL:
+        return [
+            [BCFTOOLS, "view", "-r", region, "-Ou", get_vcf_path(chromosome)],
+            [BCFTOOLS, "norm", "-m", "-any", "-Ou", "-"],
+            [BCFTOOLS, "view", "-m", "2", "-M", "2", "-v", "snps", "-i", f"MAF>{MAF}", "-Ov", "-"],
+        ]
+    return [
+        [BCFTOOLS, "view", "-r", region, "-S", panel_samples_path(panel), "--force-samples", "-Ou", get_vcf_path(chromosome)],
+        [BCFTOOLS, "norm", "-m", "-any", "-Ou", "-"],
+        [BCFTOOLS, "view", "-m", "2", "-M", "2", "-v", "snps", "-Ou", "-"],
+        [BCFTOOLS, "+fill-tags", "-", "-Ou", "--", "-t", "AC,AN,AF,MAF"],
+        [BCFTOOLS, "view", "-i", f"INFO/MAF>{MAF}", "-Ov", "-"],
+    ]
+
+def panel_region_job(chromosome, panel, start, end, outputs):
+    panel_part, sites_part, tsv_part, positions_part, index_positions, index_alleles, index_af = [f"{output}.part" for output in outputs]
+    tee_command = [
+        sys.executable, PANEL_TEE,
+        "--start", f"{start}", "--end", f"{end}",
+        "--bgzip", BGZIP, "--threads", f"{PARAMETERS['threads']}",
+        "--panel", panel_part, "--sites", sites_part, "--tsv", tsv_part, "--positions", positions_part,
+        "--index-positions", index_positions, "--index-alleles", index_alleles, "--index-af", index_af
+    ]
 
-    if os.path.exists(filtered_vcf) and os.path.exists(f"{filtered_vcf}.tbi") and os.path.exists(tsv_output):
-        logger.info(f"SNP site files already exist. Skipping SNP site processing.")
-        return filtered_vcf, tsv_output
+    def finalize(job):
+        for output in outputs:
+            os.replace(f"{output}.part", output)
 
-    logger.info(f"Processing SNP sites for chromosome {chromosome}...")
-    commands = [
-        [BCFTOOLS, "view", "-G", "-m", "2", "-M", "2", "-v", "snps", vcf_path, "-Oz", "-o", filtered_vcf, "--threads", f"{PARAMETERS['threads']}",],
-        [BCFTOOLS, "index", "-f", filtered_vcf],
+    return Job(
+        f"panel_region:{panel}:{chromosome}:{start}-{end}",
+        filter_commands(chromosome, start, end, panel) + [tee_command],
+        resource="panel",
+        memory=REGION_MEMORY_GB,
+        log_path=f"{panel_part}.log",
+        on_success=finalize
+    )
+
+def merge_panel_parts(chromosome, panel, parts):
+    """
+    Nối kết quả các region theo thứ tự: VCF ở mức block BGZF (kèm index .tbi trong cùng lần ghi),
+    TSV nối block rồi tabix, file vị trí nối văn bản, site index nối mảng thành .npy.
+    File đích chỉ xuất hiện khi đã ghi xong.
+    """
+    panels, sites, tsvs, positions = list(zip(*parts))[:4]
+    outputs = [
+        (concat_vcfs, panels, norm_vcf_path(chromosome, panel)),
+        (concat_vcfs, sites, filtered_vcf_path(chromosome, panel)),
     ]
+    for concat, inputs, output in outputs:
+        concat(inputs, f"{output}.part")
+        os.replace(f"{output}.part.tbi", f"{output}.tbi")
+        os.replace(f"{output}.part", output)
+
+    tsv_output = filtered_tsv_path(chromosome, panel)
+    concat_bgzf(tsvs, f"{tsv_output}.part")
+    subprocess.run([TABIX, "-f", "-s1", "-b2", "-e2", f"{tsv_output}.part"], check=True)
+    os.replace(f"{tsv_output}.part.tbi", f"{tsv_output}.tbi")
+    os.replace(f"{tsv_output}.part", tsv_output)
+
+    positions_output = positions_path(chromosome, panel)
+    with open(f"{positions_output}.part", "wb") as out:
+        for path in positions:
+            with open(path, "rb") as part:
+                shutil.copyfileobj(part, out)
+    os.replace(f"{positions_output}.part", positions_output)
+
+    write_site_index(chromosome, [region[4:] for region in parts], panel)
+
+def normalize_and_filter_reference(chromosome, panel=None):
+    """
+    Normalize and filter the reference panel.
+    Chạy song song theo region qua async runner (resource "panel", bộ nhớ REGION_MEMORY_GB mỗi region);
+    panel, sites VCF, TSV và file vị trí được tách từ cùng một luồng normalize (helper/panel_tee.py)
+    thay vì đọc lại panel cho từng file. Region đã xong từ lần chạy trước (cùng input, tham số
+    và công cụ) được giữ lại.
+    """
+    panel = active_panel(panel)
+    output_vcf = norm_vcf_path(chromosome, panel)
+    if panel != FULL_PANEL:
+        write_subset_samples(panel)
+    resources = normalize_resources(chromosome, panel)
+    if registry.is_fresh(**resources):
+        logger.info(f"Filtered VCF already exists. Skipping normalization and filtering.")
+        return output_vcf
 
-    # Chạy các lệnh bcftools view và index
-    for command in commands:
-        process = subprocess.run(command, check=True)
-        if process.returncode != 0:
-            logger.error(f"Error processing SNP sites: {process.stderr}")
-            raise RuntimeError(f"Error processing SNP sites: {process.stderr}")
+    # Region dở dang của một lần chạy với input/tham số khác thì bỏ đi
+    parts_dir = panel_parts_dir(chromosome, panel)
+    signature = json.dumps(registry.describe(resources["inputs"], resources["params"], resources["tools"]), sort_keys=True)
+    signature_path = os.path.join(parts_dir, "signature.json")
+    if os.path.exists(signature_path) and open(signature_path).read() != signature:
+        shutil.rmtree(parts_dir)
+    os.makedirs(parts_dir, exist_ok=True)
+    with open(signature_path, "w") as out:
+        out.write(signature)
+
+    regions = panel_regions(chromosome)
+    parts = [region_parts(parts_dir, start, end) for start, end in regions]
+    jobs = [
+        panel_region_job(chromosome, panel, start, end, region_outputs)
+        for (start, end), region_outputs in zip(regions, parts)
+        if not all(os.path.exists(output) for output in region_outputs)
+    ]
 
-    # Chạy bcftools query và bgzip
-    logger.info(f"Running bcftools query and bgzip for chromosome {chromosome}...")
-    with open(tsv_output, "wb") as output_file:
-        query_command = [BCFTOOLS, "query", "-f", "%CHROM\\t%POS\\t%REF,%ALT\\n", filtered_vcf]
-        bgzip_command = [BGZIP, "-c"]
-        query_process = subprocess.Popen(query_command, stdout=subprocess.PIPE)
-        subprocess.run(bgzip_command, stdin=query_process.stdout, stdout=output_file, check=True)
-        query_process.stdout.close()
-        query_process.wait()
+    logger.info(f"Normalizing and filtering panel {panel} for chromosome {chromosome}: {len(jobs)}/{len(regions)} regions to run")
+    try:
+        runner.run(jobs)
+    except JobFailed as e:
+        logger.error(f"Error normalizing and filtering: {e}")
+        raise RuntimeError(f"Error normalizing and filtering: {e}")
 
-    # Chạy tabix để tạo index cho tsv_output
-    logger.info(f"Running tabix for chromosome {chromosome}...")
-    tabix_command = [TABIX, "-s1", "-b2", "-e2", "-@", f"{PARAMETERS['threads']}", tsv_output]
-    subprocess.run(tabix_command, check=True)
+    merge_panel_parts(chromosome, panel, parts)
+    registry.record(**resources)
+    shutil.rmtree(parts_dir)
 
-    logger.info(f"Processed SNP sites for chromosome {chromosome}.")
-    return filtered_vcf, tsv_output
+    logger.info(f"Filtered VCF created at {output_vcf}.")
+    return output_vcf
 
 
-def chunk_reference_genome(chromosome):
+def glimpse_chunk(chromosome, output, params=None, panel=None, input_vcf=None):
+    """
+    Chạy GLIMPSE2_chunk. params=None giữ cách chia cũ (window 2 Mb, buffer 0.2 Mb, mặc định trên panel gốc;
+    input_vcf để chia trên panel khác); params từ chunk planner chia theo số variant của panel biallelic dùng để phase.
+    """
+    if params is None:
+        command = [
+            GLIMPSE_CHUNK, "--input", input_vcf or get_vcf_path(chromosome), "--region", chromosome,
+            "--window-mb", "2", "--buffer-mb", "0.2",
+            "--output", output, "--sequential"
+        ]
+    else:
+        command = [
+            GLIMPSE_CHUNK, "--input", norm_vcf_path(chromosome, panel), "--region", chromosome,
+            "--window-count", f"{params['window_count']}", "--buffer-count", f"{params['buffer_count']}",
+            "--window-mb", f"{params['window_mb']}", "--buffer-mb", f"{params['buffer_mb']}",
+            "--output", output, "--sequential"
+        ]
+
+    try:
+        runner.run([Job(f"glimpse_chunk:{active_panel(panel)}:{chromosome}:{os.path.basename(output)}", command, resource="panel", log_path=f"{output}.log")])
+    except JobFailed as e:
+        logger.error(f"Error chunking reference genome: {e}")
+        raise RuntimeError(f"Error chunking reference genome: {e}")
+    return output
+
+
+def chunk_reference_genome(chromosome, force=False, panel=None):
     """
     Chunk the reference genome.
+    force=True tạo lại file chunk (ví dụ sau khi cost model có thêm dữ liệu thời gian phase).
     """
-    vcf_path = get_vcf_path(chromosome)
-    chunks_output = chunks_path(chromosome)
+    chunks_output = chunks_path(chromosome, panel)
+    resources = chunk_resources(chromosome, panel)
 
-    if os.path.exists(chunks_output):
+    if not force and registry.is_fresh(**resources):
         logger.info(f"Chunk file already exists: {chunks_output}. Skipping chunking.")
         return chunks_output
 
     logger.info(f"Chunking reference genome for chromosome {chromosome}...")
-    command = [
-        GLIMPSE_CHUNK, "--input", vcf_path, "--region", chromosome,
-        "--window-mb", "2", "--buffer-mb", "0.2",
-        "--output", chunks_output, "--sequential"
-    ]
-
-    process = subprocess.run(command, capture_output=True, text=True)
-    if process.returncode != 0:
-        logger.error(f"Error chunking reference genome: {process.stderr}")
-        raise RuntimeError(f"Error chunking reference genome: {process.stderr}")
+    params = plan_chunk_params(chromosome, n_targets=phase_targets(), panel=panel) if PARAMETERS["glimpse"]["chunking"]["enabled"] else None
+    tmp_output = f"{chunks_output}.tmp"
+    glimpse_chunk(chromosome, tmp_output, params, panel)
+    os.replace(tmp_output, chunks_output)
+    if params is not None:
+        write_chunk_params(chromosome, params, panel)
+    registry.record(**resources)
 
     logger.info(f"Chunk file created at {chunks_output}.")
     return chunks_output
 
+def split_reference_panel(chromosome, panel=None):
+    """
+    Tạo reference panel dạng nhị phân cho từng chunk (GLIMPSE2_split_reference) một lần duy nhất,
+    để GLIMPSE2_phase của mọi mẫu đọc thẳng file .bin thay vì parse lại panel VCF.
+    """
+    missing = missing_split_reference(chromosome, panel)
+    if not missing:
+        logger.info(f"Split reference for {chromosome} already exists. Skipping.")
+        return
+
+    prefix = split_reference_prefix(chromosome, panel)
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    # Ghi với prefix tạm rồi đổi tên, để file .bin dở dang không bị coi là đã có
+    tmp_prefix = f"{prefix}.part"
+    map_file = os.path.join(MAP_PATH, f"{chromosome}.b38.gmap.gz")
+
+    jobs = []
+    for input_region, output_region in missing:
+        command = [
+            GLIMPSE_SPLIT_REFERENCE,
+            "--reference", norm_vcf_path(chromosome, panel),
+            "--map", map_file,
+            "--input-region", input_region,
+            "--output-region", output_region,
+            "--threads", f"{PARAMETERS['threads']}",
+            "--output", tmp_prefix
+        ]
+
+        def finalize(job, input_region=input_region):
+            output = split_reference_bin(chromosome, input_region, panel=panel)
+            os.replace(split_reference_bin(chromosome, input_region, tmp_prefix), output)
+            registry.record([output], **split_reference_resources(chromosome, panel))
+
+        jobs.append(Job(
+            f"split_reference:{active_panel(panel)}:{chromosome}:{input_region}",
+            command,
+            resource="split_reference",
+            log_path=f"{split_reference_bin(chromosome, input_region, tmp_prefix)}.log",
+            on_success=finalize
+        ))
+
+    logger.info(f"Splitting reference panel for {chromosome}: {len(jobs)} chunks")
+    try:
+        runner.run(jobs)
+    except JobFailed as e:
+        logger.error(f"Error splitting reference panel for {chromosome}: {e}")
+        raise RuntimeError(f"Error splitting reference panel for {chromosome}: {e}")
+    logger.info(f"Split reference for {chromosome} created under {os.path.dirname(prefix)}.")
+
+def dbsnp_path():
+    return os.path.join(PATHS["gatk_bundle_dir"], "Homo_sapiens_assembly38.dbsnp138.vcf.gz")
+
 def prepare_gatk_bundle():
-    dbsnp = os.path.join(PATHS["gatk_bundle_dir"], "Homo_sapiens_assembly38.dbsnp138.vcf.gz")
+    dbsnp = dbsnp_path()
+    dbsnp_vcf = dbsnp[:-len(".gz")]
+    outputs = [dbsnp, f"{dbsnp}.tbi"]
+    tools = [TOOLS['bgzip'], TOOLS['tabix']]
+
+    if registry.is_fresh(outputs, tools=tools):
+        print(f"{dbsnp} already exists. No action needed.")
+        return
+
+    if os.path.exists(dbsnp_vcf):
+        print(f"{dbsnp} not found. Compressing {dbsnp_vcf}...")
 
-    if not os.path.exists(dbsnp):
-        print(f"{dbsnp} not found. Compressing {dbsnp}...")
-        
         # Sử dụng bgzip để nén tệp .vcf thành .vcf.gz
-        bgzip_cmd = [TOOLS['bgzip'], dbsnp]
+        bgzip_cmd = [TOOLS['bgzip'], "-f", "-@", f"{PARAMETERS['threads']}", dbsnp_vcf]
         subprocess.run(bgzip_cmd, check=True)
-        
-        # Lập chỉ mục tệp .vcf.gz bằng tabix
-        tabix_cmd = [TOOLS['tabix'], "-f", "-@", f"{PARAMETERS['threads']}", f"{dbsnp}.gz"]
-        subprocess.run(tabix_cmd, check=True)
-        
-        print(f"{dbsnp} has been compressed and indexed.")
-    else:
-        print(f"{dbsnp} already exists. No action needed.")
 
+    if not os.path.exists(dbsnp) or not has_eof(dbsnp):
+        logger.error(f"{dbsnp} is missing or truncated and {dbsnp_vcf} is not available")
+        raise RuntimeError(f"{dbsnp} is missing or truncated and {dbsnp_vcf} is not available")
 
-def prepare_reference_panel(chromosome):
+    # Lập chỉ mục tệp .vcf.gz bằng tabix
+    tabix_cmd = [TOOLS['tabix'], "-f", "-@", f"{PARAMETERS['threads']}", dbsnp]
+    subprocess.run(tabix_cmd, check=True)
+    registry.record(outputs, tools=tools)
+
+    print(f"{dbsnp} has been compressed and indexed.")
+
+
+def prepare_panel(chromosome, panel=FULL_PANEL):
     """
-    Thực hiện các bước chuẩn bị reference panel cho một chromosome.
+    Các bước chuẩn bị một reference panel (đầy đủ hoặc panel con) cho một chromosome.
     """
-    os.makedirs(reference_path, exist_ok=True)
-
-    if check_reference_panel(chromosome):
-        logger.info(f"Reference panel for {chromosome} already exists. Skipping.")
+    if check_reference_panel(chromosome, panel):
+        logger.info(f"Reference panel {panel} for {chromosome} already exists. Skipping.")
         return
 
     # Step 1: Download reference panel
     download_reference_panel(chromosome)
 
-    # Step 2: Normalize and filter reference panel
-    normalize_and_filter_reference(chromosome)
+    # Step 2: Normalize and filter reference panel theo region (panel con: chọn mẫu rồi tính lại MAF);
+    # sites VCF, TSV và file vị trí cho BaseVar --positions được ghi trong cùng lần đọc
+    normalize_and_filter_reference(chromosome, panel)
+
+    # Step 3: Chunk reference genome
+    chunk_reference_genome(chromosome, panel=panel)
+
+    # Step 4: Binary reference panel per chunk for GLIMPSE2_phase
+    split_reference_panel(chromosome, panel)
+
+    logger.info(f"Reference panel {panel} preparation completed for {chromosome}.")
 
-    # Step 3: Process SNP sites
-    process_snp_sites(chromosome)
 
-    # Step 4: Chunk reference genome
-    chunk_reference_genome(chromosome)
+def prepare_reference_panel(chromosome):
+    """
+    Thực hiện các bước chuẩn bị reference panel cho một chromosome: panel đầy đủ và các panel con
+    trong panel.subsets, lưu cạnh nhau với tên riêng theo fingerprint.
+    """
+    os.makedirs(reference_path, exist_ok=True)
+
+    for panel in [FULL_PANEL, *SUBSETS]:
+        prepare_panel(chromosome, panel)
+
+
+def expected_resources():
+    """
+    Mọi file reference mà `python main.py prepare` phải tạo ra và đăng ký: GATK bundle, panel tải về,
+    panel đầy đủ và panel con của mọi chromosome (file .bin liệt kê theo file chunk nếu đã có).
+    """
+    outputs = [dbsnp_path(), f"{dbsnp_path()}.tbi"]
+    if any(definition.get("populations") or definition.get("super_populations") for definition in SUBSETS.values()):
+        outputs.append(population_path())
+    outputs += [panel_samples_path(panel) for panel in SUBSETS]
 
-    logger.info(f"Reference panel preparation completed for {chromosome}.")
+    for chromosome in PARAMETERS["chrs"]:
+        outputs += [get_vcf_path(chromosome), f"{get_vcf_path(chromosome)}.tbi"]
+        for panel in [FULL_PANEL, *SUBSETS]:
+            outputs += normalize_resources(chromosome, panel)["outputs"]
+            outputs += chunk_resources(chromosome, panel)["outputs"]
+            if os.path.exists(chunks_path(chromosome, panel)):
+                outputs += [split_reference_bin(chromosome, input_region, panel=panel) for input_region, _ in chunk_regions(chromosome, panel)]
+    return outputs
 
 
 def run_prepare_reference_panel():
@@ -209,5 +545,7 @@ def run_prepare_reference_panel():
     # Step 0: verify gatk bundle
     prepare_gatk_bundle()
 
-    with ThreadPoolExecutor(max_workers=25) as executor:  # Giới hạn 24 luồng song song
-        executor.map(prepare_reference_panel, PARAMETERS["chrs"])
\ No newline at end of file
+    # Mỗi chromosome một luồng điều phối; số tiến trình chạy thật sự do async runner giới hạn
+    # (runner.limits: download, panel, split_reference và runner.memory_gb)
+    with ThreadPoolExecutor(max_workers=len(PARAMETERS["chrs"])) as executor:
+        list(executor.map(prepare_reference_panel, PARAMETERS["chrs"]))
\ No newline at end of file
@@ -3,6 +3,7 @@ import os
 from statistic.GT import get_af_gt, get_af_gt_true, get_af_gt_false, get_af_gt_not_given, get_af_gt_priv_true, get_af_gt_same_true, get_af_gt_same_false
 from statistic.ALT import get_af_alt, get_af_alt_true, get_af_alt_false, get_af_alt_not_given, get_af_alt_priv_true, get_af_alt_same_true, get_af_alt_same_false
 from helper.file_utils import save_results_to_csv, process_vcf
+from helper.truth_cache import load_truth
 from helper.config import PATHS, PARAMETERS
 from helper.logger import setup_logger
 
@@ -22,9 +23,9 @@ def compare_nipt_variants(child_path, mother_path, father_path, basevar_path, gl
             merged_df = pd.read_csv(output_file)
             return merged_df
         
-        child_df = process_vcf(child_path, "Child")
-        mother_df = process_vcf(mother_path, "Mother")
-        father_df = process_vcf(father_path, "Father")
+        child_df = load_truth(child_path, "Child")
+        mother_df = load_truth(mother_path, "Mother")
+        father_df = load_truth(father_path, "Father")
         basevar_df = process_vcf(basevar_path, "BaseVar")
         glimpse_df = process_vcf(glimpse_path, "Glimpse")
 
@@ -3,6 +3,7 @@ import os
 from statistic.GT import get_af_gt, get_af_gt_true, get_af_gt_false, get_af_gt_not_given
 from statistic.ALT import get_af_alt, get_af_alt_true, get_af_alt_false, get_af_alt_not_given
 from helper.file_utils import save_results_to_csv, process_vcf
+from helper.truth_cache import load_truth
 from helper.config import PATHS, PARAMETERS
 from helper.logger import setup_logger
 
@@ -23,7 +24,7 @@ def compare_single_variants(ground_truth_path, basevar_path, glimpse_path, outpu
             merged_df = pd.read_csv(output_file)
             return merged_df
         
-        ground_truth_df = process_vcf(ground_truth_path, "Truth")
+        ground_truth_df = load_truth(ground_truth_path, "Truth")
         basevar_df = process_vcf(basevar_path, "BaseVar")
         glimpse_df = process_vcf(glimpse_path, "Glimpse")
 
@@ -1,11 +1,12 @@
 import pandas as pd
 import os
 from helper.file_utils import save_results_to_csv
-from helper.path_define import ground_truth_vcf, statistic_variants, statistic_summary, glimpse_vcf, basevar_vcf, samid
+from helper.path_define import statistic_variants, statistic_summary, glimpse_vcf, basevar_vcf, samid
 from helper.config import PATHS, PARAMETERS
 from helper.logger import setup_logger
 from statistic.single_stats import compare_single_variants, calculate_af_single_statistics
 from statistic.nipt_stats import compare_nipt_variants, calculate_af_nipt_statistics
+from pipeline.ground_truth import ground_truth_vcf
 
 # Thiết lập logger
 logger = setup_logger(os.path.join(PATHS["logs"], "statistic_pipeline.log"))